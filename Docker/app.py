@@ -1,54 +1,1023 @@
 import os
 import requests
+import requests.adapters
 import json
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
-from flask import Flask, request, jsonify
+import codecs
+import sys
+import sqlite3
+import random
+import time
+import hashlib
+import uuid
+import re
+import contextlib
+import fcntl
+import zipfile
+import threading
+import mmap
+import struct
+import bisect
+import zlib
+import math
+import unicodedata
+from collections import Counter, OrderedDict
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
+from werkzeug.exceptions import HTTPException
 
 app = Flask(__name__)
-CORS(app)  # Enable CORS support
+CORS(app, expose_headers=['X-Sync-Timestamp', 'X-Unresolved-Count', 'X-Title-Match-Count'])  # Enable CORS support
 
 ANILIST_USERNAME = os.getenv('ANILIST_USERNAME')  # AniList username
 XML_USERNAME = os.getenv('XML_USERNAME')  # XML username (can be anything)
-anime_offline_db = []
-
-# Function to download the anime-offline-database.json file
-def download_anime_offline_database():
-    url = 'https://raw.githubusercontent.com/manami-project/anime-offline-database/master/anime-offline-database.json'
-    response = requests.get(url)
-    response.raise_for_status()
-    with open('anime-offline-database.json', 'wb') as f:
-        f.write(response.content)
-
-# Load the anime offline database
-def load_anime_offline_database():
-    global anime_offline_db
-    with open('anime-offline-database.json', 'r') as f:
-        anime_offline_db = json.load(f)['data']
-
-# Ensure the anime offline database is downloaded and loaded
-download_anime_offline_database()
-load_anime_offline_database()
-
-def fetch_user_anime_list(anilist_username):
+
+ANILIST_API_URL = os.getenv('ANILIST_API_URL', 'https://graphql.anilist.co')
+WORKERS = int(os.getenv('WORKERS', 1))  # Server worker processes, set by gunicorn.conf.py
+ANILIST_LIMITER_PATH = os.getenv('ANILIST_LIMITER_PATH')  # File the worker processes share the AniList rate limit through, unset splits it between them
+ANILIST_RATE_LIMIT = int(os.getenv('ANILIST_RATE_LIMIT', 90))  # Requests per minute, shared by every conversion in every worker
+ANILIST_TIMEOUT = (5, 30)  # Connect and read timeouts for AniList requests, in seconds
+ANILIST_MAX_RETRIES = 4  # Retries after rate limiting or transport failures
+ANILIST_BACKOFF_BASE = 0.5  # Seconds, doubled on every retry and jittered
+ANILIST_BACKOFF_CAP = 30
+ANILIST_PAGE_SIZE = 50  # Largest page AniList serves
+ANILIST_STREAM_CHUNK_SIZE = 64 * 1024  # Bytes of a list response decoded at a time
+
+ANILIST_SOURCE_PREFIX = 'https://anilist.co/anime/'
+MAL_SOURCE_PREFIX = 'https://myanimelist.net/anime/'
+
+OFFLINE_DB_URL = os.getenv('OFFLINE_DB_URL', 'https://raw.githubusercontent.com/manami-project/anime-offline-database/master/anime-offline-database.json')
+OFFLINE_DB_DIR = os.getenv('OFFLINE_DB_DIR', '.')  # Cache directory for the offline database and its mapping store
+OFFLINE_DB_PATH = os.path.join(OFFLINE_DB_DIR, 'anime-offline-database.json')
+OFFLINE_DB_META_PATH = OFFLINE_DB_PATH + '.meta'  # ETag/Last-Modified of the cached copy
+OFFLINE_DB_MAX_AGE = int(os.getenv('OFFLINE_DB_MAX_AGE', 0))  # Seconds a cached copy is trusted without revalidating
+OFFLINE_DB_TIMEOUT = 60  # Seconds before giving up on the offline database download
+MAPPING_STORE_PATH = os.path.join(OFFLINE_DB_DIR, 'anime-offline-database.idx')  # Compact id index built from OFFLINE_DB_PATH
+MAPPING_STORE_CHECK_INTERVAL = 30  # Seconds between checks whether another process replaced the mapping store
+MAL_ID_CACHE_PATH = os.getenv('MAL_ID_CACHE', os.path.join(OFFLINE_DB_DIR, 'mal-id-cache.sqlite'))  # Misses and title matches kept between conversions, empty disables
+MAL_ID_MISS_TTL = int(os.getenv('MAL_ID_MISS_TTL', 7 * 24 * 60 * 60))  # Seconds an entry no id source knows is not looked up again
+TITLE_MATCH_TTL = int(os.getenv('TITLE_MATCH_TTL', 7 * 24 * 60 * 60))  # Seconds a cached title match, or failure to match, is reused
+OFFLINE_DB_REFRESH_INTERVAL = int(os.getenv('OFFLINE_DB_REFRESH_INTERVAL', 6 * 60 * 60))  # Seconds between background refreshes, 0 disables
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', 10 * 60))  # Seconds a cached conversion is served without asking AniList again
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))  # Size bound of the in-memory LRU
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR')  # Optional on-disk tier, unset disables it
+RESULT_CACHE_DISK_MAX_BYTES = int(os.getenv('RESULT_CACHE_DISK_MAX_BYTES', 512 * 1024 * 1024))  # Size bound of the on-disk tier
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', 6))  # zlib level of gzip and deflate responses
+CONTENT_CODINGS = {'gzip': 31, 'deflate': 15}  # Accept-Encoding codings served, with the zlib wbits producing them
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))  # Conversions run concurrently by the job pool
+JOB_QUEUE_DEPTH = int(os.getenv('JOB_QUEUE_DEPTH', 32))  # Jobs waiting for a worker before POST /jobs is refused
+JOB_RETENTION = int(os.getenv('JOB_RETENTION', 15 * 60))  # Seconds a finished job is kept for polling
+JOBS_DIR = os.getenv('JOBS_DIR')  # Directory where jobs are shared between worker processes, unset keeps them in memory
+JOB_SYNC_INTERVAL = 1  # Seconds between writes of job progress and checks for cancellation from other workers
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', 8))  # Users of one batch fetched concurrently, under the shared AniList rate limit
+BATCH_MAX_USERS = int(os.getenv('BATCH_MAX_USERS', 100))
+TRACE_REQUESTS = os.getenv('TRACE_REQUESTS', '') not in ('', '0')  # Log per-request stage timings to stderr
+SNAPSHOT_DB = os.getenv('SNAPSHOT_DB')  # SQLite file for per-user list snapshots, unset disables incremental sync
+SNAPSHOT_FULL_SYNC_INTERVAL = int(os.getenv('SNAPSHOT_FULL_SYNC_INTERVAL', 24 * 60 * 60))  # Seconds between full re-fetches, which also drop deleted entries
+MAPPING_STORE_MAGIC = b'AL2MAL01'
+MAPPING_STORE_HEADER = struct.Struct('<8sQqII')  # magic, source size, source mtime_ns, forward count, reverse count
+TITLE_MATCHING = os.getenv('TITLE_MATCHING', '') not in ('', '0')  # Match titles for entries no id source resolves
+TITLE_MATCH_THRESHOLD = float(os.getenv('TITLE_MATCH_THRESHOLD', 0.8))  # Confidence, from 0 to 1, a title match needs
+TITLE_MATCH_TITLE_WEIGHT = 0.7  # Share of the confidence from title similarity, type, episodes and year make up the rest
+TITLE_MATCH_MARGIN = 0.05  # Lead the best match needs over a different runner-up, ambiguous titles are not matched
+TITLE_MATCH_MAX_POSTINGS = 128  # Titles a trigram may match and still be used to find candidates
+TITLE_INDEX_MAGIC = b'AL2MALT1'
+TITLE_INDEX_HEADER = struct.Struct('<8sQqIIII')  # magic, source size, source mtime_ns, candidate, title, trigram and posting counts
+INDEX_SOURCE_HEADER = struct.Struct('<8sQq')  # The leading fields both index files share
+OFFLINE_DB_TYPES = ['UNKNOWN', 'TV', 'MOVIE', 'OVA', 'ONA', 'SPECIAL']
+ANILIST_FORMAT_TYPES = {'TV': 'TV', 'TV_SHORT': 'TV', 'MOVIE': 'MOVIE', 'OVA': 'OVA', 'ONA': 'ONA', 'SPECIAL': 'SPECIAL'}
+TITLE_SEPARATORS = re.compile(r'[\W_]+')
+
+# Read the cached validators of the offline database, empty when there is no usable cached copy
+def read_offline_database_meta():
+    if not os.path.exists(OFFLINE_DB_PATH) or not os.path.exists(OFFLINE_DB_META_PATH):
+        return {}
+    try:
+        with open(OFFLINE_DB_META_PATH, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+# Function to download the anime-offline-database.json file, revalidating the cached copy if there is one.
+# Returns True when a new copy was written.
+def download_anime_offline_database(max_age=0):
+    meta = read_offline_database_meta()
+    if max_age and time.time() - meta.get('checked_at', 0) < max_age:
+        return False
+
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    os.makedirs(OFFLINE_DB_DIR, exist_ok=True)
+    with requests.get(OFFLINE_DB_URL, headers=headers, stream=True, timeout=OFFLINE_DB_TIMEOUT) as response:
+        changed = response.status_code != 304
+        if changed:
+            response.raise_for_status()
+            tmp_path = f'{OFFLINE_DB_PATH}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    f.write(chunk)
+            os.replace(tmp_path, OFFLINE_DB_PATH)
+            meta = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')
+            }
+
+    meta['checked_at'] = time.time()
+    tmp_path = f'{OFFLINE_DB_META_PATH}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, OFFLINE_DB_META_PATH)
+    return changed
+
+# Build exact-match lookup tables between AniList and MAL ids from the offline database
+def build_id_index(entries):
+    anilist_index = {}
+    mal_index = {}
+    for anime in entries:
+        anilist_ids = []
+        mal_id = None
+        for source in anime['sources']:
+            if source.startswith(ANILIST_SOURCE_PREFIX):
+                anilist_id = source[len(ANILIST_SOURCE_PREFIX):]
+                if anilist_id.isdigit():
+                    anilist_ids.append(int(anilist_id))
+            elif mal_id is None and source.startswith(MAL_SOURCE_PREFIX):
+                source_id = source[len(MAL_SOURCE_PREFIX):]
+                if source_id.isdigit():
+                    mal_id = int(source_id)
+        if mal_id is None:
+            continue
+        for anilist_id in anilist_ids:
+            anilist_index.setdefault(anilist_id, mal_id)
+        if anilist_ids:
+            mal_index.setdefault(mal_id, anilist_ids[0])
+    return anilist_index, mal_index
+
+# Read-only id map backed by two parallel arrays, keys sorted ascending
+class SortedIdMap:
+    def __init__(self, keys, values):
+        self.keys = keys
+        self.values = values
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.values[i]
+        return default
+
+
+# Id index stored on disk as sorted integer arrays, memory-mapped on first lookup
+class MappingStore:
+    def __init__(self, path=MAPPING_STORE_PATH):
+        self.path = path
+        self._maps = None
+        self._titles = None
+        self._version = None
+        self._identity = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        if self._maps is None:
+            with self._lock:
+                if self._maps is None:
+                    with open(self.path, 'rb') as f:
+                        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                        stat = os.fstat(f.fileno())
+                    magic, source_size, source_mtime_ns, forward_count, reverse_count = MAPPING_STORE_HEADER.unpack_from(data)
+                    if magic != MAPPING_STORE_MAGIC:
+                        raise Exception(f'"{self.path}" is not an id mapping store.')
+                    view = memoryview(data)
+                    offset = MAPPING_STORE_HEADER.size
+                    maps = []
+                    for count in (forward_count, reverse_count):
+                        size = count * array('I').itemsize
+                        keys = view[offset:offset + size].cast('I')
+                        values = view[offset + size:offset + 2 * size].cast('I')
+                        maps.append(SortedIdMap(keys, values))
+                        offset += 2 * size
+                    self._version = f'{source_size}-{source_mtime_ns}'
+                    self._identity = (stat.st_ino, stat.st_mtime_ns)
+                    self._maps = maps
+        return self._maps
+
+    # True when the file at path is no longer the one this store has mapped,
+    # because a refresh in another process replaced it
+    def is_replaced(self):
+        if self._identity is None:
+            return False
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return (stat.st_ino, stat.st_mtime_ns) != self._identity
+
+    # Identifies the offline database copy the store was built from
+    @property
+    def version(self):
+        self.open()
+        return self._version
+
+    @property
+    def anilist_to_mal(self):
+        return self.open()[0]
+
+    @property
+    def mal_to_anilist(self):
+        return self.open()[1]
+
+    # Map the title index built next to the store, only there with TITLE_MATCHING
+    def load_titles(self):
+        if self._titles is None:
+            with self._lock:
+                if self._titles is None:
+                    self._titles = TitleIndex(title_index_path(self.path))
+        return self._titles
+
+    @property
+    def titles(self):
+        return self.load_titles()
+
+
+def title_index_path(store_path):
+    return store_path + '.titles'
+
+
+# Lowercase a title and reduce it to words of letters and digits, without accents
+def normalize_title(title):
+    title = ''.join(c for c in unicodedata.normalize('NFKD', title.lower()) if not unicodedata.combining(c))
+    return TITLE_SEPARATORS.sub(' ', title).strip()
+
+
+# Hashed trigrams of a normalized title, padded so that word starts and ends count too
+def title_trigrams(title):
+    padded = f' {title} '
+    return {zlib.crc32(padded[i:i + 3].encode('utf-8')) for i in range(len(padded) - 2)}
+
+
+# Build step for title matching: a trigram index over the titles and synonyms of the offline database
+# entries that have a MAL id but no AniList link, the only ones a title match can add. Titles are
+# numbered by trigram count, so the titles of a size range have a range of ids.
+def build_title_index(entries, path, stat):
+    mal_ids, types, episodes, years = array('I'), array('B'), array('H'), array('H')
+    titles = []
+    for anime in entries:
+        if any(source.startswith(ANILIST_SOURCE_PREFIX) for source in anime['sources']):
+            continue
+        mal_id = next((int(source[len(MAL_SOURCE_PREFIX):]) for source in anime['sources']
+                       if source.startswith(MAL_SOURCE_PREFIX) and source[len(MAL_SOURCE_PREFIX):].isdigit()), None)
+        normalized = {normalize_title(title) for title in [anime['title']] + anime.get('synonyms', [])} - {''}
+        if mal_id is None or not normalized:
+            continue
+        candidate = len(mal_ids)
+        mal_ids.append(mal_id)
+        types.append(OFFLINE_DB_TYPES.index(anime['type']) if anime.get('type') in OFFLINE_DB_TYPES else 0)
+        episodes.append(min(anime.get('episodes') or 0, 0xFFFF))
+        years.append((anime.get('animeSeason') or {}).get('year') or 0)
+        titles.extend((title_trigrams(title), candidate) for title in normalized)
+
+    titles.sort(key=lambda title: len(title[0]))
+    title_candidates, title_sizes = array('I'), array('H')
+    postings = {}
+    for title_id, (trigrams, candidate) in enumerate(titles):
+        for trigram in trigrams:
+            postings.setdefault(trigram, []).append(title_id)
+        title_candidates.append(candidate)
+        title_sizes.append(min(len(trigrams), 0xFFFF))
+
+    keys = array('I', sorted(postings))
+    offsets = array('I', [0])
+    flat = array('I')
+    for key in keys:
+        flat.extend(postings[key])
+        offsets.append(len(flat))
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(TITLE_INDEX_HEADER.pack(TITLE_INDEX_MAGIC, stat.st_size, stat.st_mtime_ns,
+                                        len(mal_ids), len(title_candidates), len(keys), len(flat)))
+        for part in (keys, offsets, flat, mal_ids, title_candidates, episodes, years, title_sizes, types):
+            part.tofile(f)
+    os.replace(tmp_path, path)
+
+
+# Fuzzy title lookup over the index of build_title_index, memory-mapped like MappingStore
+class TitleIndex:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, _, _, candidate_count, title_count, key_count, posting_count = TITLE_INDEX_HEADER.unpack_from(data)
+        if magic != TITLE_INDEX_MAGIC:
+            raise Exception(f'"{path}" is not a title index.')
+        view = memoryview(data)
+        offset = TITLE_INDEX_HEADER.size
+        parts = []
+        for typecode, count in (('I', key_count), ('I', key_count + 1), ('I', posting_count), ('I', candidate_count),
+                                ('I', title_count), ('H', candidate_count), ('H', candidate_count), ('H', title_count),
+                                ('B', candidate_count)):
+            size = count * array(typecode).itemsize
+            parts.append(view[offset:offset + size].cast(typecode))
+            offset += size
+        (self.keys, self.offsets, self.postings, self.mal_ids, self.title_candidates,
+         self.episodes, self.years, self.title_sizes, self.types) = parts
+
+    # Title similarity, as the Dice coefficient of the trigram sets, of every candidate that can reach
+    # min_similarity with one of the entry's titles. Only titles of a size that can reach it are looked
+    # at, and only the rarest trigrams, enough that any such title has at least one of them, are used to
+    # find candidates. Trigrams matching more than TITLE_MATCH_MAX_POSTINGS titles are too common to
+    # find candidates with and are skipped, so a lookup scans at most that many titles per trigram.
+    # The other trigrams of the candidates are then checked by bisecting the postings.
+    def similarities(self, anime, min_similarity):
+        similarities = {}
+        for title in (anime.title, anime.romaji_title):
+            if not title:
+                continue
+            trigrams = title_trigrams(normalize_title(title))
+            size = len(trigrams)
+            # 2c / (q + t) >= s with c <= min(q, t) needs s q / (2 - s) <= t <= (2 - s) q / s,
+            # and c >= s q / (2 - s) common trigrams
+            min_common = max(1, math.ceil(min_similarity * size / (2 - min_similarity)))
+            first = bisect.bisect_left(self.title_sizes, min_common)
+            last = bisect.bisect_right(self.title_sizes, int(size * (2 - min_similarity) / min_similarity))
+            ranges = []
+            for trigram in trigrams:
+                i = bisect.bisect_left(self.keys, trigram)
+                if i < len(self.keys) and self.keys[i] == trigram:
+                    start = bisect.bisect_left(self.postings, first, self.offsets[i], self.offsets[i + 1])
+                    end = bisect.bisect_left(self.postings, last, start, self.offsets[i + 1])
+                    if start < end:
+                        ranges.append((start, end))
+            ranges.sort(key=lambda bounds: bounds[1] - bounds[0])
+            prefix = len(ranges) - min_common + 1
+            if prefix <= 0:
+                continue
+            while prefix and ranges[prefix - 1][1] - ranges[prefix - 1][0] > TITLE_MATCH_MAX_POSTINGS:
+                prefix -= 1
+            hits = Counter()
+            for start, end in ranges[:prefix]:
+                hits.update(self.postings[start:end])
+            rest = ranges[prefix:]
+            for title_id, common in hits.items():
+                title_size = self.title_sizes[title_id]
+                needed = min_similarity * (size + title_size) / 2
+                missing = len(rest)
+                if common + missing < needed:
+                    continue
+                for start, end in rest:
+                    if common + missing < needed:
+                        break
+                    missing -= 1
+                    i = bisect.bisect_left(self.postings, title_id, start, end)
+                    if i < end and self.postings[i] == title_id:
+                        common += 1
+                similarity = 2 * common / (size + title_size)
+                candidate = self.title_candidates[title_id]
+                if similarity >= min_similarity and similarity > similarities.get(candidate, 0):
+                    similarities[candidate] = similarity
+        return similarities
+
+    # Title similarity weighed with agreement on type, episodes and year, which add 0.1 each when they
+    # agree and 0.05 when unknown on either side
+    def confidence(self, candidate, similarity, anime):
+        type_ = ANILIST_FORMAT_TYPES.get(anime.format)
+        confidence = TITLE_MATCH_TITLE_WEIGHT * similarity
+        for ours, theirs in ((OFFLINE_DB_TYPES.index(type_) if type_ else 0, self.types[candidate]),
+                             (anime.episodes or 0, self.episodes[candidate]),
+                             (anime.year or 0, self.years[candidate])):
+            if not ours or not theirs:
+                confidence += 0.05
+            elif ours == theirs:
+                confidence += 0.1
+        return confidence
+
+    # Returns (mal_id, confidence) of the best match for a list entry, or None when no candidate
+    # reaches threshold or the best one isn't clearly ahead of the rest
+    def match(self, anime, threshold=TITLE_MATCH_THRESHOLD):
+        best, best_confidence, runner_up = None, 0, 0
+        min_similarity = max(0.1, (threshold - (1 - TITLE_MATCH_TITLE_WEIGHT)) / TITLE_MATCH_TITLE_WEIGHT)
+        for candidate, similarity in self.similarities(anime, min_similarity).items():
+            confidence = self.confidence(candidate, similarity, anime)
+            if confidence > best_confidence:
+                if best is not None and self.mal_ids[best] != self.mal_ids[candidate]:
+                    runner_up = best_confidence
+                best, best_confidence = candidate, confidence
+            elif confidence > runner_up and self.mal_ids[best] != self.mal_ids[candidate]:
+                runner_up = confidence
+        if best is None or best_confidence < threshold or best_confidence - runner_up < TITLE_MATCH_MARGIN:
+            return None
+        return self.mal_ids[best], best_confidence
+
+
+# Build step: turn the offline database json into the compact mapping store
+def build_mapping_store(db_path=OFFLINE_DB_PATH, store_path=MAPPING_STORE_PATH):
+    with open(db_path, 'r') as f:
+        entries = json.load(f)['data']
+    anilist_index, mal_index = build_id_index(entries)
+    stat = os.stat(db_path)
+    if TITLE_MATCHING:
+        build_title_index(entries, title_index_path(store_path), stat)
+    del entries
+    tmp_path = f'{store_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAPPING_STORE_HEADER.pack(MAPPING_STORE_MAGIC, stat.st_size, stat.st_mtime_ns, len(anilist_index), len(mal_index)))
+        for index in (anilist_index, mal_index):
+            keys = sorted(index)
+            array('I', keys).tofile(f)
+            array('I', [index[key] for key in keys]).tofile(f)
+    os.replace(tmp_path, store_path)
+
+
+# An index file is current when it was built from the offline database file as it is on disk now
+def index_file_is_current(db_path, path, expected_magic):
+    if not os.path.exists(path):
+        return False
+    if not os.path.exists(db_path):
+        return True
+    with open(path, 'rb') as f:
+        header = f.read(INDEX_SOURCE_HEADER.size)
+    if len(header) < INDEX_SOURCE_HEADER.size:
+        return False
+    magic, size, mtime_ns = INDEX_SOURCE_HEADER.unpack(header)
+    stat = os.stat(db_path)
+    return magic == expected_magic and size == stat.st_size and mtime_ns == stat.st_mtime_ns
+
+
+# The store is current when it, and with TITLE_MATCHING its title index, match the offline database
+def mapping_store_is_current(db_path=OFFLINE_DB_PATH, store_path=MAPPING_STORE_PATH):
+    if not index_file_is_current(db_path, store_path, MAPPING_STORE_MAGIC):
+        return False
+    return not TITLE_MATCHING or index_file_is_current(db_path, title_index_path(store_path), TITLE_INDEX_MAGIC)
+
+
+# Load the anime offline database, only parsing the json when the mapping store is missing or stale
+def load_anime_offline_database(db_path=None, store_path=None):
+    global id_store
+    db_path = db_path or OFFLINE_DB_PATH
+    store_path = store_path or MAPPING_STORE_PATH
+    if not mapping_store_is_current(db_path, store_path):
+        build_mapping_store(db_path, store_path)
+    id_store = MappingStore(store_path)
+
+# Make sure there is a usable offline database, falling back to the cached copy when the download fails
+def prepare_anime_offline_database():
+    try:
+        download_anime_offline_database(OFFLINE_DB_MAX_AGE)
+    except requests.RequestException as e:
+        if not os.path.exists(OFFLINE_DB_PATH) and not os.path.exists(MAPPING_STORE_PATH):
+            raise
+        print(f'Error downloading anime offline database, using the cached copy: {e}', file=sys.stderr)
+    load_anime_offline_database()
+
+# Revalidate the offline database and, if it changed, rebuild the mapping store. With swap the new
+# store is opened before it is swapped in, so requests in flight keep using the old one. Without it
+# only the files are rebuilt, for the processes serving requests to pick up.
+def refresh_anime_offline_database(swap=True):
+    global id_store
+    with refresh_lock:
+        download_anime_offline_database()
+        if mapping_store_is_current():
+            return False
+        build_mapping_store()
+        if swap:
+            id_store = open_mapping_store()
+        return True
+
+
+def offline_database_refresher(interval, swap):
+    while not refresh_stop_event.wait(interval):
+        try:
+            refresh_anime_offline_database(swap)
+        except Exception as e:
+            print(f'Error refreshing anime offline database: {e}')
+
+
+# The gunicorn parent serves no requests, so it refreshes without swap: its workers are separate
+# processes and only see the rebuilt store through reload_mapping_store_if_replaced
+def start_offline_database_refresher(interval=OFFLINE_DB_REFRESH_INTERVAL, swap=True):
+    global refresher_pid
+    if interval <= 0:
+        return None
+    if swap:
+        refresher_pid = os.getpid()
+    thread = threading.Thread(target=offline_database_refresher, args=(interval, swap), name='offline-db-refresher', daemon=True)
+    thread.start()
+    return thread
+
+
+# Processes without the refresher, such as every gunicorn worker, don't refresh themselves, they pick
+# up the store the refresher in the parent process rebuilt. Checked at most every MAPPING_STORE_CHECK_INTERVAL seconds.
+def reload_mapping_store_if_replaced():
+    global id_store, mapping_store_checked_at
+    now = time.monotonic()
+    if now - mapping_store_checked_at < MAPPING_STORE_CHECK_INTERVAL:
+        return False
+    mapping_store_checked_at = now
+    if not id_store.is_replaced():
+        return False
+    id_store = open_mapping_store(id_store.path)
+    return True
+
+
+# A new store with its files mapped up front, rather than on the first request that needs them
+def open_mapping_store(path=MAPPING_STORE_PATH):
+    store = MappingStore(path)
+    store.open()
+    if TITLE_MATCHING:
+        store.load_titles()
+    return store
+
+
+id_store = MappingStore()
+refresh_lock = threading.Lock()
+refresh_stop_event = threading.Event()
+mapping_store_checked_at = 0
+refresher_pid = None  # Process whose refresher swaps in new stores itself, the development server
+
+# Ensure the anime offline database is downloaded and loaded. The store is mapped here, before
+# gunicorn forks (preload_app), so every worker shares the same read-only pages.
+prepare_anime_offline_database()
+id_store.open()
+if TITLE_MATCHING:
+    # The title index is mapped here too, before forking, instead of by every worker on its first title match
+    id_store.load_titles()
+
+
+# The AniList client, like the offline database, list parsing and XML code, is kept identical to
+# anime_list_converter.py rather than imported from a shared module, so the desktop script keeps
+# working as the single file the README has users download. tests/test_shared_code.py checks the
+# copies still match.
+class AniListError(Exception):
+    pass
+
+
+class AniListNotFoundError(AniListError):
+    pass
+
+
+class AniListRateLimitError(AniListError):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AniListTransportError(AniListError):
+    pass
+
+
+class AniListCancelledError(AniListError):
+    pass
+
+
+# Token bucket shared by every thread using the client, also honouring the limits AniList reports back
+class TokenBucket:
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, requests_per_minute, burst):
+        self.rate = requests_per_minute / 60
+        self.capacity = burst
+        self.tokens = burst
+        self.updated_at = self.clock()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    # Hold the bucket while its state is read and updated
+    @contextlib.contextmanager
+    def locked(self):
+        with self.lock:
+            yield
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # Wait for a token, returns False if cancel_event was set while waiting
+    def acquire(self, cancel_event=None):
+        while True:
+            with self.locked():
+                now = self.clock()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            if cancel_event is not None:
+                if cancel_event.wait(wait):
+                    return False
+            else:
+                time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.locked():
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+            self.tokens = 0
+
+    # Never hand out more tokens than AniList says are left in the current window
+    def observe(self, remaining):
+        with self.locked():
+            self.tokens = min(self.tokens, remaining)
+
+
+SHARED_BUCKET_STATE = struct.Struct('<ddd')  # tokens, updated_at, paused_until
+
+
+# TokenBucket kept in a file that every worker process draws from, so one busy worker can use the whole
+# AniList budget instead of a fixed share of it while the others are idle
+class SharedTokenBucket(TokenBucket):
+    clock = staticmethod(time.time)  # Comparable between processes
+
+    def __init__(self, requests_per_minute, burst, path):
+        super().__init__(requests_per_minute, burst)
+        self.path = path
+
+    @contextlib.contextmanager
+    def locked(self):
+        with self.lock, os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600), 'r+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            data = f.read()
+            if len(data) == SHARED_BUCKET_STATE.size:
+                self.tokens, self.updated_at, self.paused_until = SHARED_BUCKET_STATE.unpack(data)
+            else:
+                self.tokens, self.updated_at, self.paused_until = self.capacity, self.clock(), 0
+            yield
+            f.seek(0)
+            f.write(SHARED_BUCKET_STATE.pack(self.tokens, self.updated_at, self.paused_until))
+            f.truncate()
+
+
+# Keep-alive GraphQL client for AniList with timeouts, rate limiting and jittered retries
+class AniListClient:
+    def __init__(self, url=ANILIST_API_URL, requests_per_minute=ANILIST_RATE_LIMIT, max_retries=ANILIST_MAX_RETRIES, timeout=ANILIST_TIMEOUT, pool_size=10, on_attempt=None,
+                 limiter=None):
+        self.url = url
+        self.on_attempt = on_attempt  # Called with the outcome of every request, for metrics
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.limiter = limiter or TokenBucket(requests_per_minute, burst=max(1, int(requests_per_minute) // 6))
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    # parse, if given, reads a successful response from its streamed body instead of the client
+    # decoding it whole, and its result is returned in place of the data
+    def query(self, query, variables, cancel_event=None, parse=None):
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                delay = random.uniform(0, min(ANILIST_BACKOFF_CAP, ANILIST_BACKOFF_BASE * 2 ** attempt))
+                if cancel_event is not None and cancel_event.wait(delay):
+                    raise AniListCancelledError('AniList request cancelled.')
+                elif cancel_event is None:
+                    time.sleep(delay)
+            if not self.limiter.acquire(cancel_event):
+                raise AniListCancelledError('AniList request cancelled.')
+
+            try:
+                response = self.session.post(self.url, json={'query': query, 'variables': variables}, timeout=self.timeout,
+                                             stream=parse is not None)
+            except requests.RequestException as e:
+                error = AniListTransportError(f'Error contacting AniList: {e}')
+                self.record_attempt('transport_error')
+                continue
+
+            remaining = response.headers.get('X-RateLimit-Remaining')
+            if remaining is not None and remaining.isdigit():
+                self.limiter.observe(int(remaining))
+            if response.status_code == 429:
+                retry_after = response.headers.get('Retry-After', '')
+                retry_after = int(retry_after) if retry_after.isdigit() else 60
+                self.limiter.pause(retry_after)
+                error = AniListRateLimitError(f'AniList rate limit reached, try again in {retry_after} seconds.', retry_after)
+                self.record_attempt('rate_limited')
+                response.close()  # A streamed response holds its pooled connection until closed
+                continue
+            if response.status_code >= 500:
+                error = AniListTransportError(f'AniList returned HTTP {response.status_code}.')
+                self.record_attempt('server_error')
+                response.close()
+                continue
+            if parse is not None and response.status_code == 200:
+                try:
+                    result = parse(response)
+                except requests.RequestException as e:
+                    error = AniListTransportError(f'Error reading the AniList response: {e}')
+                    self.record_attempt('transport_error')
+                    continue
+                except ValueError:
+                    error = AniListTransportError('AniList returned an invalid response (HTTP 200).')
+                    self.record_attempt('invalid_response')
+                    continue
+                finally:
+                    response.close()
+                self.record_attempt('ok')
+                return result
+
+            try:
+                data = response.json()
+            except ValueError:
+                error = AniListTransportError(f'AniList returned an invalid response (HTTP {response.status_code}).')
+                self.record_attempt('invalid_response')
+                continue
+            if data.get('errors'):
+                message = '; '.join(e.get('message', 'Unknown error') for e in data['errors'])
+                if response.status_code == 404 or any(e.get('status') == 404 for e in data['errors']):
+                    self.record_attempt('not_found')
+                    raise AniListNotFoundError(message)
+                self.record_attempt('error')
+                raise AniListError(f'AniList error: {message}')
+            if response.status_code >= 400:
+                self.record_attempt('error')
+                raise AniListError(f'AniList returned HTTP {response.status_code}.')
+            self.record_attempt('ok')
+            return data['data']
+        raise error
+
+    def record_attempt(self, outcome):
+        if self.on_attempt is not None:
+            self.on_attempt(outcome)
+
+
+# Pack an AniList fuzzy date into a yyyymmdd int, unknown parts are 0
+def pack_date(date):
+    return (date['year'] or 0) * 10000 + (date['month'] or 0) * 100 + (date['day'] or 0)
+
+
+# MAL date of a packed date, unpadded and with zeros for unknown parts as the export always wrote it
+def format_date(packed):
+    year, month, day = packed // 10000, packed // 100 % 100, packed % 100
+    return f"{year or '0000'}-{month or '00'}-{day or '00'}"
+
+
+# One entry of a user's list. Lists can have tens of thousands of these, so they are slotted,
+# the dates are packed ints and the format and status strings are shared. Manga entries keep their
+# chapters in episodes and the chapters read in progress, only they have volumes.
+class ListEntry:
+    __slots__ = ('anilist_id', 'title', 'episodes', 'format', 'score', 'progress', 'started_at', 'completed_at',
+                 'status', 'updated_at', 'mal_id', 'year', 'romaji_title', 'volumes', 'progress_volumes')
+
+    def __init__(self, anilist_id, title, episodes, format_, score, progress, started_at, completed_at, status, updated_at,
+                 mal_id=None, year=None, romaji_title=None, volumes=None, progress_volumes=None):
+        self.anilist_id = anilist_id
+        self.title = title
+        self.episodes = episodes
+        self.format = sys.intern(format_) if format_ else format_
+        self.score = score
+        self.progress = progress
+        self.started_at = started_at
+        self.completed_at = completed_at
+        self.status = sys.intern(status) if status else status
+        self.updated_at = updated_at
+        self.mal_id = mal_id
+        self.year = year
+        self.romaji_title = romaji_title  # Only kept when title is the English one
+        self.volumes = volumes
+        self.progress_volumes = progress_volumes
+
+    @property
+    def start_date(self):
+        return format_date(self.started_at)
+
+    @property
+    def finish_date(self):
+        return format_date(self.completed_at)
+
+    # The fields as a list, which is how entries are stored and hashed
+    def to_row(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+
+def parse_list_entry(entry):
+    media = entry['media']
+    title = media['title']
+    return ListEntry(media['id'], title['english'] or title['romaji'], media['episodes'] if 'episodes' in media else media.get('chapters'),
+                     media['format'], entry['score'], entry['progress'], pack_date(entry['startedAt']), pack_date(entry['completedAt']),
+                     entry['status'], entry.get('updatedAt') or 0, media.get('idMal') or None, media.get('seasonYear'),
+                     title['romaji'] if title['english'] else None, media.get('volumes'), entry.get('progressVolumes'))
+
+
+# An escaped quote can't start a key, so this never matches inside a string
+LIST_ENTRIES_KEY = re.compile(r'(?<!\\)"entries"\s*:\s*\[')
+JSON_SEPARATORS = re.compile(r'[\s,]*')
+
+
+# Decode the objects of every "entries" array of a MediaListCollection response one by one as the body
+# arrives, so neither the whole document nor its parsed tree is ever held in memory
+def iter_list_entries(chunks):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    in_entries = False
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+        pos = 0
+        while True:
+            if not in_entries:
+                match = LIST_ENTRIES_KEY.search(buffer, pos)
+                if match is None:
+                    # Keep enough of the tail for a key split between chunks
+                    pos = max(pos, len(buffer) - 32)
+                    break
+                pos = match.end()
+                in_entries = True
+            pos = JSON_SEPARATORS.match(buffer, pos).end()
+            if pos == len(buffer):
+                break
+            if buffer[pos] == ']':
+                in_entries = False
+                pos += 1
+                continue
+            try:
+                entry, pos_end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                break  # The entry continues in the next chunk
+            yield entry
+            pos = pos_end
+        buffer = buffer[pos:]
+    if in_entries:
+        raise ValueError('List response ended in the middle of a list.')
+
+
+# Entry records of a streamed list response. Entries that are also in custom lists come once
+# for every list, only the first copy is kept.
+def iter_anime_entries(chunks):
+    seen = set()
+    for entry in iter_list_entries(chunks):
+        anilist_id = entry['media']['id']
+        if anilist_id not in seen:
+            seen.add(anilist_id)
+            yield parse_list_entry(entry)
+
+
+def parse_media_list_collection(response):
+    return list(iter_anime_entries(response.iter_content(ANILIST_STREAM_CHUNK_SIZE)))
+
+
+# Fetch the entries updated at or after since, newest first, paging through the list only as far as needed
+def fetch_updated_anime_entries(anilist_username, since, cancel_event=None, media_type='ANIME'):
     query = '''
-        query ($userName: String) {
-            MediaListCollection(userName: $userName, type: ANIME) {
+        query ($userName: String, $type: MediaType, $manga: Boolean!, $page: Int, $perPage: Int) {
+            Page(page: $page, perPage: $perPage) {
+                pageInfo {
+                    hasNextPage
+                }
+                mediaList(userName: $userName, type: $type, sort: UPDATED_TIME_DESC) {
+                    media {
+                        id
+                        idMal
+                        title {
+                            english
+                            romaji
+                        }
+                        episodes @skip(if: $manga)
+                        chapters @include(if: $manga)
+                        volumes @include(if: $manga)
+                        format
+                        seasonYear
+                    }
+                    score
+                    progress
+                    progressVolumes @include(if: $manga)
+                    startedAt {
+                        year
+                        month
+                        day
+                    }
+                    completedAt {
+                        year
+                        month
+                        day
+                    }
+                    status
+                    updatedAt
+                }
+            }
+        }
+    '''
+
+    updated = []
+    page = 1
+    while True:
+        variables = {
+            'userName': anilist_username,
+            'type': media_type,
+            'manga': media_type == 'MANGA',
+            'page': page,
+            'perPage': ANILIST_PAGE_SIZE
+        }
+        try:
+            data = anilist_client.query(query, variables, cancel_event)
+        except AniListNotFoundError:
+            raise AniListNotFoundError(f'AniList username "{anilist_username}" not found.')
+        for entry in data['Page']['mediaList']:
+            if (entry['updatedAt'] or 0) < since:
+                return updated
+            updated.append(parse_list_entry(entry))
+        if not data['Page']['pageInfo']['hasNextPage']:
+            return updated
+        page += 1
+
+
+# Per-user copy of the last fetched list, so later runs only need to fetch what changed
+class SnapshotStore:
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._pid = None
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS snapshot_entries ('
+                                    'username TEXT, anilist_id INTEGER, updated_at INTEGER, entry TEXT, '
+                                    'PRIMARY KEY (username, anilist_id))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS snapshot_state ('
+                                    'username TEXT PRIMARY KEY, last_updated_at INTEGER, full_synced_at REAL)')
+
+    # SQLite connections must not be shared across fork, so every worker process opens its own
+    @property
+    def connection(self):
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._pid = os.getpid()
+        return self._connection
+
+    # Returns (last_updated_at, full_synced_at), or None for a user without a snapshot
+    def get_state(self, username):
+        with self.lock:
+            return self.connection.execute('SELECT last_updated_at, full_synced_at FROM snapshot_state WHERE username = ?',
+                                           (username,)).fetchone()
+
+    def replace(self, username, anime_list):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM snapshot_entries WHERE username = ?', (username,))
+            self._upsert(username, anime_list)
+            self.connection.execute('INSERT OR REPLACE INTO snapshot_state VALUES (?, ?, ?)',
+                                    (username, max((anime.updated_at for anime in anime_list), default=0), time.time()))
+
+    def merge(self, username, anime_list):
+        with self.lock, self.connection:
+            self._upsert(username, anime_list)
+            self.connection.execute('UPDATE snapshot_state SET last_updated_at = MAX(last_updated_at, ?) WHERE username = ?',
+                                    (max((anime.updated_at for anime in anime_list), default=0), username))
+
+    def _upsert(self, username, anime_list):
+        self.connection.executemany(
+            'INSERT INTO snapshot_entries VALUES (?, ?, ?, ?) ON CONFLICT (username, anilist_id) '
+            'DO UPDATE SET updated_at = excluded.updated_at, entry = excluded.entry',
+            ((username, anime.anilist_id, anime.updated_at, json.dumps(anime.to_row())) for anime in anime_list))
+
+    def load(self, username):
+        with self.lock:
+            rows = self.connection.execute('SELECT entry FROM snapshot_entries WHERE username = ? ORDER BY rowid',
+                                           (username,)).fetchall()
+        return [ListEntry.from_row(json.loads(entry)) for entry, in rows]
+
+
+# Worker processes draw from one AniList rate limit through ANILIST_LIMITER_PATH, without it each gets its share
+if ANILIST_LIMITER_PATH:
+    anilist_limiter = SharedTokenBucket(ANILIST_RATE_LIMIT, max(1, ANILIST_RATE_LIMIT // 6), ANILIST_LIMITER_PATH)
+else:
+    anilist_limiter = None
+anilist_client = AniListClient(requests_per_minute=ANILIST_RATE_LIMIT / WORKERS, limiter=anilist_limiter,
+                               on_attempt=lambda outcome: anilist_requests.inc(outcome=outcome))
+snapshot_store = SnapshotStore(SNAPSHOT_DB) if SNAPSHOT_DB else None
+
+
+# media_type is 'ANIME' or 'MANGA', both lists come back as the same entry records
+def fetch_user_anime_list(anilist_username, cancel_event=None, media_type='ANIME'):
+    query = '''
+        query ($userName: String, $type: MediaType, $manga: Boolean!) {
+            MediaListCollection(userName: $userName, type: $type) {
                 lists {
                     name
                     entries {
                         media {
                             id
+                            idMal
                             title {
                                 english
                                 romaji
                             }
-                            episodes
+                            episodes @skip(if: $manga)
+                            chapters @include(if: $manga)
+                            volumes @include(if: $manga)
                             format
+                            seasonYear
                         }
                         score
                         progress
+                        progressVolumes @include(if: $manga)
                         startedAt {
                             year
                             month
@@ -60,6 +1029,7 @@ def fetch_user_anime_list(anilist_username):
                             day
                         }
                         status
+                        updatedAt
                     }
                 }
             }
@@ -67,43 +1037,178 @@ def fetch_user_anime_list(anilist_username):
     '''
 
     variables = {
-        'userName': anilist_username
+        'userName': anilist_username,
+        'type': media_type,
+        'manga': media_type == 'MANGA'
     }
 
-    url = 'https://graphql.anilist.co'
+    try:
+        return anilist_client.query(query, variables, cancel_event, parse=parse_media_list_collection)
+    except AniListNotFoundError:
+        raise AniListNotFoundError(f'AniList username "{anilist_username}" not found.')
+
 
-    response = requests.post(url, json={'query': query, 'variables': variables})
-    response.raise_for_status()
+# Snapshots are keyed by the lowercased username, a manga list is kept under its own key next to it
+def snapshot_key(anilist_username, media_type='ANIME'):
+    username = anilist_username.lower()
+    return username if media_type == 'ANIME' else f'{username}:{media_type.lower()}'
 
-    data = response.json()
-    if 'errors' in data:
-        raise Exception(f'AniList username "{anilist_username}" not found.')
 
-    lists = data['data']['MediaListCollection']['lists']
-    return [
-        {
-            'anilist_id': entry['media']['id'],
-            'title': entry['media']['title']['english'] or entry['media']['title']['romaji'],
-            'episodes': entry['media']['episodes'],
-            'format': entry['media']['format'],
-            'score': entry['score'],
-            'progress': entry['progress'],
-            'startedAt': f"{entry['startedAt']['year'] or '0000'}-{entry['startedAt']['month'] or '00'}-{entry['startedAt']['day'] or '00'}",
-            'completedAt': f"{entry['completedAt']['year'] or '0000'}-{entry['completedAt']['month'] or '00'}-{entry['completedAt']['day'] or '00'}",
-            'status': entry['status']
-        }
-        for list_ in lists for entry in list_['entries']
-    ]
+# Bring the user's snapshot up to date and return the whole list from it. A full fetch is only made
+# for new users or when the snapshot is older than SNAPSHOT_FULL_SYNC_INTERVAL.
+def sync_user_anime_list(anilist_username, store, cancel_event=None, media_type='ANIME'):
+    username = snapshot_key(anilist_username, media_type)
+    state = store.get_state(username)
+    if state is None or time.time() - state[1] > SNAPSHOT_FULL_SYNC_INTERVAL:
+        anime_list = fetch_user_anime_list(anilist_username, cancel_event, media_type)
+        if anime_list is None:
+            return None
+        store.replace(username, anime_list)
+    else:
+        store.merge(username, fetch_updated_anime_entries(anilist_username, state[0], cancel_event, media_type))
+    return store.load(username)
+
+
+def load_user_anime_list(anilist_username, cancel_event=None, media_type='ANIME'):
+    with stage_timer('fetch'):
+        if snapshot_store is not None:
+            return sync_user_anime_list(anilist_username, snapshot_store, cancel_event, media_type)
+        return fetch_user_anime_list(anilist_username, cancel_event, media_type)
+
+
+# Load several of the user's lists, e.g. ('ANIME', 'MANGA'), returning {media_type: list}. The lists are
+# fetched concurrently through the shared client, so this takes about as long as the slowest fetch.
+def load_user_lists(anilist_username, media_types, cancel_event=None):
+    if len(media_types) == 1:
+        return {media_types[0]: load_user_anime_list(anilist_username, cancel_event, media_types[0])}
+    request_id = getattr(trace_context, 'request_id', '-')
+
+    def load(media_type):
+        trace_context.request_id = request_id
+        return load_user_anime_list(anilist_username, cancel_event, media_type)
+
+    with ThreadPoolExecutor(max_workers=len(media_types)) as executor:
+        futures = {media_type: executor.submit(load, media_type) for media_type in media_types}
+        return {media_type: future.result() for media_type, future in futures.items()}
 
 
 def fetch_mal_id(anilist_id):
-    for anime in anime_offline_db:
-        for source in anime['sources']:
-            if f'https://anilist.co/anime/{anilist_id}' in source:
-                for mal_source in anime['sources']:
-                    if 'https://myanimelist.net/anime/' in mal_source:
-                        return mal_source.split('/')[-1]
-    return None
+    return id_store.anilist_to_mal.get(int(anilist_id))
+
+
+def fetch_anilist_id(mal_id):
+    return id_store.mal_to_anilist.get(int(mal_id))
+
+
+# Resolve many AniList ids at once, ids without a MAL mapping are left out
+def resolve_mal_ids(anilist_ids):
+    anilist_to_mal = id_store.anilist_to_mal
+    resolved = {}
+    for anilist_id in anilist_ids:
+        mal_id = anilist_to_mal.get(int(anilist_id))
+        if mal_id is not None:
+            resolved[anilist_id] = mal_id
+    return resolved
+
+
+# Lookups of entries neither idMal nor the offline database index resolves, kept between conversions.
+# A row is (mal_id, confidence, title_matched): misses have a NULL mal_id and are trusted for miss_ttl
+# seconds, rows written after title matching ran keep the match, or NULL for a failure to match, with its
+# confidence for title_match_ttl seconds. A guess never turns into a permanent id.
+class MalIdCache:
+    def __init__(self, path, miss_ttl=MAL_ID_MISS_TTL, title_match_ttl=TITLE_MATCH_TTL):
+        self.path = path
+        self.miss_ttl = miss_ttl
+        self.title_match_ttl = title_match_ttl
+        self._connection = None
+        self._pid = None
+        self.lock = threading.Lock()
+
+    # Opened on first use, once per process like SnapshotStore
+    @property
+    def connection(self):
+        if self._pid != os.getpid():
+            # The directory may not exist yet, OFFLINE_DB_DIR is only created when the offline database is downloaded
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS mal_id_lookups (anilist_id INTEGER PRIMARY KEY, '
+                                     'mal_id INTEGER, confidence REAL, title_matched INTEGER, checked_at REAL)')
+            self._pid = os.getpid()
+        return self._connection
+
+    # Returns {anilist_id: (mal_id, confidence, title_matched)} for the cached ids that haven't expired
+    def get_many(self, anilist_ids):
+        anilist_ids = list(anilist_ids)
+        now = time.time()
+        cached = {}
+        with self.lock:
+            for start in range(0, len(anilist_ids), 500):
+                batch = anilist_ids[start:start + 500]
+                rows = self.connection.execute('SELECT anilist_id, mal_id, confidence, title_matched FROM mal_id_lookups '
+                                               'WHERE checked_at >= CASE WHEN title_matched THEN ? ELSE ? END '
+                                               f'AND anilist_id IN ({",".join("?" * len(batch))})',
+                                               [now - self.title_match_ttl, now - self.miss_ttl] + batch)
+                for anilist_id, mal_id, confidence, title_matched in rows:
+                    cached[anilist_id] = (mal_id, confidence, bool(title_matched))
+        return cached
+
+    # rows maps AniList ids to (mal_id, confidence, title_matched) like get_many returns them
+    def put_many(self, rows):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO mal_id_lookups VALUES (?, ?, ?, ?, ?)',
+                                        ((anilist_id, mal_id, confidence, title_matched, now)
+                                         for anilist_id, (mal_id, confidence, title_matched) in rows.items()))
+
+
+mal_id_cache = MalIdCache(MAL_ID_CACHE_PATH) if MAL_ID_CACHE_PATH else None
+
+
+# Find the MAL id of every entry, in list order, from the first tier that knows it: the idMal AniList
+# sent with the entry, the offline database index, then with TITLE_MATCHING a title match. Most entries
+# have an idMal, so the other tiers only see the few that don't. Entries those tiers didn't resolve are
+# remembered in the cache, which is asked first: a cached miss skips the index until it expires, and a
+# cached title match, or failure to match, is reused instead of matching again. Title matches only count
+# while TITLE_MATCHING is on and their confidence meets TITLE_MATCH_THRESHOLD. Entries no tier resolves
+# get None and are also returned as a list of dicts, so they can be reported instead of being exported
+# under a wrong id. The title matched entries are returned last, with the MAL id and confidence of the
+# match, so the guesses can be checked. The offline database only covers anime, manga lists are resolved
+# from idMal alone.
+def resolve_anime_mal_ids(anime_list, cache=None, media_type='ANIME'):
+    mal_ids = [anime.mal_id for anime in anime_list]
+    pending = [i for i, mal_id in enumerate(mal_ids) if mal_id is None]
+    title_matched = []
+    if pending and media_type == 'ANIME':
+        cached = cache.get_many({anime_list[i].anilist_id for i in pending}) if cache is not None else {}
+        anilist_to_mal = id_store.anilist_to_mal
+        for i in pending:
+            if anime_list[i].anilist_id not in cached:
+                mal_ids[i] = anilist_to_mal.get(anime_list[i].anilist_id)
+        pending = [i for i in pending if mal_ids[i] is None]
+        titles = id_store.titles if pending and TITLE_MATCHING else None
+        lookups = {}
+        for i in pending:
+            anilist_id = anime_list[i].anilist_id
+            row = cached.get(anilist_id)
+            if titles is None:
+                if row is None:
+                    lookups[anilist_id] = (None, None, False)
+                continue
+            if row is not None and row[2]:
+                match = row[:2] if row[0] is not None else None
+            else:
+                match = titles.match(anime_list[i])
+                lookups[anilist_id] = (*(match or (None, None)), True)
+            if match is not None and match[1] >= TITLE_MATCH_THRESHOLD:
+                mal_ids[i] = match[0]
+                title_matched.append({'anilist_id': anilist_id, 'title': anime_list[i].title, 'mal_id': match[0],
+                                      'confidence': round(match[1], 3)})
+        if lookups and cache is not None:
+            cache.put_many(lookups)
+        pending = [i for i in pending if mal_ids[i] is None]
+    unresolved = [{'anilist_id': anime_list[i].anilist_id, 'title': anime_list[i].title, 'format': anime_list[i].format,
+                   'status': anime_list[i].status} for i in pending]
+    return mal_ids, unresolved, title_matched
 
 
 def map_format_to_mal_type(format_):
@@ -117,7 +1222,15 @@ def map_format_to_mal_type(format_):
     }.get(format_, 'Unknown')
 
 
-def map_status_to_mal_status(status):
+def map_status_to_mal_status(status, media_type='ANIME'):
+    if media_type == 'MANGA':
+        return {
+            'CURRENT': 'Reading',
+            'COMPLETED': 'Completed',
+            'PAUSED': 'On-Hold',
+            'DROPPED': 'Dropped',
+            'PLANNING': 'Plan to Read'
+        }.get(status, 'Unknown')
     return {
         'CURRENT': 'Watching',
         'COMPLETED': 'Completed',
@@ -127,78 +1240,1012 @@ def map_status_to_mal_status(status):
     }.get(status, 'Unknown')
 
 
-def create_mal_xml(anime_list, xml_username):
-    root = ET.Element('myanimelist')
-    myinfo = ET.SubElement(root, 'myinfo')
-    ET.SubElement(myinfo, 'user_id').text = '0'
-    ET.SubElement(myinfo, 'user_name').text = xml_username
-    ET.SubElement(myinfo, 'user_export_type').text = '1'
-    ET.SubElement(myinfo, 'user_total_anime').text = str(len(anime_list))
-    ET.SubElement(myinfo, 'user_total_watching').text = str(len([a for a in anime_list if a['status'] == 'CURRENT']))
-    ET.SubElement(myinfo, 'user_total_completed').text = str(len([a for a in anime_list if a['status'] == 'COMPLETED']))
-    ET.SubElement(myinfo, 'user_total_onhold').text = str(len([a for a in anime_list if a['status'] == 'PAUSED']))
-    ET.SubElement(myinfo, 'user_total_dropped').text = str(len([a for a in anime_list if a['status'] == 'DROPPED']))
-    ET.SubElement(myinfo, 'user_total_plantowatch').text = str(len([a for a in anime_list if a['status'] == 'PLANNING']))
-
-    for anime in anime_list:
-        mal_id = fetch_mal_id(anime['anilist_id']) or anime['anilist_id']
-        if mal_id is None:
-            continue
-        anime_elem = ET.SubElement(root, 'anime')
-        ET.SubElement(anime_elem, 'series_animedb_id').text = str(mal_id)
-        ET.SubElement(anime_elem, 'series_title').text = anime['title']
-        ET.SubElement(anime_elem, 'series_type').text = map_format_to_mal_type(anime['format'])
-        ET.SubElement(anime_elem, 'series_episodes').text = str(anime['episodes'])
-        ET.SubElement(anime_elem, 'my_id').text = '0'
-        ET.SubElement(anime_elem, 'my_watched_episodes').text = str(anime['progress'])
-        ET.SubElement(anime_elem, 'my_start_date').text = anime['startedAt']
-        ET.SubElement(anime_elem, 'my_finish_date').text = anime['completedAt']
-        ET.SubElement(anime_elem, 'my_rated').text = ''
-        ET.SubElement(anime_elem, 'my_score').text = str(anime['score'])
-        ET.SubElement(anime_elem, 'my_storage').text = ''
-        ET.SubElement(anime_elem, 'my_storage_value').text = '0.00'
-        ET.SubElement(anime_elem, 'my_status').text = map_status_to_mal_status(anime['status'])
-        ET.SubElement(anime_elem, 'my_comments').text = ''
-        ET.SubElement(anime_elem, 'my_times_watched').text = '0'
-        ET.SubElement(anime_elem, 'my_rewatch_value').text = ''
-        ET.SubElement(anime_elem, 'my_priority').text = 'LOW'
-        ET.SubElement(anime_elem, 'my_tags').text = ''
-        ET.SubElement(anime_elem, 'my_rewatching').text = '0'
-        ET.SubElement(anime_elem, 'my_rewatching_ep').text = '0'
-        ET.SubElement(anime_elem, 'my_discuss').text = '1'
-        ET.SubElement(anime_elem, 'my_sns').text = 'default'
-        ET.SubElement(anime_elem, 'update_on_import').text = '1'
-
-    xml_str = ET.tostring(root, encoding='utf-8')
-    pretty_xml_str = minidom.parseString(xml_str).toprettyxml(indent="  ")
-    return pretty_xml_str
-
-
-@app.route('/convert', methods=['POST'])
+# Export type, entry element and per-status totals of the MAL anime and manga exports
+MAL_EXPORT_TYPES = {
+    'ANIME': ('1', 'anime', ['watching', 'completed', 'onhold', 'dropped', 'plantowatch']),
+    'MANGA': ('2', 'manga', ['reading', 'completed', 'onhold', 'dropped', 'plantoread'])
+}
+MAL_TOTAL_STATUSES = ['CURRENT', 'COMPLETED', 'PAUSED', 'DROPPED', 'PLANNING']
+PROGRESS_MAX_STEP = 100  # generate_mal_xml reports progress every 1% of the entries, and at least every this many
+
+
+def anime_xml_fields(anime, mal_id):
+    return [
+        ('series_animedb_id', str(mal_id)),
+        ('series_title', anime.title),
+        ('series_type', map_format_to_mal_type(anime.format)),
+        ('series_episodes', str(anime.episodes)),
+        ('my_id', '0'),
+        ('my_watched_episodes', str(anime.progress)),
+        ('my_start_date', anime.start_date),
+        ('my_finish_date', anime.finish_date),
+        ('my_rated', ''),
+        ('my_score', str(anime.score)),
+        ('my_storage', ''),
+        ('my_storage_value', '0.00'),
+        ('my_status', map_status_to_mal_status(anime.status)),
+        ('my_comments', ''),
+        ('my_times_watched', '0'),
+        ('my_rewatch_value', ''),
+        ('my_priority', 'LOW'),
+        ('my_tags', ''),
+        ('my_rewatching', '0'),
+        ('my_rewatching_ep', '0'),
+        ('my_discuss', '1'),
+        ('my_sns', 'default'),
+        ('update_on_import', '1')
+    ]
+
+
+# Unknown chapter and volume counts are 0, as in MAL's own manga exports
+def manga_xml_fields(manga, mal_id):
+    return [
+        ('manga_mangadb_id', str(mal_id)),
+        ('manga_title', manga.title),
+        ('manga_volumes', str(manga.volumes or 0)),
+        ('manga_chapters', str(manga.episodes or 0)),
+        ('my_id', '0'),
+        ('my_read_volumes', str(manga.progress_volumes or 0)),
+        ('my_read_chapters', str(manga.progress or 0)),
+        ('my_start_date', manga.start_date),
+        ('my_finish_date', manga.finish_date),
+        ('my_scanalation_group', ''),
+        ('my_score', str(manga.score)),
+        ('my_storage', ''),
+        ('my_retail_volumes', '0'),
+        ('my_status', map_status_to_mal_status(manga.status, 'MANGA')),
+        ('my_comments', ''),
+        ('my_times_read', '0'),
+        ('my_tags', ''),
+        ('my_priority', 'LOW'),
+        ('my_reread_value', ''),
+        ('my_rereading', '0'),
+        ('my_discuss', '1'),
+        ('my_sns', 'default'),
+        ('update_on_import', '1')
+    ]
+
+
+# Escape element text the way minidom's toprettyxml did, keeping the output byte-identical
+def escape_xml_text(text):
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace('>', '&gt;')
+
+
+def xml_element(name, text, indent):
+    if text:
+        return f'{indent}<{name}>{escape_xml_text(text)}</{name}>\n'
+    return f'{indent}<{name}/>\n'
+
+
+# Incrementally write the MAL export of an 'ANIME' or 'MANGA' list, yielding the header, then one chunk per entry.
+# progress, if given, is called as progress(stage, count, total) with the entries gone through as 'mapped',
+# out of all of them, and the entries written as 'written', out of those with a MAL id. Both are reported
+# together every 1% of the list. mal_ids can pass in the ids found by resolve_anime_mal_ids. Entries without
+# a MAL id are left out.
+def generate_mal_xml(anime_list, xml_username, progress=None, mal_ids=None, media_type='ANIME'):
+    if mal_ids is None:
+        mal_ids, _, _ = resolve_anime_mal_ids(anime_list, mal_id_cache, media_type)
+    export_type, element, total_names = MAL_EXPORT_TYPES[media_type]
+    entry_fields = anime_xml_fields if media_type == 'ANIME' else manga_xml_fields
+    status_counts = Counter(anime.status for anime, mal_id in zip(anime_list, mal_ids) if mal_id is not None)
+    total = sum(status_counts.values())
+    myinfo = [
+        ('user_id', '0'),
+        ('user_name', xml_username),
+        ('user_export_type', export_type),
+        (f'user_total_{element}', str(total))
+    ] + [(f'user_total_{name}', str(status_counts[status])) for name, status in zip(total_names, MAL_TOTAL_STATUSES)]
+    yield ''.join(['<?xml version="1.0" ?>\n<myanimelist>\n  <myinfo>\n']
+                  + [xml_element(name, text, '    ') for name, text in myinfo]
+                  + ['  </myinfo>\n'])
+
+    written = 0
+    step = max(1, min(PROGRESS_MAX_STEP, len(anime_list) // 100))
+    opening, closing = f'  <{element}>\n', f'  </{element}>\n'
+    for mapped, (anime, mal_id) in enumerate(zip(anime_list, mal_ids), 1):
+        if mal_id is not None:
+            yield ''.join([opening]
+                          + [xml_element(name, text, '    ') for name, text in entry_fields(anime, mal_id)]
+                          + [closing])
+            written += 1
+        if progress and (mapped % step == 0 or mapped == len(anime_list)):
+            progress('mapped', mapped, len(anime_list))
+            progress('written', written, total)
+
+    yield '</myanimelist>\n'
+
+
+# Pass items through, adding the time spent producing them to timings[stage]
+def timed_stage(items, timings, stage):
+    items = iter(items)
+    while True:
+        started_at = time.perf_counter()
+        item = next(items, None)
+        timings[stage] += time.perf_counter() - started_at
+        if item is None:
+            return
+        yield item
+
+
+# resolve_anime_mal_ids with the map stage timed and the entries counted
+def resolve_timed_mal_ids(anime_list, media_type='ANIME'):
+    with stage_timer('map'):
+        mal_ids, unresolved, title_matched = resolve_anime_mal_ids(anime_list, mal_id_cache, media_type)
+    converted_entries.inc(len(anime_list) - len(unresolved))
+    unmapped_entries.inc(len(unresolved))
+    return mal_ids, unresolved, title_matched
+
+
+# generate_mal_xml with the map and xml stages timed, the xml stage only counting time spent generating
+def generate_timed_mal_xml(anime_list, xml_username, progress=None, mal_ids=None, media_type='ANIME'):
+    if mal_ids is None:
+        mal_ids, _, _ = resolve_timed_mal_ids(anime_list, media_type)
+    timings = {'xml': 0}
+    yield from timed_stage(generate_mal_xml(anime_list, xml_username, progress, mal_ids, media_type), timings, 'xml')
+    record_stage('xml', timings['xml'])
+
+
+def create_mal_xml(anime_list, xml_username, media_type='ANIME'):
+    return ''.join(generate_timed_mal_xml(anime_list, xml_username, media_type=media_type))
+
+
+# Lists exported for each value of the media parameter
+MEDIA_TYPES = {'anime': ('ANIME',), 'manga': ('MANGA',), 'both': ('ANIME', 'MANGA')}
+# Response body keys of each export, the anime ones are the legacy xml_content and unresolved
+MEDIA_JSON_PREFIXES = {'ANIME': '', 'MANGA': 'manga_'}
+
+
+# Stream the legacy {"xml_content": ...} response body without building the documents in memory first.
+# lists maps media types to their entries, a manga export goes to "manga_xml_content". "unresolved" and
+# "manga_unresolved" list the entries left out for lack of a MAL id, "title_matches" and
+# "manga_title_matches" the entries exported under a title match. progress counts across all lists.
+def generate_xml_content_json(lists, xml_username, progress=None):
+    resolved = {media_type: resolve_timed_mal_ids(anime_list, media_type) for media_type, anime_list in lists.items()}
+    total = sum(len(lists[media_type]) - len(unresolved) for media_type, (_, unresolved, _) in resolved.items())
+    entry_count = sum(len(anime_list) for anime_list in lists.values())
+    done = 0
+    gone_through = 0
+    separator = '{'
+    for media_type, anime_list in lists.items():
+        mal_ids, unresolved, title_matched = resolved[media_type]
+        prefix = MEDIA_JSON_PREFIXES[media_type]
+        list_progress = None
+        if progress:
+            def list_progress(stage, count, _, written_offset=done, mapped_offset=gone_through):
+                if stage == 'written':
+                    progress(stage, written_offset + count, total)
+                else:
+                    progress(stage, mapped_offset + count, entry_count)
+        yield f'{separator}"{prefix}xml_content": "'
+        for chunk in generate_timed_mal_xml(anime_list, xml_username, list_progress, mal_ids, media_type):
+            yield json.dumps(chunk)[1:-1]
+        yield f'", "{prefix}unresolved": {json.dumps(unresolved)}, "{prefix}title_matches": {json.dumps(title_matched)}'
+        separator = ', '
+        done += len(anime_list) - len(unresolved)
+        gone_through += len(anime_list)
+    yield '}\n'
+
+
+# Minimal Prometheus metrics, exposed in the text format at /metrics
+def format_metric_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class MetricCounter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_metric_labels(key)} {value}')
+        return lines
+
+
+class MetricHistogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.values = {}  # labels -> [bucket counts, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for key, (bucket_counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(f'{self.name}_bucket{format_metric_labels(key + (("le", repr(float(bound))),))} {bucket_count}')
+                lines.append(f'{self.name}_bucket{format_metric_labels(key + (("le", "+Inf"),))} {count}')
+                lines.append(f'{self.name}_sum{format_metric_labels(key)} {total}')
+                lines.append(f'{self.name}_count{format_metric_labels(key)} {count}')
+        return lines
+
+
+# Gauge read at scrape time, function returns a list of (labels dict, value)
+class MetricGauge:
+    def __init__(self, name, help_text, function):
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} gauge']
+        for labels, value in self.function():
+            lines.append(f'{self.name}{format_metric_labels(tuple(sorted(labels.items())))} {value}')
+        return lines
+
+
+def offline_database_age():
+    for path in (OFFLINE_DB_PATH, MAPPING_STORE_PATH):
+        if os.path.exists(path):
+            return [({}, time.time() - os.path.getmtime(path))]
+    return []
+
+
+def mapping_index_size():
+    store = id_store
+    return [({'direction': 'anilist_to_mal'}, len(store.anilist_to_mal)),
+            ({'direction': 'mal_to_anilist'}, len(store.mal_to_anilist))]
+
+
+stage_seconds = MetricHistogram('anilist_xml_stage_seconds', 'Time spent in each conversion stage.',
+                                [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60])
+converted_entries = MetricCounter('anilist_xml_converted_entries_total', 'List entries written to MAL XML.')
+unmapped_entries = MetricCounter('anilist_xml_unmapped_entries_total', 'List entries without a MAL id in the offline database.')
+anilist_requests = MetricCounter('anilist_xml_anilist_requests_total', 'AniList API requests by outcome, including rate_limited (429).')
+http_requests = MetricCounter('anilist_xml_http_requests_total', 'HTTP requests served by endpoint and status.')
+metrics = [
+    stage_seconds,
+    converted_entries,
+    unmapped_entries,
+    anilist_requests,
+    http_requests,
+    MetricGauge('anilist_xml_offline_db_age_seconds', 'Seconds since the offline database was last downloaded.', offline_database_age),
+    MetricGauge('anilist_xml_mapping_index_entries', 'Ids in the mapping store.', mapping_index_size),
+    MetricGauge('anilist_xml_result_cache_bytes', 'Bytes held by the in-memory result cache.', lambda: [({}, result_cache.size)])
+]
+
+trace_context = threading.local()  # request_id of the request or job running on this thread
+
+
+def record_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+    if TRACE_REQUESTS:
+        print(f'trace {getattr(trace_context, "request_id", "-")} {stage} {seconds * 1000:.1f} ms', file=sys.stderr)
+
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started_at)
+
+
+# Hash of everything the generated XML depends on, used as the cache validator and ETag
+def hash_user_lists(lists, xml_username):
+    digest = hashlib.sha1(f'{xml_username}\0{id_store.version}\0'.encode('utf-8'))
+    for media_type, anime_list in lists.items():
+        digest.update(f'{media_type}\0'.encode('utf-8'))
+        for anime in anime_list:
+            digest.update(json.dumps(anime.to_row(), separators=(',', ':')).encode('utf-8'))
+    return digest.hexdigest()
+
+
+# A generated /convert response body and the validators sent with it
+class CachedResult:
+    def __init__(self, list_hash, body=b'', modified_at=None, checked_at=None, headers=None):
+        self.list_hash = list_hash
+        self.body = body
+        self.headers = headers or {}  # Sent along with body, the report of an xml export
+        self.modified_at = modified_at or time.time()  # When the XML last changed
+        self.checked_at = checked_at or self.modified_at  # When the list was last fetched from AniList
+        self.encodings = {}  # Compressed copies of body by content coding, only kept in memory
+        self.stored_size = 0  # Bytes counted against the in-memory cache
+
+    @property
+    def size(self):
+        return len(self.body) + sum(len(body) for body in self.encodings.values())
+
+
+# LRU cache of /convert results bounded by total body size, with an optional on-disk tier
+class ResultCache:
+    def __init__(self, max_bytes, ttl, directory=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def is_fresh(self, entry):
+        return time.time() - entry.checked_at < self.ttl
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+        if self.directory:
+            entry = self.read_disk(key)
+            if entry is not None:
+                self.store(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        self.store(key, entry)
+        if self.directory:
+            self.write_disk(key, entry, write_body=True)
+
+    # Mark an entry as checked against AniList again without its content changing
+    def touch(self, key, entry):
+        entry.checked_at = time.time()
+        if self.directory:
+            self.write_disk(key, entry, write_body=False)
+
+    def store(self, key, entry):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.stored_size
+            entry.stored_size = entry.size
+            if entry.stored_size > self.max_bytes:
+                return
+            self.entries[key] = entry
+            self.size += entry.stored_size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.stored_size
+
+    def disk_path(self, key):
+        return os.path.join(self.directory, hashlib.sha1('\0'.join(key).encode('utf-8')).hexdigest())
+
+    def read_disk(self, key):
+        path = self.disk_path(key)
+        try:
+            with open(path + '.meta', 'r') as f:
+                meta = json.load(f)
+            with open(path + '.body', 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        return CachedResult(meta['list_hash'], body, meta['modified_at'], meta['checked_at'], meta.get('headers'))
+
+    def write_disk(self, key, entry, write_body):
+        path = self.disk_path(key)
+        tmp_suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            if write_body:
+                with open(path + '.body' + tmp_suffix, 'wb') as f:
+                    f.write(entry.body)
+                os.replace(path + '.body' + tmp_suffix, path + '.body')
+            with open(path + '.meta' + tmp_suffix, 'w') as f:
+                json.dump({'list_hash': entry.list_hash, 'modified_at': entry.modified_at, 'checked_at': entry.checked_at,
+                           'headers': entry.headers}, f)
+            os.replace(path + '.meta' + tmp_suffix, path + '.meta')
+            if write_body:
+                self.prune_disk()
+        except OSError as e:
+            print(f'Error writing result cache: {e}')
+
+    # Drop the least recently written results until the on-disk tier fits in disk_max_bytes
+    def prune_disk(self):
+        bodies = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.body'):
+                stat = entry.stat()
+                bodies.append((stat.st_mtime, stat.st_size, entry.path[:-len('.body')]))
+        total = sum(size for _, size, _ in bodies)
+        for _, size, path in sorted(bodies):
+            if total <= self.disk_max_bytes:
+                break
+            for suffix in ('.body', '.meta'):
+                try:
+                    os.remove(path + suffix)
+                except OSError:
+                    pass
+            total -= size
+
+
+result_cache = ResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL, RESULT_CACHE_DIR, RESULT_CACHE_DISK_MAX_BYTES)
+
+
+# Pass the response body through while keeping a copy, caching it once it has been sent in full
+def cache_response_body(key, entry, chunks):
+    parts = []
+    for chunk in chunks:
+        data = chunk.encode('utf-8')
+        parts.append(data)
+        yield data
+    entry.body = b''.join(parts)
+    result_cache.put(key, entry)
+
+
+# Attach the cache validators, answering GET requests with 304 when the client copy is current.
+# Every content coding is its own representation with its own ETag. complete_length, given for bodies
+# sent whole, also enables range requests.
+def conditional_response(response, entry, coding=None, complete_length=None):
+    response.set_etag(entry.list_hash if coding is None else f'{entry.list_hash}-{coding}')
+    response.last_modified = int(entry.modified_at)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request, accept_ranges=complete_length is not None, complete_length=complete_length)
+
+
+# The content coding to send the response in from Accept-Encoding, None for the body as is
+def negotiate_content_coding():
+    return request.accept_encodings.best_match(list(CONTENT_CODINGS))
+
+
+def compress_chunks(chunks, coding):
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, CONTENT_CODINGS[coding])
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# Compressed copy of a finished body, kept with the entry (and counted by the cache when key is given)
+# so repeat downloads are not compressed again
+def encoded_body(entry, coding, key=None):
+    body = entry.encodings.get(coding)
+    if body is None:
+        body = b''.join(compress_chunks([entry.body], coding))
+        entry.encodings[coding] = body
+        if key is not None:
+            result_cache.store(key, entry)
+    return body
+
+
+# Body of a conversion and the headers to send with it. The legacy {"xml_content": ...} json lists the
+# unresolved and title matched entries itself. With format 'xml', the MAL export of its only list, their
+# counts go to the X-Unresolved-Count and X-Title-Match-Count headers, so ids are resolved up front.
+def generate_conversion_body(lists, xml_username, format_='json'):
+    if format_ == 'xml':
+        (media_type, anime_list), = lists.items()
+        mal_ids, unresolved, title_matched = resolve_timed_mal_ids(anime_list, media_type)
+        headers = {'X-Unresolved-Count': str(len(unresolved)), 'X-Title-Match-Count': str(len(title_matched))}
+        return generate_timed_mal_xml(anime_list, xml_username, mal_ids=mal_ids, media_type=media_type), headers
+    return generate_xml_content_json(lists, xml_username), {}
+
+
+# Wrap a finished body or a chunk generator, already compressed with coding if there is one. An xml body
+# is sent as a file download named file_name.
+def conversion_response(body, format_='json', coding=None, file_name=None, headers=None):
+    response = Response(body, mimetype='application/xml' if format_ == 'xml' else 'application/json', headers=headers)
+    if coding is not None:
+        response.content_encoding = coding
+    response.vary.add('Accept-Encoding')
+    if format_ == 'xml':
+        response.headers['Content-Disposition'] = f'attachment; filename="{file_name}"'
+    return response
+
+
+# Result cache key of a conversion, anime conversions to json keep the key they always had
+def conversion_key(anilist_username, xml_username, media='anime', format_='json'):
+    key = (anilist_username.lower(), xml_username)
+    if media != 'anime':
+        key += (media,)
+    return key if format_ == 'json' else key + (format_,)
+
+
+# Return a fresh cached result and no lists, or a new result and the fetched {media_type: list} when the XML must be generated
+def fetch_conversion(key, anilist_username, xml_username, cancel_event=None, media_types=('ANIME',)):
+    entry = result_cache.get(key)
+    if entry is not None and result_cache.is_fresh(entry):
+        return entry, None
+    lists = load_user_lists(anilist_username, media_types, cancel_event)
+    if not any(lists.values()):
+        kind = ' and '.join(media_type.lower() for media_type in media_types)
+        raise Exception(f'Error fetching {kind} list or no {kind} found')
+    lists = {media_type: anime_list or [] for media_type, anime_list in lists.items()}
+    list_hash = hash_user_lists(lists, xml_username)
+    if entry is not None and entry.list_hash == list_hash:
+        result_cache.touch(key, entry)
+        return entry, None
+    return CachedResult(list_hash), lists
+
+
+class JobCancelled(Exception):
+    pass
+
+
+JOB_ID_PATTERN = re.compile('[0-9a-f]{32}')
+
+
+def job_path(job_id, suffix):
+    return os.path.join(JOBS_DIR, f'{job_id}.{suffix}')
+
+
+def write_file_atomic(path, data):
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+# A conversion running in the job pool, polled through GET /jobs/<id>
+class ConversionJob:
+    def __init__(self, anilist_username, xml_username, media='anime'):
+        self.id = uuid.uuid4().hex
+        self.anilist_username = anilist_username
+        self.xml_username = xml_username
+        self.media = media  # A MEDIA_TYPES key, 'both' produces the anime and manga exports in one job
+        self.state = 'queued'  # queued, running, done, failed or cancelled
+        self.progress = {'fetched': 0, 'mapped': 0, 'written': 0, 'total': 0}
+        self.error = None
+        self.result = None
+        self.cancel_event = threading.Event()
+        self.future = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.saved_at = 0
+        self.cancel_checked_at = 0
+
+    # total is that of the last stage, except for 'mapped', which counts against all the entries 'fetched' gives
+    def update_progress(self, stage, count, total):
+        self.progress[stage] = count
+        if stage != 'mapped':
+            self.progress['total'] = total
+        self.save(force=False)
+
+    # Also honours a cancel request that reached another worker process
+    def is_cancelled(self):
+        if not self.cancel_event.is_set() and JOBS_DIR:
+            now = time.monotonic()
+            if now - self.cancel_checked_at >= JOB_SYNC_INTERVAL:
+                self.cancel_checked_at = now
+                if os.path.exists(job_path(self.id, 'cancel')):
+                    self.cancel_event.set()
+        return self.cancel_event.is_set()
+
+    def check_cancelled(self):
+        if self.is_cancelled():
+            raise JobCancelled()
+
+    def finish(self, state, error=None):
+        self.state = state
+        self.error = error
+        self.finished_at = time.time()
+        self.save()
+
+    # Mirror the job into JOBS_DIR so that whichever worker a poll lands on can answer it
+    def save(self, force=True):
+        if not JOBS_DIR:
+            return
+        now = time.monotonic()
+        if not force and now - self.saved_at < JOB_SYNC_INTERVAL:
+            return
+        self.saved_at = now
+        job = self.to_dict()
+        if self.state == 'done':
+            write_file_atomic(job_path(self.id, 'body'), self.result.body)
+            job['result_hash'] = self.result.list_hash
+            job['result_modified_at'] = self.result.modified_at
+        write_file_atomic(job_path(self.id, 'json'), json.dumps(job).encode('utf-8'))
+
+    def to_dict(self):
+        job = {
+            'job_id': self.id,
+            'media': self.media,
+            'state': self.state,
+            'progress': dict(self.progress),
+            'created_at': self.created_at,
+            'finished_at': self.finished_at
+        }
+        if self.error:
+            job['error'] = self.error
+        if self.state == 'done':
+            job['result'] = f'/jobs/{self.id}/result'
+        return job
+
+    def run(self):
+        trace_context.request_id = f'job-{self.id}'
+        key = conversion_key(self.anilist_username, self.xml_username, self.media)
+        self.check_cancelled()
+        entry, lists = fetch_conversion(key, self.anilist_username, self.xml_username, self.cancel_event, MEDIA_TYPES[self.media])
+        if lists is None:
+            return entry
+        self.check_cancelled()
+        fetched = sum(len(anime_list) for anime_list in lists.values())
+        self.update_progress('fetched', fetched, fetched)
+        body = cache_response_body(key, entry, generate_xml_content_json(lists, self.xml_username, self.update_progress))
+        for _ in body:
+            self.check_cancelled()
+        return entry
+
+
+# A job owned by another worker process, as last saved to JOBS_DIR
+class StoredJob:
+    def __init__(self, job):
+        self.id = job['job_id']
+        self.state = job['state']
+        self.job = job
+
+    def to_dict(self):
+        return {key: value for key, value in self.job.items() if not key.startswith('result_')}
+
+    @property
+    def result(self):
+        with open(job_path(self.id, 'body'), 'rb') as f:
+            return CachedResult(self.job['result_hash'], f.read(), self.job['result_modified_at'])
+
+    @classmethod
+    def load(cls, job_id):
+        try:
+            with open(job_path(job_id, 'json'), 'r') as f:
+                return cls(json.load(f))
+        except (OSError, ValueError):
+            return None
+
+
+# Bounded worker pool and registry of conversion jobs
+class JobManager:
+    def __init__(self, workers, queue_depth, retention):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='convert')
+        self.queue_depth = queue_depth
+        self.retention = retention
+        self.jobs = {}
+        self.queued = 0
+        self.lock = threading.Lock()
+
+    # Returns None when the queue is full
+    def submit(self, anilist_username, xml_username, media='anime'):
+        with self.lock:
+            self.prune()
+            if self.queued >= self.queue_depth:
+                return None
+            job = ConversionJob(anilist_username, xml_username, media)
+            self.jobs[job.id] = job
+            self.queued += 1
+        job.save()
+        job.future = self.executor.submit(self.run, job)
+        return job
+
+    def run(self, job):
+        with self.lock:
+            self.queued -= 1
+        if job.is_cancelled():
+            job.finish('cancelled')
+            return
+        job.state = 'running'
+        job.save()
+        try:
+            job.result = job.run()
+            job.finish('done')
+        except (JobCancelled, AniListCancelledError):
+            job.finish('cancelled')
+        except Exception as e:
+            job.finish('failed', str(e))
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None and JOBS_DIR and JOB_ID_PATTERN.fullmatch(job_id):
+            job = StoredJob.load(job_id)
+        return job
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        if isinstance(job, StoredJob):
+            # The worker running it notices the marker within JOB_SYNC_INTERVAL
+            if job.state in ('queued', 'running'):
+                write_file_atomic(job_path(job.id, 'cancel'), b'')
+            return job
+        job.cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            with self.lock:
+                self.queued -= 1
+            job.finish('cancelled')
+        return job
+
+    def prune(self):
+        cutoff = time.time() - self.retention
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished_at and job.finished_at < cutoff]:
+            del self.jobs[job_id]
+        if JOBS_DIR:
+            for file_name in os.listdir(JOBS_DIR):
+                path = os.path.join(JOBS_DIR, file_name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+
+if JOBS_DIR:
+    os.makedirs(JOBS_DIR, exist_ok=True)
+job_manager = JobManager(JOB_WORKERS, JOB_QUEUE_DEPTH, JOB_RETENTION)
+
+
+# Turn a conversion error into a JSON error response, keeping AniList failures apart
+def error_response(e):
+    if isinstance(e, HTTPException):
+        return e  # Already an HTTP answer, e.g. 416 for a range outside the body
+    if isinstance(e, AniListNotFoundError):
+        return jsonify({'error': str(e)}), 404
+    if isinstance(e, AniListRateLimitError):
+        return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
+    if isinstance(e, AniListTransportError):
+        return jsonify({'error': str(e)}), 502
+    return jsonify({'error': str(e)}), 500
+
+
+# Export only the entries updated at or after since (a unix timestamp) for an update_on_import delta.
+# X-Sync-Timestamp carries the since value to use next time.
+def convert_changes(anilist_username, xml_username, since, media_types=('ANIME',), format_='json', file_name=None):
+    try:
+        since = int(since)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'since must be a unix timestamp'}), 400
+
+    try:
+        lists = load_user_lists(anilist_username, media_types)
+        if not any(lists.values()):
+            kind = ' and '.join(media_type.lower() for media_type in media_types)
+            raise Exception(f'Error fetching {kind} list or no {kind} found')
+    except Exception as e:
+        return error_response(e)
+    changed = {media_type: [anime for anime in anime_list or [] if anime.updated_at >= since]
+               for media_type, anime_list in lists.items()}
+    coding = negotiate_content_coding()
+    body, headers = generate_conversion_body(changed, xml_username, format_)
+    chunks = (chunk.encode('utf-8') for chunk in body)
+    response = conversion_response(compress_chunks(chunks, coding) if coding else chunks, format_, coding, file_name, headers)
+    response.headers['X-Sync-Timestamp'] = str(max(anime.updated_at for anime_list in lists.values() for anime in anime_list or []) + 1)
+    return response
+
+
+@app.before_request
+def start_trace():
+    trace_context.request_id = uuid.uuid4().hex[:12]
+    trace_context.started_at = time.perf_counter()
+    if refresher_pid != os.getpid():
+        reload_mapping_store_if_replaced()
+
+
+@app.after_request
+def count_request(response):
+    http_requests.inc(endpoint=request.endpoint or 'unknown', status=response.status_code)
+    if TRACE_REQUESTS:
+        print(f'trace {trace_context.request_id} {request.method} {request.path} {response.status_code} '
+              f'{(time.perf_counter() - trace_context.started_at) * 1000:.1f} ms until headers', file=sys.stderr)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.expose())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+# The JSON object a POST carries, empty for a missing, null, malformed or non-object body so the
+# endpoint answers 400 for the missing fields rather than failing
+def request_data():
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
+
+@app.route('/convert', methods=['GET', 'POST'])
 def convert():
-    data = request.json
+    data = request.args if request.method == 'GET' else request_data()
     anilist_username = data.get('anilist_username')
     xml_username = data.get('xml_username')
+    media = data.get('media', 'anime')
+    format_ = data.get('format', 'json')
 
     if not anilist_username or not xml_username:
         return jsonify({'error': 'Missing usernames'}), 400
+    if media not in MEDIA_TYPES:
+        return jsonify({'error': 'media must be anime, manga or both'}), 400
+    if format_ not in ('json', 'xml'):
+        return jsonify({'error': 'format must be json or xml'}), 400
+    if format_ == 'xml' and media == 'both':
+        return jsonify({'error': 'format xml exports a single list, use media anime or manga'}), 400
+
+    file_name = safe_file_name(anilist_username) + ('-manga.xml' if media == 'manga' else '.xml')
+    if data.get('since') is not None:
+        return convert_changes(anilist_username, xml_username, data.get('since'), MEDIA_TYPES[media], format_, file_name)
 
     try:
-        anime_list = fetch_user_anime_list(anilist_username)
-        if anime_list:
-            xml_content = create_mal_xml(anime_list, xml_username)
-            return jsonify({'xml_content': xml_content}), 200
-        else:
-            return jsonify({'error': 'Error fetching anime list or no anime found'}), 500
+        key = conversion_key(anilist_username, xml_username, media, format_)
+        entry, lists = fetch_conversion(key, anilist_username, xml_username, media_types=MEDIA_TYPES[media])
+        coding = negotiate_content_coding()
+        if lists is None:
+            body = entry.body if coding is None else encoded_body(entry, coding, key)
+            return conditional_response(conversion_response(body, format_, coding, file_name, entry.headers), entry, coding, len(body))
+        body, entry.headers = generate_conversion_body(lists, xml_username, format_)
+        chunks = cache_response_body(key, entry, body)
+        return conditional_response(conversion_response(compress_chunks(chunks, coding) if coding else chunks, format_, coding, file_name,
+                                                        entry.headers), entry, coding)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
+
+
+# Write-only file object that collects what zipfile writes so it can be streamed out
+class ZipStream:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+# Batch users are AniList usernames or {"anilist_username", "xml_username"} objects
+def parse_batch_users(users):
+    if not isinstance(users, list) or not users:
+        raise ValueError('Missing users')
+    if len(users) > BATCH_MAX_USERS:
+        raise ValueError(f'At most {BATCH_MAX_USERS} users can be converted in one batch')
+    parsed = []
+    for user in users:
+        if isinstance(user, str):
+            user = {'anilist_username': user}
+        if not isinstance(user, dict) or not user.get('anilist_username'):
+            raise ValueError('Every user needs an anilist_username')
+        pair = (user['anilist_username'], user.get('xml_username') or user['anilist_username'])
+        if pair not in parsed:
+            parsed.append(pair)
+    return parsed
+
+
+def safe_file_name(name):
+    return re.sub(r'[^\w.-]', '_', name)
+
+
+def convert_user(anilist_username, xml_username):
+    anime_list = load_user_anime_list(anilist_username)
+    if not anime_list:
+        raise Exception('Error fetching anime list or no anime found')
+    mal_ids, unresolved, title_matched = resolve_timed_mal_ids(anime_list)
+    return ''.join(generate_timed_mal_xml(anime_list, xml_username, mal_ids=mal_ids)), unresolved, title_matched
+
+
+# Fetch and convert the users concurrently, streaming a zip of per-user XML files as they finish,
+# followed by status.json with the outcome for every user
+def generate_batch_zip(users):
+    stream = ZipStream()
+    statuses = []
+    file_names = set()
+    with ThreadPoolExecutor(max_workers=min(BATCH_WORKERS, len(users)), thread_name_prefix='batch') as executor, \
+            zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        futures = {executor.submit(convert_user, anilist_username, xml_username): (anilist_username, xml_username)
+                   for anilist_username, xml_username in users}
+        for future in as_completed(futures):
+            anilist_username, xml_username = futures[future]
+            status = {'anilist_username': anilist_username, 'xml_username': xml_username}
+            try:
+                xml_content, unresolved, title_matched = future.result()
+            except Exception as e:
+                status['status'] = 'error'
+                status['error'] = str(e)
+            else:
+                file_name = safe_file_name(anilist_username)
+                if file_name in file_names:
+                    file_name = f'{file_name}-{safe_file_name(xml_username)}'
+                file_names.add(file_name)
+                archive.writestr(f'{file_name}.xml', xml_content)
+                status['status'] = 'ok'
+                status['file'] = f'{file_name}.xml'
+                status['unresolved'] = unresolved
+                status['title_matches'] = title_matched
+            statuses.append(status)
+            yield stream.drain()
+        archive.writestr('status.json', json.dumps(statuses, indent=2))
+    yield stream.drain()
+
+
+@app.route('/convert/batch', methods=['POST'])
+def convert_batch():
+    data = request_data()
+    try:
+        users = parse_batch_users(data.get('users'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return Response(generate_batch_zip(users), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename=myanimelist-batch.zip'})
+
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    data = request_data()
+    anilist_username = data.get('anilist_username')
+    xml_username = data.get('xml_username')
+    media = data.get('media', 'anime')
+
+    if not anilist_username or not xml_username:
+        return jsonify({'error': 'Missing usernames'}), 400
+    if media not in MEDIA_TYPES:
+        return jsonify({'error': 'media must be anime, manga or both'}), 400
+
+    job = job_manager.submit(anilist_username, xml_username, media)
+    if job is None:
+        return jsonify({'error': 'Too many conversions queued, try again later'}), 503
+    return jsonify(job.to_dict()), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job.to_dict()), 200
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if job.state != 'done':
+        return jsonify(job.to_dict()), 409
+    result = job.result
+    coding = negotiate_content_coding()
+    body = result.body if coding is None else encoded_body(result, coding)
+    return conditional_response(conversion_response(body, coding=coding), result, coding, len(body))
 
 
 @app.route('/cancel', methods=['POST'])
 def cancel():
-    # This endpoint can be used to handle cancellation logic if needed.
-    return jsonify({'message': 'Cancellation not implemented'}), 200
+    data = request_data()
+    job_id = data.get('job_id')
+    if not job_id:
+        return jsonify({'error': 'Missing job_id'}), 400
+
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job.to_dict()), 200
 
 
+# Development server. In production gunicorn.conf.py serves the app with several worker processes.
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=int(os.getenv('PORT', 5000)))
\ No newline at end of file
+    start_offline_database_refresher()
+    app.run(host='0.0.0.0', port=int(os.getenv('PORT', 5000)))
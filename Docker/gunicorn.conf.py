@@ -0,0 +1,34 @@
+import os
+import tempfile
+
+# Production server: gunicorn pre-forks WORKERS processes, each serving THREADS requests at a time.
+# The app is imported once in the parent (preload_app), which downloads the offline database and
+# maps the id index before forking, so the workers share it read-only instead of each loading a copy.
+#
+#   gunicorn --config gunicorn.conf.py app:app
+
+# The default is kept small: the CPU count seen in a container is often the host's, and every worker
+# holds its own connections and caches.
+workers = int(os.getenv('WORKERS', min(len(os.sched_getaffinity(0)), 4)))
+threads = int(os.getenv('THREADS', 4))
+worker_class = 'gthread'
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+preload_app = True
+timeout = 120  # Large lists take a while to fetch from AniList
+accesslog = '-'
+
+# app.py reads these at import, so set them before gunicorn loads it.
+# Jobs have to be visible to every worker, since a poll can land on any of them, and the workers
+# draw from one AniList rate limit instead of each getting a fixed share.
+os.environ['WORKERS'] = str(workers)
+if workers > 1:
+    os.environ.setdefault('JOBS_DIR', os.path.join(tempfile.gettempdir(), 'anilist-to-xml-jobs'))
+    os.environ.setdefault('ANILIST_LIMITER_PATH', os.path.join(tempfile.gettempdir(), 'anilist-to-xml-rate-limit'))
+
+
+# The parent refreshes the offline database and only rebuilds the id index files. It serves no
+# requests, so it doesn't swap the new index in for itself, each worker maps the new files once it
+# notices they were replaced. Refreshing in every worker instead would download the database once per worker.
+def when_ready(server):
+    import app
+    app.start_offline_database_refresher(swap=False)
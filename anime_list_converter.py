@@ -1,58 +1,897 @@
 import os
-import requests
-import xml.etree.ElementTree as ET
 import time
-from xml.dom import minidom
-import tkinter as tk
-from tkinter import ttk, messagebox
+import requests
+import requests.adapters
+import tempfile
+import contextlib
 import threading
+import queue
 import json
+import codecs
+import sqlite3
+import re
+import sys
+import argparse
+import random
+import mmap
+import struct
+import bisect
+import zlib
+import math
+import unicodedata
+import gzip
+import csv
+import xml.etree.ElementTree as ET
+from collections import Counter
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+STARTED_AT = time.perf_counter()  # Start of the script after its imports, reported by --timings
 ANILIST_USERNAME = os.getenv('ANILIST_USERNAME')  # AniList username
 XML_USERNAME = os.getenv('XML_USERNAME')  # XML username (can be anything)
 RATE_LIMIT_DELAY = 1000  # Delay in milliseconds between requests to avoid rate limiting
+SNAPSHOT_FULL_SYNC_INTERVAL = 24 * 60 * 60  # Seconds between full re-fetches of a snapshot, which also drop deleted entries
+BATCH_WORKERS = 4  # Users fetched concurrently in --batch mode, all sharing the rate limit above
+EVENT_POLL_INTERVAL = 100  # Milliseconds between the window's checks for progress from its worker threads
 
 cancel_event = threading.Event()
 
-# Function to download the anime-offline-database.json file
-def download_anime_offline_database():
-    url = 'https://raw.githubusercontent.com/manami-project/anime-offline-database/master/anime-offline-database.json'
-    response = requests.get(url)
-    response.raise_for_status()
-    with open('anime-offline-database.json', 'wb') as f:
-        f.write(response.content)
-
-# Load the anime offline database
-def load_anime_offline_database():
-    global anime_offline_db
-    with open('anime-offline-database.json', 'r') as f:
-        anime_offline_db = json.load(f)['data']
-
-# Ensure the anime offline database is downloaded and loaded
-download_anime_offline_database()
-load_anime_offline_database()
-
-def fetch_user_anime_list():
+ANILIST_API_URL = os.getenv('ANILIST_API_URL', 'https://graphql.anilist.co')
+ANILIST_RATE_LIMIT = 60000 / RATE_LIMIT_DELAY  # Requests per minute
+ANILIST_TIMEOUT = (5, 30)  # Connect and read timeouts for AniList requests, in seconds
+ANILIST_MAX_RETRIES = 4  # Retries after rate limiting or transport failures
+ANILIST_BACKOFF_BASE = 0.5  # Seconds, doubled on every retry and jittered
+ANILIST_BACKOFF_CAP = 30
+ANILIST_PAGE_SIZE = 50  # Largest page AniList serves
+ANILIST_STREAM_CHUNK_SIZE = 64 * 1024  # Bytes of a list response decoded at a time
+
+ANILIST_SOURCE_PREFIX = 'https://anilist.co/anime/'
+MAL_SOURCE_PREFIX = 'https://myanimelist.net/anime/'
+
+OFFLINE_DB_URL = os.getenv('OFFLINE_DB_URL', 'https://raw.githubusercontent.com/manami-project/anime-offline-database/master/anime-offline-database.json')
+OFFLINE_DB_DIR = os.getenv('OFFLINE_DB_DIR', '.')  # Cache directory for the offline database and its mapping store
+OFFLINE_DB_PATH = os.path.join(OFFLINE_DB_DIR, 'anime-offline-database.json')
+OFFLINE_DB_META_PATH = OFFLINE_DB_PATH + '.meta'  # ETag/Last-Modified of the cached copy
+OFFLINE_DB_MAX_AGE = int(os.getenv('OFFLINE_DB_MAX_AGE', 0))  # Seconds a cached copy is trusted without revalidating
+OFFLINE_DB_TIMEOUT = 60  # Seconds before giving up on the offline database download
+MAPPING_STORE_PATH = os.path.join(OFFLINE_DB_DIR, 'anime-offline-database.idx')  # Compact id index built from OFFLINE_DB_PATH
+MAL_ID_CACHE_PATH = os.path.join(OFFLINE_DB_DIR, 'mal-id-cache.sqlite')  # Misses and title matches kept between conversions
+MAL_ID_MISS_TTL = 7 * 24 * 60 * 60  # Seconds an entry no id source knows is not looked up again
+TITLE_MATCH_TTL = 7 * 24 * 60 * 60  # Seconds a cached title match, or failure to match, is reused
+MAPPING_STORE_MAGIC = b'AL2MAL01'
+MAPPING_STORE_HEADER = struct.Struct('<8sQqII')  # magic, source size, source mtime_ns, forward count, reverse count
+TITLE_MATCHING = os.getenv('TITLE_MATCHING', '') not in ('', '0')  # Match titles for entries no id source resolves, or --match-titles
+TITLE_MATCH_THRESHOLD = float(os.getenv('TITLE_MATCH_THRESHOLD', 0.8))  # Confidence, from 0 to 1, a title match needs
+TITLE_MATCH_TITLE_WEIGHT = 0.7  # Share of the confidence from title similarity, type, episodes and year make up the rest
+TITLE_MATCH_MARGIN = 0.05  # Lead the best match needs over a different runner-up, ambiguous titles are not matched
+TITLE_MATCH_MAX_POSTINGS = 128  # Titles a trigram may match and still be used to find candidates
+TITLE_INDEX_MAGIC = b'AL2MALT1'
+TITLE_INDEX_HEADER = struct.Struct('<8sQqIIII')  # magic, source size, source mtime_ns, candidate, title, trigram and posting counts
+INDEX_SOURCE_HEADER = struct.Struct('<8sQq')  # The leading fields both index files share
+OFFLINE_DB_TYPES = ['UNKNOWN', 'TV', 'MOVIE', 'OVA', 'ONA', 'SPECIAL']
+ANILIST_FORMAT_TYPES = {'TV': 'TV', 'TV_SHORT': 'TV', 'MOVIE': 'MOVIE', 'OVA': 'OVA', 'ONA': 'ONA', 'SPECIAL': 'SPECIAL'}
+TITLE_SEPARATORS = re.compile(r'[\W_]+')
+MAL_TO_ANILIST_STATUS = {'Watching': 'CURRENT', 'Completed': 'COMPLETED', 'On-Hold': 'PAUSED', 'Dropped': 'DROPPED', 'Plan to Watch': 'PLANNING'}
+IMPORT_STATUSES = frozenset(MAL_TO_ANILIST_STATUS.values()) | {'REPEATING'}  # Statuses AniList accepts on import
+IMPORT_FIELDS = ['anilist_id', 'mal_id', 'title', 'status', 'progress', 'score', 'started_at', 'completed_at', 'repeat', 'notes']
+IMPORT_DATE_FIELDS = ('started_at', 'completed_at')  # {'year', 'month', 'day'} dates, split into a column per part in csv
+IMPORT_CSV_FIELDS = [column for field in IMPORT_FIELDS
+                     for column in ([f'{field}_{part}' for part in ('year', 'month', 'day')] if field in IMPORT_DATE_FIELDS else [field])]
+
+# Read the cached validators of the offline database, empty when there is no usable cached copy
+def read_offline_database_meta():
+    if not os.path.exists(OFFLINE_DB_PATH) or not os.path.exists(OFFLINE_DB_META_PATH):
+        return {}
+    try:
+        with open(OFFLINE_DB_META_PATH, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+# Function to download the anime-offline-database.json file, revalidating the cached copy if there is one.
+# Returns True when a new copy was written.
+def download_anime_offline_database(max_age=0):
+    meta = read_offline_database_meta()
+    if max_age and time.time() - meta.get('checked_at', 0) < max_age:
+        return False
+
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    os.makedirs(OFFLINE_DB_DIR, exist_ok=True)
+    with requests.get(OFFLINE_DB_URL, headers=headers, stream=True, timeout=OFFLINE_DB_TIMEOUT) as response:
+        changed = response.status_code != 304
+        if changed:
+            response.raise_for_status()
+            tmp_path = f'{OFFLINE_DB_PATH}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    f.write(chunk)
+            os.replace(tmp_path, OFFLINE_DB_PATH)
+            meta = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')
+            }
+
+    meta['checked_at'] = time.time()
+    tmp_path = f'{OFFLINE_DB_META_PATH}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, OFFLINE_DB_META_PATH)
+    return changed
+
+# Build exact-match lookup tables between AniList and MAL ids from the offline database
+def build_id_index(entries):
+    anilist_index = {}
+    mal_index = {}
+    for anime in entries:
+        anilist_ids = []
+        mal_id = None
+        for source in anime['sources']:
+            if source.startswith(ANILIST_SOURCE_PREFIX):
+                anilist_id = source[len(ANILIST_SOURCE_PREFIX):]
+                if anilist_id.isdigit():
+                    anilist_ids.append(int(anilist_id))
+            elif mal_id is None and source.startswith(MAL_SOURCE_PREFIX):
+                source_id = source[len(MAL_SOURCE_PREFIX):]
+                if source_id.isdigit():
+                    mal_id = int(source_id)
+        if mal_id is None:
+            continue
+        for anilist_id in anilist_ids:
+            anilist_index.setdefault(anilist_id, mal_id)
+        if anilist_ids:
+            mal_index.setdefault(mal_id, anilist_ids[0])
+    return anilist_index, mal_index
+
+# Read-only id map backed by two parallel arrays, keys sorted ascending
+class SortedIdMap:
+    def __init__(self, keys, values):
+        self.keys = keys
+        self.values = values
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.values[i]
+        return default
+
+
+# Id index stored on disk as sorted integer arrays, memory-mapped on first lookup
+class MappingStore:
+    def __init__(self, path=MAPPING_STORE_PATH):
+        self.path = path
+        self._maps = None
+        self._titles = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        if self._maps is None:
+            with self._lock:
+                if self._maps is None:
+                    with open(self.path, 'rb') as f:
+                        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    magic, source_size, source_mtime_ns, forward_count, reverse_count = MAPPING_STORE_HEADER.unpack_from(data)
+                    if magic != MAPPING_STORE_MAGIC:
+                        raise Exception(f'"{self.path}" is not an id mapping store.')
+                    view = memoryview(data)
+                    offset = MAPPING_STORE_HEADER.size
+                    maps = []
+                    for count in (forward_count, reverse_count):
+                        size = count * array('I').itemsize
+                        keys = view[offset:offset + size].cast('I')
+                        values = view[offset + size:offset + 2 * size].cast('I')
+                        maps.append(SortedIdMap(keys, values))
+                        offset += 2 * size
+                    self._version = f'{source_size}-{source_mtime_ns}'
+                    self._maps = maps
+        return self._maps
+
+    # Identifies the offline database copy the store was built from
+    @property
+    def version(self):
+        self.open()
+        return self._version
+
+    @property
+    def anilist_to_mal(self):
+        return self.open()[0]
+
+    @property
+    def mal_to_anilist(self):
+        return self.open()[1]
+
+    # Map the title index built next to the store, only there with TITLE_MATCHING
+    def load_titles(self):
+        if self._titles is None:
+            with self._lock:
+                if self._titles is None:
+                    self._titles = TitleIndex(title_index_path(self.path))
+        return self._titles
+
+    @property
+    def titles(self):
+        return self.load_titles()
+
+
+def title_index_path(store_path):
+    return store_path + '.titles'
+
+
+# Lowercase a title and reduce it to words of letters and digits, without accents
+def normalize_title(title):
+    title = ''.join(c for c in unicodedata.normalize('NFKD', title.lower()) if not unicodedata.combining(c))
+    return TITLE_SEPARATORS.sub(' ', title).strip()
+
+
+# Hashed trigrams of a normalized title, padded so that word starts and ends count too
+def title_trigrams(title):
+    padded = f' {title} '
+    return {zlib.crc32(padded[i:i + 3].encode('utf-8')) for i in range(len(padded) - 2)}
+
+
+# Build step for title matching: a trigram index over the titles and synonyms of the offline database
+# entries that have a MAL id but no AniList link, the only ones a title match can add. Titles are
+# numbered by trigram count, so the titles of a size range have a range of ids.
+def build_title_index(entries, path, stat):
+    mal_ids, types, episodes, years = array('I'), array('B'), array('H'), array('H')
+    titles = []
+    for anime in entries:
+        if any(source.startswith(ANILIST_SOURCE_PREFIX) for source in anime['sources']):
+            continue
+        mal_id = next((int(source[len(MAL_SOURCE_PREFIX):]) for source in anime['sources']
+                       if source.startswith(MAL_SOURCE_PREFIX) and source[len(MAL_SOURCE_PREFIX):].isdigit()), None)
+        normalized = {normalize_title(title) for title in [anime['title']] + anime.get('synonyms', [])} - {''}
+        if mal_id is None or not normalized:
+            continue
+        candidate = len(mal_ids)
+        mal_ids.append(mal_id)
+        types.append(OFFLINE_DB_TYPES.index(anime['type']) if anime.get('type') in OFFLINE_DB_TYPES else 0)
+        episodes.append(min(anime.get('episodes') or 0, 0xFFFF))
+        years.append((anime.get('animeSeason') or {}).get('year') or 0)
+        titles.extend((title_trigrams(title), candidate) for title in normalized)
+
+    titles.sort(key=lambda title: len(title[0]))
+    title_candidates, title_sizes = array('I'), array('H')
+    postings = {}
+    for title_id, (trigrams, candidate) in enumerate(titles):
+        for trigram in trigrams:
+            postings.setdefault(trigram, []).append(title_id)
+        title_candidates.append(candidate)
+        title_sizes.append(min(len(trigrams), 0xFFFF))
+
+    keys = array('I', sorted(postings))
+    offsets = array('I', [0])
+    flat = array('I')
+    for key in keys:
+        flat.extend(postings[key])
+        offsets.append(len(flat))
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(TITLE_INDEX_HEADER.pack(TITLE_INDEX_MAGIC, stat.st_size, stat.st_mtime_ns,
+                                        len(mal_ids), len(title_candidates), len(keys), len(flat)))
+        for part in (keys, offsets, flat, mal_ids, title_candidates, episodes, years, title_sizes, types):
+            part.tofile(f)
+    os.replace(tmp_path, path)
+
+
+# Fuzzy title lookup over the index of build_title_index, memory-mapped like MappingStore
+class TitleIndex:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, _, _, candidate_count, title_count, key_count, posting_count = TITLE_INDEX_HEADER.unpack_from(data)
+        if magic != TITLE_INDEX_MAGIC:
+            raise Exception(f'"{path}" is not a title index.')
+        view = memoryview(data)
+        offset = TITLE_INDEX_HEADER.size
+        parts = []
+        for typecode, count in (('I', key_count), ('I', key_count + 1), ('I', posting_count), ('I', candidate_count),
+                                ('I', title_count), ('H', candidate_count), ('H', candidate_count), ('H', title_count),
+                                ('B', candidate_count)):
+            size = count * array(typecode).itemsize
+            parts.append(view[offset:offset + size].cast(typecode))
+            offset += size
+        (self.keys, self.offsets, self.postings, self.mal_ids, self.title_candidates,
+         self.episodes, self.years, self.title_sizes, self.types) = parts
+
+    # Title similarity, as the Dice coefficient of the trigram sets, of every candidate that can reach
+    # min_similarity with one of the entry's titles. Only titles of a size that can reach it are looked
+    # at, and only the rarest trigrams, enough that any such title has at least one of them, are used to
+    # find candidates. Trigrams matching more than TITLE_MATCH_MAX_POSTINGS titles are too common to
+    # find candidates with and are skipped, so a lookup scans at most that many titles per trigram.
+    # The other trigrams of the candidates are then checked by bisecting the postings.
+    def similarities(self, anime, min_similarity):
+        similarities = {}
+        for title in (anime.title, anime.romaji_title):
+            if not title:
+                continue
+            trigrams = title_trigrams(normalize_title(title))
+            size = len(trigrams)
+            # 2c / (q + t) >= s with c <= min(q, t) needs s q / (2 - s) <= t <= (2 - s) q / s,
+            # and c >= s q / (2 - s) common trigrams
+            min_common = max(1, math.ceil(min_similarity * size / (2 - min_similarity)))
+            first = bisect.bisect_left(self.title_sizes, min_common)
+            last = bisect.bisect_right(self.title_sizes, int(size * (2 - min_similarity) / min_similarity))
+            ranges = []
+            for trigram in trigrams:
+                i = bisect.bisect_left(self.keys, trigram)
+                if i < len(self.keys) and self.keys[i] == trigram:
+                    start = bisect.bisect_left(self.postings, first, self.offsets[i], self.offsets[i + 1])
+                    end = bisect.bisect_left(self.postings, last, start, self.offsets[i + 1])
+                    if start < end:
+                        ranges.append((start, end))
+            ranges.sort(key=lambda bounds: bounds[1] - bounds[0])
+            prefix = len(ranges) - min_common + 1
+            if prefix <= 0:
+                continue
+            while prefix and ranges[prefix - 1][1] - ranges[prefix - 1][0] > TITLE_MATCH_MAX_POSTINGS:
+                prefix -= 1
+            hits = Counter()
+            for start, end in ranges[:prefix]:
+                hits.update(self.postings[start:end])
+            rest = ranges[prefix:]
+            for title_id, common in hits.items():
+                title_size = self.title_sizes[title_id]
+                needed = min_similarity * (size + title_size) / 2
+                missing = len(rest)
+                if common + missing < needed:
+                    continue
+                for start, end in rest:
+                    if common + missing < needed:
+                        break
+                    missing -= 1
+                    i = bisect.bisect_left(self.postings, title_id, start, end)
+                    if i < end and self.postings[i] == title_id:
+                        common += 1
+                similarity = 2 * common / (size + title_size)
+                candidate = self.title_candidates[title_id]
+                if similarity >= min_similarity and similarity > similarities.get(candidate, 0):
+                    similarities[candidate] = similarity
+        return similarities
+
+    # Title similarity weighed with agreement on type, episodes and year, which add 0.1 each when they
+    # agree and 0.05 when unknown on either side
+    def confidence(self, candidate, similarity, anime):
+        type_ = ANILIST_FORMAT_TYPES.get(anime.format)
+        confidence = TITLE_MATCH_TITLE_WEIGHT * similarity
+        for ours, theirs in ((OFFLINE_DB_TYPES.index(type_) if type_ else 0, self.types[candidate]),
+                             (anime.episodes or 0, self.episodes[candidate]),
+                             (anime.year or 0, self.years[candidate])):
+            if not ours or not theirs:
+                confidence += 0.05
+            elif ours == theirs:
+                confidence += 0.1
+        return confidence
+
+    # Returns (mal_id, confidence) of the best match for a list entry, or None when no candidate
+    # reaches threshold or the best one isn't clearly ahead of the rest
+    def match(self, anime, threshold=TITLE_MATCH_THRESHOLD):
+        best, best_confidence, runner_up = None, 0, 0
+        min_similarity = max(0.1, (threshold - (1 - TITLE_MATCH_TITLE_WEIGHT)) / TITLE_MATCH_TITLE_WEIGHT)
+        for candidate, similarity in self.similarities(anime, min_similarity).items():
+            confidence = self.confidence(candidate, similarity, anime)
+            if confidence > best_confidence:
+                if best is not None and self.mal_ids[best] != self.mal_ids[candidate]:
+                    runner_up = best_confidence
+                best, best_confidence = candidate, confidence
+            elif confidence > runner_up and self.mal_ids[best] != self.mal_ids[candidate]:
+                runner_up = confidence
+        if best is None or best_confidence < threshold or best_confidence - runner_up < TITLE_MATCH_MARGIN:
+            return None
+        return self.mal_ids[best], best_confidence
+
+
+# Build step: turn the offline database json into the compact mapping store
+def build_mapping_store(db_path=OFFLINE_DB_PATH, store_path=MAPPING_STORE_PATH):
+    with open(db_path, 'r') as f:
+        entries = json.load(f)['data']
+    anilist_index, mal_index = build_id_index(entries)
+    stat = os.stat(db_path)
+    if TITLE_MATCHING:
+        build_title_index(entries, title_index_path(store_path), stat)
+    del entries
+    tmp_path = f'{store_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAPPING_STORE_HEADER.pack(MAPPING_STORE_MAGIC, stat.st_size, stat.st_mtime_ns, len(anilist_index), len(mal_index)))
+        for index in (anilist_index, mal_index):
+            keys = sorted(index)
+            array('I', keys).tofile(f)
+            array('I', [index[key] for key in keys]).tofile(f)
+    os.replace(tmp_path, store_path)
+
+
+# An index file is current when it was built from the offline database file as it is on disk now
+def index_file_is_current(db_path, path, expected_magic):
+    if not os.path.exists(path):
+        return False
+    if not os.path.exists(db_path):
+        return True
+    with open(path, 'rb') as f:
+        header = f.read(INDEX_SOURCE_HEADER.size)
+    if len(header) < INDEX_SOURCE_HEADER.size:
+        return False
+    magic, size, mtime_ns = INDEX_SOURCE_HEADER.unpack(header)
+    stat = os.stat(db_path)
+    return magic == expected_magic and size == stat.st_size and mtime_ns == stat.st_mtime_ns
+
+
+# The store is current when it, and with TITLE_MATCHING its title index, match the offline database
+def mapping_store_is_current(db_path=OFFLINE_DB_PATH, store_path=MAPPING_STORE_PATH):
+    if not index_file_is_current(db_path, store_path, MAPPING_STORE_MAGIC):
+        return False
+    return not TITLE_MATCHING or index_file_is_current(db_path, title_index_path(store_path), TITLE_INDEX_MAGIC)
+
+
+# Load the anime offline database, only parsing the json when the mapping store is missing or stale
+def load_anime_offline_database(db_path=None, store_path=None):
+    global id_store
+    db_path = db_path or OFFLINE_DB_PATH
+    store_path = store_path or MAPPING_STORE_PATH
+    if not mapping_store_is_current(db_path, store_path):
+        build_mapping_store(db_path, store_path)
+    id_store = MappingStore(store_path)
+
+# Make sure there is a usable offline database, falling back to the cached copy when the download fails
+def prepare_anime_offline_database():
+    try:
+        download_anime_offline_database(OFFLINE_DB_MAX_AGE)
+    except requests.RequestException as e:
+        if not os.path.exists(OFFLINE_DB_PATH) and not os.path.exists(MAPPING_STORE_PATH):
+            raise
+        print(f'Error downloading anime offline database, using the cached copy: {e}', file=sys.stderr)
+    load_anime_offline_database()
+
+# The database is only downloaded and loaded on the first id lookup
+def get_id_store():
+    if id_store is None:
+        with id_store_lock:
+            if id_store is None:
+                prepare_anime_offline_database()
+    return id_store
+
+
+id_store = None
+id_store_lock = threading.Lock()
+
+
+# The AniList client, like the offline database, list parsing and XML code, is kept identical to
+# Docker/app.py rather than imported from a shared module, so this script keeps working as the
+# single file the README has users download. tests/test_shared_code.py checks the copies still match.
+class AniListError(Exception):
+    pass
+
+
+class AniListNotFoundError(AniListError):
+    pass
+
+
+class AniListRateLimitError(AniListError):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AniListTransportError(AniListError):
+    pass
+
+
+class AniListCancelledError(AniListError):
+    pass
+
+
+# Token bucket shared by every thread using the client, also honouring the limits AniList reports back
+class TokenBucket:
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, requests_per_minute, burst):
+        self.rate = requests_per_minute / 60
+        self.capacity = burst
+        self.tokens = burst
+        self.updated_at = self.clock()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    # Hold the bucket while its state is read and updated
+    @contextlib.contextmanager
+    def locked(self):
+        with self.lock:
+            yield
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # Wait for a token, returns False if cancel_event was set while waiting
+    def acquire(self, cancel_event=None):
+        while True:
+            with self.locked():
+                now = self.clock()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            if cancel_event is not None:
+                if cancel_event.wait(wait):
+                    return False
+            else:
+                time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.locked():
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+            self.tokens = 0
+
+    # Never hand out more tokens than AniList says are left in the current window
+    def observe(self, remaining):
+        with self.locked():
+            self.tokens = min(self.tokens, remaining)
+
+
+# Keep-alive GraphQL client for AniList with timeouts, rate limiting and jittered retries
+class AniListClient:
+    def __init__(self, url=ANILIST_API_URL, requests_per_minute=ANILIST_RATE_LIMIT, max_retries=ANILIST_MAX_RETRIES, timeout=ANILIST_TIMEOUT, pool_size=10, on_attempt=None,
+                 limiter=None):
+        self.url = url
+        self.on_attempt = on_attempt  # Called with the outcome of every request, for metrics
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.limiter = limiter or TokenBucket(requests_per_minute, burst=max(1, int(requests_per_minute) // 6))
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    # parse, if given, reads a successful response from its streamed body instead of the client
+    # decoding it whole, and its result is returned in place of the data
+    def query(self, query, variables, cancel_event=None, parse=None):
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                delay = random.uniform(0, min(ANILIST_BACKOFF_CAP, ANILIST_BACKOFF_BASE * 2 ** attempt))
+                if cancel_event is not None and cancel_event.wait(delay):
+                    raise AniListCancelledError('AniList request cancelled.')
+                elif cancel_event is None:
+                    time.sleep(delay)
+            if not self.limiter.acquire(cancel_event):
+                raise AniListCancelledError('AniList request cancelled.')
+
+            try:
+                response = self.session.post(self.url, json={'query': query, 'variables': variables}, timeout=self.timeout,
+                                             stream=parse is not None)
+            except requests.RequestException as e:
+                error = AniListTransportError(f'Error contacting AniList: {e}')
+                self.record_attempt('transport_error')
+                continue
+
+            remaining = response.headers.get('X-RateLimit-Remaining')
+            if remaining is not None and remaining.isdigit():
+                self.limiter.observe(int(remaining))
+            if response.status_code == 429:
+                retry_after = response.headers.get('Retry-After', '')
+                retry_after = int(retry_after) if retry_after.isdigit() else 60
+                self.limiter.pause(retry_after)
+                error = AniListRateLimitError(f'AniList rate limit reached, try again in {retry_after} seconds.', retry_after)
+                self.record_attempt('rate_limited')
+                response.close()  # A streamed response holds its pooled connection until closed
+                continue
+            if response.status_code >= 500:
+                error = AniListTransportError(f'AniList returned HTTP {response.status_code}.')
+                self.record_attempt('server_error')
+                response.close()
+                continue
+            if parse is not None and response.status_code == 200:
+                try:
+                    result = parse(response)
+                except requests.RequestException as e:
+                    error = AniListTransportError(f'Error reading the AniList response: {e}')
+                    self.record_attempt('transport_error')
+                    continue
+                except ValueError:
+                    error = AniListTransportError('AniList returned an invalid response (HTTP 200).')
+                    self.record_attempt('invalid_response')
+                    continue
+                finally:
+                    response.close()
+                self.record_attempt('ok')
+                return result
+
+            try:
+                data = response.json()
+            except ValueError:
+                error = AniListTransportError(f'AniList returned an invalid response (HTTP {response.status_code}).')
+                self.record_attempt('invalid_response')
+                continue
+            if data.get('errors'):
+                message = '; '.join(e.get('message', 'Unknown error') for e in data['errors'])
+                if response.status_code == 404 or any(e.get('status') == 404 for e in data['errors']):
+                    self.record_attempt('not_found')
+                    raise AniListNotFoundError(message)
+                self.record_attempt('error')
+                raise AniListError(f'AniList error: {message}')
+            if response.status_code >= 400:
+                self.record_attempt('error')
+                raise AniListError(f'AniList returned HTTP {response.status_code}.')
+            self.record_attempt('ok')
+            return data['data']
+        raise error
+
+    def record_attempt(self, outcome):
+        if self.on_attempt is not None:
+            self.on_attempt(outcome)
+
+
+# Pack an AniList fuzzy date into a yyyymmdd int, unknown parts are 0
+def pack_date(date):
+    return (date['year'] or 0) * 10000 + (date['month'] or 0) * 100 + (date['day'] or 0)
+
+
+# MAL date of a packed date, unpadded and with zeros for unknown parts as the export always wrote it
+def format_date(packed):
+    year, month, day = packed // 10000, packed // 100 % 100, packed % 100
+    return f"{year or '0000'}-{month or '00'}-{day or '00'}"
+
+
+# One entry of a user's list. Lists can have tens of thousands of these, so they are slotted,
+# the dates are packed ints and the format and status strings are shared. Manga entries keep their
+# chapters in episodes and the chapters read in progress, only they have volumes.
+class ListEntry:
+    __slots__ = ('anilist_id', 'title', 'episodes', 'format', 'score', 'progress', 'started_at', 'completed_at',
+                 'status', 'updated_at', 'mal_id', 'year', 'romaji_title', 'volumes', 'progress_volumes')
+
+    def __init__(self, anilist_id, title, episodes, format_, score, progress, started_at, completed_at, status, updated_at,
+                 mal_id=None, year=None, romaji_title=None, volumes=None, progress_volumes=None):
+        self.anilist_id = anilist_id
+        self.title = title
+        self.episodes = episodes
+        self.format = sys.intern(format_) if format_ else format_
+        self.score = score
+        self.progress = progress
+        self.started_at = started_at
+        self.completed_at = completed_at
+        self.status = sys.intern(status) if status else status
+        self.updated_at = updated_at
+        self.mal_id = mal_id
+        self.year = year
+        self.romaji_title = romaji_title  # Only kept when title is the English one
+        self.volumes = volumes
+        self.progress_volumes = progress_volumes
+
+    @property
+    def start_date(self):
+        return format_date(self.started_at)
+
+    @property
+    def finish_date(self):
+        return format_date(self.completed_at)
+
+    # The fields as a list, which is how entries are stored and hashed
+    def to_row(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+
+def parse_list_entry(entry):
+    media = entry['media']
+    title = media['title']
+    return ListEntry(media['id'], title['english'] or title['romaji'], media['episodes'] if 'episodes' in media else media.get('chapters'),
+                     media['format'], entry['score'], entry['progress'], pack_date(entry['startedAt']), pack_date(entry['completedAt']),
+                     entry['status'], entry.get('updatedAt') or 0, media.get('idMal') or None, media.get('seasonYear'),
+                     title['romaji'] if title['english'] else None, media.get('volumes'), entry.get('progressVolumes'))
+
+
+# An escaped quote can't start a key, so this never matches inside a string
+LIST_ENTRIES_KEY = re.compile(r'(?<!\\)"entries"\s*:\s*\[')
+JSON_SEPARATORS = re.compile(r'[\s,]*')
+
+
+# Decode the objects of every "entries" array of a MediaListCollection response one by one as the body
+# arrives, so neither the whole document nor its parsed tree is ever held in memory
+def iter_list_entries(chunks):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    in_entries = False
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+        pos = 0
+        while True:
+            if not in_entries:
+                match = LIST_ENTRIES_KEY.search(buffer, pos)
+                if match is None:
+                    # Keep enough of the tail for a key split between chunks
+                    pos = max(pos, len(buffer) - 32)
+                    break
+                pos = match.end()
+                in_entries = True
+            pos = JSON_SEPARATORS.match(buffer, pos).end()
+            if pos == len(buffer):
+                break
+            if buffer[pos] == ']':
+                in_entries = False
+                pos += 1
+                continue
+            try:
+                entry, pos_end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                break  # The entry continues in the next chunk
+            yield entry
+            pos = pos_end
+        buffer = buffer[pos:]
+    if in_entries:
+        raise ValueError('List response ended in the middle of a list.')
+
+
+# Entry records of a streamed list response. Entries that are also in custom lists come once
+# for every list, only the first copy is kept.
+def iter_anime_entries(chunks):
+    seen = set()
+    for entry in iter_list_entries(chunks):
+        anilist_id = entry['media']['id']
+        if anilist_id not in seen:
+            seen.add(anilist_id)
+            yield parse_list_entry(entry)
+
+
+def parse_media_list_collection(response):
+    return list(iter_anime_entries(response.iter_content(ANILIST_STREAM_CHUNK_SIZE)))
+
+
+# Fetch the entries updated at or after since, newest first, paging through the list only as far as needed
+def fetch_updated_anime_entries(anilist_username, since, cancel_event=None, media_type='ANIME'):
+    query = '''
+        query ($userName: String, $type: MediaType, $manga: Boolean!, $page: Int, $perPage: Int) {
+            Page(page: $page, perPage: $perPage) {
+                pageInfo {
+                    hasNextPage
+                }
+                mediaList(userName: $userName, type: $type, sort: UPDATED_TIME_DESC) {
+                    media {
+                        id
+                        idMal
+                        title {
+                            english
+                            romaji
+                        }
+                        episodes @skip(if: $manga)
+                        chapters @include(if: $manga)
+                        volumes @include(if: $manga)
+                        format
+                        seasonYear
+                    }
+                    score
+                    progress
+                    progressVolumes @include(if: $manga)
+                    startedAt {
+                        year
+                        month
+                        day
+                    }
+                    completedAt {
+                        year
+                        month
+                        day
+                    }
+                    status
+                    updatedAt
+                }
+            }
+        }
+    '''
+
+    updated = []
+    page = 1
+    while True:
+        variables = {
+            'userName': anilist_username,
+            'type': media_type,
+            'manga': media_type == 'MANGA',
+            'page': page,
+            'perPage': ANILIST_PAGE_SIZE
+        }
+        try:
+            data = anilist_client.query(query, variables, cancel_event)
+        except AniListNotFoundError:
+            raise AniListNotFoundError(f'AniList username "{anilist_username}" not found.')
+        for entry in data['Page']['mediaList']:
+            if (entry['updatedAt'] or 0) < since:
+                return updated
+            updated.append(parse_list_entry(entry))
+        if not data['Page']['pageInfo']['hasNextPage']:
+            return updated
+        page += 1
+
+
+# Per-user copy of the last fetched list, so later runs only need to fetch what changed
+class SnapshotStore:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS snapshot_entries ('
+                                    'username TEXT, anilist_id INTEGER, updated_at INTEGER, entry TEXT, '
+                                    'PRIMARY KEY (username, anilist_id))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS snapshot_state ('
+                                    'username TEXT PRIMARY KEY, last_updated_at INTEGER, full_synced_at REAL)')
+
+    # Returns (last_updated_at, full_synced_at), or None for a user without a snapshot
+    def get_state(self, username):
+        with self.lock:
+            return self.connection.execute('SELECT last_updated_at, full_synced_at FROM snapshot_state WHERE username = ?',
+                                           (username,)).fetchone()
+
+    def replace(self, username, anime_list):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM snapshot_entries WHERE username = ?', (username,))
+            self._upsert(username, anime_list)
+            self.connection.execute('INSERT OR REPLACE INTO snapshot_state VALUES (?, ?, ?)',
+                                    (username, max((anime.updated_at for anime in anime_list), default=0), time.time()))
+
+    def merge(self, username, anime_list):
+        with self.lock, self.connection:
+            self._upsert(username, anime_list)
+            self.connection.execute('UPDATE snapshot_state SET last_updated_at = MAX(last_updated_at, ?) WHERE username = ?',
+                                    (max((anime.updated_at for anime in anime_list), default=0), username))
+
+    def _upsert(self, username, anime_list):
+        self.connection.executemany(
+            'INSERT INTO snapshot_entries VALUES (?, ?, ?, ?) ON CONFLICT (username, anilist_id) '
+            'DO UPDATE SET updated_at = excluded.updated_at, entry = excluded.entry',
+            ((username, anime.anilist_id, anime.updated_at, json.dumps(anime.to_row())) for anime in anime_list))
+
+    def load(self, username):
+        with self.lock:
+            rows = self.connection.execute('SELECT entry FROM snapshot_entries WHERE username = ? ORDER BY rowid',
+                                           (username,)).fetchall()
+        return [ListEntry.from_row(json.loads(entry)) for entry, in rows]
+
+
+anilist_client = AniListClient()
+snapshot_store = None  # Set by --snapshot-db
+
+
+# media_type is 'ANIME' or 'MANGA', both lists come back as the same entry records
+def fetch_user_anime_list(anilist_username=None, media_type='ANIME'):
     if cancel_event.is_set():
         return None
+    anilist_username = anilist_username or ANILIST_USERNAME
 
     query = '''
-        query ($userName: String) {
-            MediaListCollection(userName: $userName, type: ANIME) {
+        query ($userName: String, $type: MediaType, $manga: Boolean!) {
+            MediaListCollection(userName: $userName, type: $type) {
                 lists {
                     name
                     entries {
                         media {
                             id
+                            idMal
                             title {
                                 english
                                 romaji
                             }
-                            episodes
+                            episodes @skip(if: $manga)
+                            chapters @include(if: $manga)
+                            volumes @include(if: $manga)
                             format
+                            seasonYear
                         }
                         score
                         progress
+                        progressVolumes @include(if: $manga)
                         startedAt {
                             year
                             month
@@ -64,6 +903,7 @@ def fetch_user_anime_list():
                             day
                         }
                         status
+                        updatedAt
                     }
                 }
             }
@@ -71,48 +911,172 @@ def fetch_user_anime_list():
     '''
 
     variables = {
-        'userName': ANILIST_USERNAME
+        'userName': anilist_username,
+        'type': media_type,
+        'manga': media_type == 'MANGA'
     }
 
-    url = 'https://graphql.anilist.co'
-
     try:
-        response = requests.post(url, json={'query': query, 'variables': variables})
-        response.raise_for_status()
-
-        data = response.json()
-        if 'errors' in data:
-            raise Exception(f'AniList username "{ANILIST_USERNAME}" not found.')
-
-        lists = data['data']['MediaListCollection']['lists']
-        return [
-            {
-                'anilist_id': entry['media']['id'],
-                'title': entry['media']['title']['english'] or entry['media']['title']['romaji'],
-                'episodes': entry['media']['episodes'],
-                'format': entry['media']['format'],
-                'score': entry['score'],
-                'progress': entry['progress'],
-                'startedAt': f"{entry['startedAt']['year'] or '0000'}-{entry['startedAt']['month'] or '00'}-{entry['startedAt']['day'] or '00'}",
-                'completedAt': f"{entry['completedAt']['year'] or '0000'}-{entry['completedAt']['month'] or '00'}-{entry['completedAt']['day'] or '00'}",
-                'status': entry['status']
-            }
-            for list_ in lists for entry in list_['entries']
-        ]
-    except Exception as e:
-        if not cancel_event.is_set():
-            print(f'Error fetching user anime list: {e}')
+        return anilist_client.query(query, variables, cancel_event, parse=parse_media_list_collection)
+    except AniListCancelledError:
         return None
+    except AniListNotFoundError:
+        raise AniListNotFoundError(f'AniList username "{anilist_username}" not found.')
+
+
+# Snapshots are keyed by the lowercased username, a manga list is kept under its own key next to it
+def snapshot_key(anilist_username, media_type='ANIME'):
+    username = anilist_username.lower()
+    return username if media_type == 'ANIME' else f'{username}:{media_type.lower()}'
+
+
+# Bring the user's snapshot up to date and return the whole list from it. A full fetch is only made
+# for new users or when the snapshot is older than SNAPSHOT_FULL_SYNC_INTERVAL.
+def sync_user_anime_list(anilist_username, store, cancel_event=None, media_type='ANIME'):
+    username = snapshot_key(anilist_username, media_type)
+    state = store.get_state(username)
+    if state is None or time.time() - state[1] > SNAPSHOT_FULL_SYNC_INTERVAL:
+        anime_list = fetch_user_anime_list(anilist_username, media_type)
+        if anime_list is None:
+            return None
+        store.replace(username, anime_list)
+    else:
+        store.merge(username, fetch_updated_anime_entries(anilist_username, state[0], cancel_event, media_type))
+    return store.load(username)
+
+
+def load_user_anime_list(anilist_username, cancel_event=None, media_type='ANIME'):
+    if snapshot_store is not None:
+        return sync_user_anime_list(anilist_username, snapshot_store, cancel_event, media_type)
+    return fetch_user_anime_list(anilist_username, media_type)
+
+
+# Load several of the user's lists, e.g. ('ANIME', 'MANGA'), returning {media_type: list}. The lists are
+# fetched concurrently through the shared client, so this takes about as long as the slowest fetch.
+def load_user_lists(anilist_username, media_types, cancel_event=None):
+    if len(media_types) == 1:
+        return {media_types[0]: load_user_anime_list(anilist_username, cancel_event, media_types[0])}
+    with ThreadPoolExecutor(max_workers=len(media_types)) as executor:
+        futures = {media_type: executor.submit(load_user_anime_list, anilist_username, cancel_event, media_type)
+                   for media_type in media_types}
+        return {media_type: future.result() for media_type, future in futures.items()}
 
 
 def fetch_mal_id(anilist_id):
-    for anime in anime_offline_db:
-        for source in anime['sources']:
-            if f'https://anilist.co/anime/{anilist_id}' in source:
-                for mal_source in anime['sources']:
-                    if 'https://myanimelist.net/anime/' in mal_source:
-                        return mal_source.split('/')[-1]
-    return None
+    return get_id_store().anilist_to_mal.get(int(anilist_id))
+
+
+def fetch_anilist_id(mal_id):
+    return get_id_store().mal_to_anilist.get(int(mal_id))
+
+
+# Resolve many AniList ids at once, ids without a MAL mapping are left out
+def resolve_mal_ids(anilist_ids):
+    anilist_to_mal = get_id_store().anilist_to_mal
+    resolved = {}
+    for anilist_id in anilist_ids:
+        mal_id = anilist_to_mal.get(int(anilist_id))
+        if mal_id is not None:
+            resolved[anilist_id] = mal_id
+    return resolved
+
+
+# Lookups of entries neither idMal nor the offline database index resolves, kept between conversions.
+# A row is (mal_id, confidence, title_matched): misses have a NULL mal_id and are trusted for miss_ttl
+# seconds, rows written after title matching ran keep the match, or NULL for a failure to match, with its
+# confidence for title_match_ttl seconds. A guess never turns into a permanent id.
+class MalIdCache:
+    def __init__(self, path, miss_ttl=MAL_ID_MISS_TTL, title_match_ttl=TITLE_MATCH_TTL):
+        self.path = path
+        self.miss_ttl = miss_ttl
+        self.title_match_ttl = title_match_ttl
+        self._connection = None
+        self.lock = threading.Lock()
+
+    # Opened on first use, most conversions never need it
+    @property
+    def connection(self):
+        if self._connection is None:
+            # The directory may not exist yet, OFFLINE_DB_DIR is only created when the offline database is downloaded
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS mal_id_lookups (anilist_id INTEGER PRIMARY KEY, '
+                                     'mal_id INTEGER, confidence REAL, title_matched INTEGER, checked_at REAL)')
+        return self._connection
+
+    # Returns {anilist_id: (mal_id, confidence, title_matched)} for the cached ids that haven't expired
+    def get_many(self, anilist_ids):
+        anilist_ids = list(anilist_ids)
+        now = time.time()
+        cached = {}
+        with self.lock:
+            for start in range(0, len(anilist_ids), 500):
+                batch = anilist_ids[start:start + 500]
+                rows = self.connection.execute('SELECT anilist_id, mal_id, confidence, title_matched FROM mal_id_lookups '
+                                               'WHERE checked_at >= CASE WHEN title_matched THEN ? ELSE ? END '
+                                               f'AND anilist_id IN ({",".join("?" * len(batch))})',
+                                               [now - self.title_match_ttl, now - self.miss_ttl] + batch)
+                for anilist_id, mal_id, confidence, title_matched in rows:
+                    cached[anilist_id] = (mal_id, confidence, bool(title_matched))
+        return cached
+
+    # rows maps AniList ids to (mal_id, confidence, title_matched) like get_many returns them
+    def put_many(self, rows):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO mal_id_lookups VALUES (?, ?, ?, ?, ?)',
+                                        ((anilist_id, mal_id, confidence, title_matched, now)
+                                         for anilist_id, (mal_id, confidence, title_matched) in rows.items()))
+
+
+mal_id_cache = MalIdCache(MAL_ID_CACHE_PATH)
+
+
+# Find the MAL id of every entry, in list order, from the first tier that knows it: the idMal AniList
+# sent with the entry, the offline database index, then with TITLE_MATCHING a title match. Most entries
+# have an idMal, so the other tiers only see the few that don't. Entries those tiers didn't resolve are
+# remembered in the cache, which is asked first: a cached miss skips the index until it expires, and a
+# cached title match, or failure to match, is reused instead of matching again. Title matches only count
+# while TITLE_MATCHING is on and their confidence meets TITLE_MATCH_THRESHOLD. Entries no tier resolves
+# get None and are also returned as a list of dicts, so they can be reported instead of being exported
+# under a wrong id. The title matched entries are returned last, with the MAL id and confidence of the
+# match, so the guesses can be checked. The offline database only covers anime, manga lists are resolved
+# from idMal alone.
+def resolve_anime_mal_ids(anime_list, cache=None, media_type='ANIME'):
+    mal_ids = [anime.mal_id for anime in anime_list]
+    pending = [i for i, mal_id in enumerate(mal_ids) if mal_id is None]
+    title_matched = []
+    if pending and media_type == 'ANIME':
+        cached = cache.get_many({anime_list[i].anilist_id for i in pending}) if cache is not None else {}
+        anilist_to_mal = get_id_store().anilist_to_mal
+        for i in pending:
+            if anime_list[i].anilist_id not in cached:
+                mal_ids[i] = anilist_to_mal.get(anime_list[i].anilist_id)
+        pending = [i for i in pending if mal_ids[i] is None]
+        titles = get_id_store().titles if pending and TITLE_MATCHING else None
+        lookups = {}
+        for i in pending:
+            anilist_id = anime_list[i].anilist_id
+            row = cached.get(anilist_id)
+            if titles is None:
+                if row is None:
+                    lookups[anilist_id] = (None, None, False)
+                continue
+            if row is not None and row[2]:
+                match = row[:2] if row[0] is not None else None
+            else:
+                match = titles.match(anime_list[i])
+                lookups[anilist_id] = (*(match or (None, None)), True)
+            if match is not None and match[1] >= TITLE_MATCH_THRESHOLD:
+                mal_ids[i] = match[0]
+                title_matched.append({'anilist_id': anilist_id, 'title': anime_list[i].title, 'mal_id': match[0],
+                                      'confidence': round(match[1], 3)})
+        if lookups and cache is not None:
+            cache.put_many(lookups)
+        pending = [i for i in pending if mal_ids[i] is None]
+    unresolved = [{'anilist_id': anime_list[i].anilist_id, 'title': anime_list[i].title, 'format': anime_list[i].format,
+                   'status': anime_list[i].status} for i in pending]
+    return mal_ids, unresolved, title_matched
 
 
 def map_format_to_mal_type(format_):
@@ -126,7 +1090,15 @@ def map_format_to_mal_type(format_):
     }.get(format_, 'Unknown')
 
 
-def map_status_to_mal_status(status):
+def map_status_to_mal_status(status, media_type='ANIME'):
+    if media_type == 'MANGA':
+        return {
+            'CURRENT': 'Reading',
+            'COMPLETED': 'Completed',
+            'PAUSED': 'On-Hold',
+            'DROPPED': 'Dropped',
+            'PLANNING': 'Plan to Read'
+        }.get(status, 'Unknown')
     return {
         'CURRENT': 'Watching',
         'COMPLETED': 'Completed',
@@ -136,67 +1108,379 @@ def map_status_to_mal_status(status):
     }.get(status, 'Unknown')
 
 
-def create_mal_xml(anime_list, file_name):
-    if cancel_event.is_set():
+# Export type, entry element and per-status totals of the MAL anime and manga exports
+MAL_EXPORT_TYPES = {
+    'ANIME': ('1', 'anime', ['watching', 'completed', 'onhold', 'dropped', 'plantowatch']),
+    'MANGA': ('2', 'manga', ['reading', 'completed', 'onhold', 'dropped', 'plantoread'])
+}
+MAL_TOTAL_STATUSES = ['CURRENT', 'COMPLETED', 'PAUSED', 'DROPPED', 'PLANNING']
+PROGRESS_MAX_STEP = 100  # generate_mal_xml reports progress every 1% of the entries, and at least every this many
+
+
+def anime_xml_fields(anime, mal_id):
+    return [
+        ('series_animedb_id', str(mal_id)),
+        ('series_title', anime.title),
+        ('series_type', map_format_to_mal_type(anime.format)),
+        ('series_episodes', str(anime.episodes)),
+        ('my_id', '0'),
+        ('my_watched_episodes', str(anime.progress)),
+        ('my_start_date', anime.start_date),
+        ('my_finish_date', anime.finish_date),
+        ('my_rated', ''),
+        ('my_score', str(anime.score)),
+        ('my_storage', ''),
+        ('my_storage_value', '0.00'),
+        ('my_status', map_status_to_mal_status(anime.status)),
+        ('my_comments', ''),
+        ('my_times_watched', '0'),
+        ('my_rewatch_value', ''),
+        ('my_priority', 'LOW'),
+        ('my_tags', ''),
+        ('my_rewatching', '0'),
+        ('my_rewatching_ep', '0'),
+        ('my_discuss', '1'),
+        ('my_sns', 'default'),
+        ('update_on_import', '1')
+    ]
+
+
+# Unknown chapter and volume counts are 0, as in MAL's own manga exports
+def manga_xml_fields(manga, mal_id):
+    return [
+        ('manga_mangadb_id', str(mal_id)),
+        ('manga_title', manga.title),
+        ('manga_volumes', str(manga.volumes or 0)),
+        ('manga_chapters', str(manga.episodes or 0)),
+        ('my_id', '0'),
+        ('my_read_volumes', str(manga.progress_volumes or 0)),
+        ('my_read_chapters', str(manga.progress or 0)),
+        ('my_start_date', manga.start_date),
+        ('my_finish_date', manga.finish_date),
+        ('my_scanalation_group', ''),
+        ('my_score', str(manga.score)),
+        ('my_storage', ''),
+        ('my_retail_volumes', '0'),
+        ('my_status', map_status_to_mal_status(manga.status, 'MANGA')),
+        ('my_comments', ''),
+        ('my_times_read', '0'),
+        ('my_tags', ''),
+        ('my_priority', 'LOW'),
+        ('my_reread_value', ''),
+        ('my_rereading', '0'),
+        ('my_discuss', '1'),
+        ('my_sns', 'default'),
+        ('update_on_import', '1')
+    ]
+
+
+# Escape element text the way minidom's toprettyxml did, keeping the output byte-identical
+def escape_xml_text(text):
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace('>', '&gt;')
+
+
+def xml_element(name, text, indent):
+    if text:
+        return f'{indent}<{name}>{escape_xml_text(text)}</{name}>\n'
+    return f'{indent}<{name}/>\n'
+
+
+# Incrementally write the MAL export of an 'ANIME' or 'MANGA' list, yielding the header, then one chunk per entry.
+# progress, if given, is called as progress(stage, count, total) with the entries gone through as 'mapped',
+# out of all of them, and the entries written as 'written', out of those with a MAL id. Both are reported
+# together every 1% of the list. mal_ids can pass in the ids found by resolve_anime_mal_ids. Entries without
+# a MAL id are left out.
+def generate_mal_xml(anime_list, xml_username, progress=None, mal_ids=None, media_type='ANIME'):
+    if mal_ids is None:
+        mal_ids, _, _ = resolve_anime_mal_ids(anime_list, mal_id_cache, media_type)
+    export_type, element, total_names = MAL_EXPORT_TYPES[media_type]
+    entry_fields = anime_xml_fields if media_type == 'ANIME' else manga_xml_fields
+    status_counts = Counter(anime.status for anime, mal_id in zip(anime_list, mal_ids) if mal_id is not None)
+    total = sum(status_counts.values())
+    myinfo = [
+        ('user_id', '0'),
+        ('user_name', xml_username),
+        ('user_export_type', export_type),
+        (f'user_total_{element}', str(total))
+    ] + [(f'user_total_{name}', str(status_counts[status])) for name, status in zip(total_names, MAL_TOTAL_STATUSES)]
+    yield ''.join(['<?xml version="1.0" ?>\n<myanimelist>\n  <myinfo>\n']
+                  + [xml_element(name, text, '    ') for name, text in myinfo]
+                  + ['  </myinfo>\n'])
+
+    written = 0
+    step = max(1, min(PROGRESS_MAX_STEP, len(anime_list) // 100))
+    opening, closing = f'  <{element}>\n', f'  </{element}>\n'
+    for mapped, (anime, mal_id) in enumerate(zip(anime_list, mal_ids), 1):
+        if mal_id is not None:
+            yield ''.join([opening]
+                          + [xml_element(name, text, '    ') for name, text in entry_fields(anime, mal_id)]
+                          + [closing])
+            written += 1
+        if progress and (mapped % step == 0 or mapped == len(anime_list)):
+            progress('mapped', mapped, len(anime_list))
+            progress('written', written, total)
+
+    yield '</myanimelist>\n'
+
+
+# List the entries that were left out of the export for lack of a MAL id
+def report_unresolved(unresolved, file=None):
+    if not unresolved:
         return
+    print(f'{len(unresolved)} entries have no MAL id and were left out:', file=file)
+    for anime in unresolved:
+        print(f"  {anime['title']} (AniList id {anime['anilist_id']}, {anime['status']})", file=file)
+
+
+# List the entries that were exported under a title match, so the guesses can be checked
+def report_title_matches(title_matched, file=None):
+    if not title_matched:
+        return
+    print(f'{len(title_matched)} entries were matched by title:', file=file)
+    for anime in title_matched:
+        print(f"  {anime['title']} (AniList id {anime['anilist_id']}) as MAL id {anime['mal_id']}, "
+              f"confidence {anime['confidence']:.2f}", file=file)
+
+
+# Write the MAL export straight to disk, only replacing file_name once it is complete.
+# progress is passed on to generate_mal_xml. Returns the entries left out for lack of a MAL id.
+def create_mal_xml(anime_list, file_name, xml_username=None, media_type='ANIME', progress=None):
+    if cancel_event.is_set():
+        return None
 
-    root = ET.Element('myanimelist')
-    myinfo = ET.SubElement(root, 'myinfo')
-    ET.SubElement(myinfo, 'user_id').text = '0'
-    ET.SubElement(myinfo, 'user_name').text = XML_USERNAME
-    ET.SubElement(myinfo, 'user_export_type').text = '1'
-    ET.SubElement(myinfo, 'user_total_anime').text = str(len(anime_list))
-    ET.SubElement(myinfo, 'user_total_watching').text = str(len([a for a in anime_list if a['status'] == 'CURRENT']))
-    ET.SubElement(myinfo, 'user_total_completed').text = str(len([a for a in anime_list if a['status'] == 'COMPLETED']))
-    ET.SubElement(myinfo, 'user_total_onhold').text = str(len([a for a in anime_list if a['status'] == 'PAUSED']))
-    ET.SubElement(myinfo, 'user_total_dropped').text = str(len([a for a in anime_list if a['status'] == 'DROPPED']))
-    ET.SubElement(myinfo, 'user_total_plantowatch').text = str(len([a for a in anime_list if a['status'] == 'PLANNING']))
-
-    for anime in anime_list:
+    mal_ids, unresolved, title_matched = resolve_anime_mal_ids(anime_list, mal_id_cache, media_type)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            for chunk in generate_mal_xml(anime_list, xml_username or XML_USERNAME, progress, mal_ids, media_type):
+                if cancel_event.is_set():
+                    break
+                f.write(chunk)
         if cancel_event.is_set():
-            return
-        mal_id = fetch_mal_id(anime['anilist_id']) or anime['anilist_id']
-        if mal_id is None:
-            print(f'Unable to fetch MAL ID for {anime["title"]}, skipping.')
-            continue
-        anime_elem = ET.SubElement(root, 'anime')
-        ET.SubElement(anime_elem, 'series_animedb_id').text = str(mal_id)
-        ET.SubElement(anime_elem, 'series_title').text = anime['title']
-        ET.SubElement(anime_elem, 'series_type').text = map_format_to_mal_type(anime['format'])
-        ET.SubElement(anime_elem, 'series_episodes').text = str(anime['episodes'])
-        ET.SubElement(anime_elem, 'my_id').text = '0'
-        ET.SubElement(anime_elem, 'my_watched_episodes').text = str(anime['progress'])
-        ET.SubElement(anime_elem, 'my_start_date').text = anime['startedAt']
-        ET.SubElement(anime_elem, 'my_finish_date').text = anime['completedAt']
-        ET.SubElement(anime_elem, 'my_rated').text = ''
-        ET.SubElement(anime_elem, 'my_score').text = str(anime['score'])
-        ET.SubElement(anime_elem, 'my_storage').text = ''
-        ET.SubElement(anime_elem, 'my_storage_value').text = '0.00'
-        ET.SubElement(anime_elem, 'my_status').text = map_status_to_mal_status(anime['status'])
-        ET.SubElement(anime_elem, 'my_comments').text = ''
-        ET.SubElement(anime_elem, 'my_times_watched').text = '0'
-        ET.SubElement(anime_elem, 'my_rewatch_value').text = ''
-        ET.SubElement(anime_elem, 'my_priority').text = 'LOW'
-        ET.SubElement(anime_elem, 'my_tags').text = ''
-        ET.SubElement(anime_elem, 'my_rewatching').text = '0'
-        ET.SubElement(anime_elem, 'my_rewatching_ep').text = '0'
-        ET.SubElement(anime_elem, 'my_discuss').text = '1'
-        ET.SubElement(anime_elem, 'my_sns').text = 'default'
-        ET.SubElement(anime_elem, 'update_on_import').text = '1'
-
-    xml_str = ET.tostring(root, encoding='utf-8')
-    pretty_xml_str = minidom.parseString(xml_str).toprettyxml(indent="  ")
-    with open(file_name, 'w', encoding='utf-8') as f:
-        f.write(pretty_xml_str)
+            os.remove(tmp_path)
+            return None
+        os.replace(tmp_path, file_name)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
     print('MAL XML file created successfully.')
+    report_unresolved(unresolved)
+    report_title_matches(title_matched)
+    return unresolved
+
+
+def convert_user(anilist_username, xml_username, file_name, since=None):
+    anime_list = load_user_anime_list(anilist_username)
+    if not anime_list:
+        raise Exception('Error fetching anime list or no anime found')
+    if since is not None:
+        anime_list = [anime for anime in anime_list if anime.updated_at >= since]
+    create_mal_xml(anime_list, file_name, xml_username)
+
+
+# Convert several users concurrently, writing one <anilist username>.xml per user into output_dir.
+# users is a list of (anilist_username, xml_username), returns {anilist_username: error message or None}
+def convert_users(users, output_dir, workers=BATCH_WORKERS, since=None):
+    os.makedirs(output_dir, exist_ok=True)
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(users)))) as executor:
+        futures = {}
+        for anilist_username, xml_username in users:
+            file_name = os.path.join(output_dir, re.sub(r'[^\w.-]', '_', anilist_username) + '.xml')
+            futures[executor.submit(convert_user, anilist_username, xml_username, file_name, since)] = anilist_username
+        for future in as_completed(futures):
+            anilist_username = futures[future]
+            try:
+                future.result()
+                results[anilist_username] = None
+                print(f'{anilist_username}: done')
+            except Exception as e:
+                results[anilist_username] = str(e)
+                print(f'{anilist_username}: {e}')
+    return results
+
+
+# Read the anime of a MAL export (.xml, or .xml.gz as MAL serves it) one by one. Every entry is dropped
+# from the tree once it has been read, so memory stays flat however large the export is. A manga export
+# raises ValueError rather than importing nothing. Statuses MAL_TO_ANILIST_STATUS doesn't know are kept as
+# they are, for import_mal_export to leave out. Entries with a number or date that doesn't parse are
+# skipped, and (title, error) of each is added to malformed when it is given.
+def iter_mal_export(path, malformed=None):
+    with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as f:
+        root = None
+        for event, elem in ET.iterparse(f, events=('start', 'end')):
+            if root is None:
+                root = elem
+            elif event == 'end' and (elem.tag == 'manga' or elem.tag == 'user_export_type' and (elem.text or '').strip() == '2'):
+                raise ValueError(f'{path} is a MAL manga export, only anime exports can be imported')
+            elif event == 'end' and elem.tag == 'anime':
+                mal_id = elem.findtext('series_animedb_id', '').strip()
+                status = elem.findtext('my_status', '').strip()
+                if elem.findtext('my_rewatching', '').strip() == '1':
+                    status = 'REPEATING'
+                title = elem.findtext('series_title', '')
+                try:
+                    entry = {
+                        'anilist_id': None,
+                        'mal_id': int(mal_id) if mal_id.isdigit() else None,
+                        'title': title,
+                        'status': MAL_TO_ANILIST_STATUS.get(status, status),
+                        'progress': parse_mal_number(elem, 'my_watched_episodes', int),
+                        'score': parse_mal_number(elem, 'my_score', float),
+                        'started_at': parse_mal_date(elem, 'my_start_date'),
+                        'completed_at': parse_mal_date(elem, 'my_finish_date'),
+                        'repeat': parse_mal_number(elem, 'my_times_watched', int),
+                        'notes': elem.findtext('my_comments', '')
+                    }
+                except ValueError as e:
+                    if malformed is not None:
+                        malformed.append((title, str(e)))
+                    entry = None
+                root.clear()
+                if entry is not None:
+                    yield entry
+
+
+# A number field of an export entry, missing or empty ones are 0
+def parse_mal_number(elem, tag, type_):
+    text = (elem.findtext(tag, '') or '').strip()
+    try:
+        return type_(text) if text else 0
+    except ValueError:
+        raise ValueError(f'{tag} {text!r} is not a number') from None
+
+
+# A yyyy-mm-dd date field of an export entry as year, month and day like AniList's fuzzy dates. MAL
+# writes 00 for the parts it doesn't know, and 0000-00-00 for no date, those parts become None.
+def parse_mal_date(elem, tag):
+    text = (elem.findtext(tag, '') or '').strip() or '0000-00-00'
+    parts = text.split('-')
+    if len(parts) != 3 or not all(part.isdigit() for part in parts):
+        raise ValueError(f'{tag} {text!r} is not a date')
+    year, month, day = (int(part) or None for part in parts)
+    return {'year': year, 'month': month, 'day': day}
+
+
+# Writes import rows as a json array or, for .csv file names, as csv, only replacing file_name once complete
+class ImportWriter:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.count = 0
+        fd, self.tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)), suffix='.tmp')
+        self.file = os.fdopen(fd, 'w', encoding='utf-8', newline='')
+        self.csv = None
+        if file_name.lower().endswith('.csv'):
+            self.csv = csv.DictWriter(self.file, IMPORT_CSV_FIELDS)
+            self.csv.writeheader()
+        else:
+            self.file.write('[')
+
+    def write(self, row):
+        if self.csv is not None:
+            row = dict(row)
+            for field in IMPORT_DATE_FIELDS:
+                row.update((f'{field}_{part}', value) for part, value in row.pop(field).items())
+            self.csv.writerow(row)
+        else:
+            self.file.write((',\n' if self.count else '\n') + json.dumps(row, ensure_ascii=False))
+        self.count += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.csv is None:
+            self.file.write('\n]\n' if self.count else ']\n')
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.file_name)
+        else:
+            os.remove(self.tmp_path)
+
+
+# Map a MAL anime export to AniList ids through the offline database's reverse index. Mapped entries are
+# written to output, the ones without an AniList id, or with a status AniList has no equivalent for, to
+# unmapped_output. Malformed entries are reported on stderr. Returns the mapped, unmapped and malformed counts.
+def import_mal_export(path, output, unmapped_output):
+    mal_to_anilist = get_id_store().mal_to_anilist
+    malformed = []
+    with ImportWriter(output) as mapped, ImportWriter(unmapped_output) as unmapped:
+        for entry in iter_mal_export(path, malformed):
+            if entry['mal_id'] is not None:
+                entry['anilist_id'] = mal_to_anilist.get(entry['mal_id'])
+            importable = entry['anilist_id'] is not None and entry['status'] in IMPORT_STATUSES
+            (mapped if importable else unmapped).write(entry)
+    for title, error in malformed:
+        print(f'Skipped malformed entry "{title}": {error}', file=sys.stderr)
+    return mapped.count, unmapped.count, len(malformed)
+
+
+# tkinter is only imported when the window is opened, so headless runs work without Tk installed
+def import_tkinter():
+    global tk, ttk, messagebox
+    import tkinter as tk
+    from tkinter import ttk, messagebox
+
+
+# Stream the MAL export to an open text file such as sys.stdout, reporting left out entries on stderr
+def write_mal_xml(anime_list, out, xml_username, media_type='ANIME'):
+    mal_ids, unresolved, title_matched = resolve_anime_mal_ids(anime_list, mal_id_cache, media_type)
+    for chunk in generate_mal_xml(anime_list, xml_username, mal_ids=mal_ids, media_type=media_type):
+        out.write(chunk)
+    out.flush()
+    report_unresolved(unresolved, sys.stderr)
+    report_title_matches(title_matched, sys.stderr)
+
+
+def print_timing(stage, started_at):
+    print(f'{stage}: {(time.perf_counter() - started_at) * 1000:.1f} ms', file=sys.stderr)
 
 
+# Convert one user without opening the window. file_names maps each of media_types to the file its
+# export is written to, '-' writes to stdout. Several lists are fetched concurrently.
+def run_cli(anilist_username, xml_username, file_names, since=None, timings=False, media_types=('ANIME',)):
+    if timings:
+        print_timing('startup', STARTED_AT)
+    started_at = time.perf_counter()
+    lists = load_user_lists(anilist_username, media_types)
+    if not any(lists.values()):
+        kind = ' and '.join(media_type.lower() for media_type in media_types)
+        raise Exception(f'Error fetching {kind} list or no {kind} found')
+    if timings:
+        print_timing('fetch', started_at)
+        started_at = time.perf_counter()
+    for media_type, anime_list in lists.items():
+        anime_list = anime_list or []
+        if since is not None:
+            anime_list = [anime for anime in anime_list if anime.updated_at >= since]
+        file_name = file_names[media_type]
+        if file_name == '-':
+            write_mal_xml(anime_list, sys.stdout, xml_username, media_type)
+            continue
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                write_mal_xml(anime_list, f, xml_username, media_type)
+            os.replace(tmp_path, file_name)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    if timings:
+        print_timing('write', started_at)
+        print_timing('total', STARTED_AT)
+
+
+# The conversion and the offline database load run on worker threads that never touch the widgets.
+# They send events to self.events instead, which the Tk main loop drains every EVENT_POLL_INTERVAL ms.
 class AnimeListConverterApp:
     def __init__(self, root):
         self.root = root
         self.root.title("AniList to XML Converter")
-        self.root.geometry("600x400")
+        self.root.geometry("600x460")
         self.root.configure(bg='#f0f0f0')
 
         style = ttk.Style()
@@ -215,23 +1499,49 @@ class AnimeListConverterApp:
         self.xml_username_entry = ttk.Entry(main_frame, width=30)
         self.xml_username_entry.grid(row=1, column=1, pady=5)
 
+        self.progress_bar = ttk.Progressbar(main_frame, orient=tk.HORIZONTAL, mode='determinate')
+        self.progress_bar.grid(row=2, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(10, 0))
+        self.status_label = ttk.Label(main_frame, text="")
+        self.status_label.grid(row=3, column=0, columnspan=2, sticky=tk.W)
+
         self.output_text = tk.Text(main_frame, wrap=tk.WORD, height=10, width=80, state=tk.DISABLED, bg='#e0e0e0', font=("Helvetica", 10))
-        self.output_text.grid(row=3, column=0, columnspan=2, pady=10)
+        self.output_text.grid(row=4, column=0, columnspan=2, pady=10)
         self.output_text.tag_config("error", foreground="red")
 
         self.convert_button = ttk.Button(main_frame, text="Convert", command=self.on_convert_button_click)
-        self.convert_button.grid(row=4, column=0, pady=10)
+        self.convert_button.grid(row=5, column=0, pady=10)
 
         self.cancel_button = ttk.Button(main_frame, text="Cancel", command=self.on_cancel_button_click)
-        self.cancel_button.grid(row=4, column=1, pady=10)
+        self.cancel_button.grid(row=5, column=1, pady=10)
 
+        self.events = queue.Queue()
         self.process = None
-        self.timer_running = False
+        self.running = False
         self.start_time = None
+        self.stage = None  # Last progress event as (stage, count, total)
+        self.stage_started_at = {}  # When the first progress event of each stage arrived
 
         self.root.protocol("WM_DELETE_WINDOW", self.on_exit)
+        threading.Thread(target=self.load_database, daemon=True).start()
+        self.root.after(EVENT_POLL_INTERVAL, self.poll_events)
+
+    # Load the offline database while the window is already up, conversions wait for it if it isn't done yet
+    def load_database(self):
+        try:
+            get_id_store()
+            self.events.put(('database', None))
+        except Exception as e:
+            self.events.put(('database', str(e)))
+
+    def log(self, text, *tags):
+        self.output_text.config(state=tk.NORMAL)
+        self.output_text.insert(tk.END, text, tags)
+        self.output_text.config(state=tk.DISABLED)
+        self.output_text.see(tk.END)
 
     def on_convert_button_click(self):
+        if self.running:
+            return
         anilist_username = self.anilist_username_entry.get().strip()
         xml_username = self.xml_username_entry.get().strip()
 
@@ -241,76 +1551,170 @@ class AnimeListConverterApp:
 
         self.output_text.config(state=tk.NORMAL)
         self.output_text.delete(1.0, tk.END)
-        self.output_text.insert(tk.END, "This will take a few minutes if you have a long list due to Jikan API rate limiting. Please wait...\n")
-        self.output_text.insert(tk.END, "00:00\n")
         self.output_text.config(state=tk.DISABLED)
+        self.log("Fetching your list from AniList...\n")
+        self.progress_bar.config(value=0, maximum=1)
 
         cancel_event.clear()
+        self.running = True
+        self.start_time = time.monotonic()
+        self.stage = None
+        self.stage_started_at = {}
+        self.convert_button.state(['disabled'])
+        self.update_status()
         self.start_conversion_thread(anilist_username, xml_username)
 
+    # Only asks the worker to stop, it reports back with a cancelled event once it has
     def on_cancel_button_click(self):
-        cancel_event.set()
-        if self.process and self.process.is_alive():
-            self.timer_running = False
-            self.process.join()
-            self.output_text.config(state=tk.NORMAL)
-            self.output_text.insert(tk.END, "\nProcess cancelled.\n")
-            self.output_text.config(state=tk.DISABLED)
-            print("Process cancelled.")
+        if self.running and not cancel_event.is_set():
+            cancel_event.set()
+            self.status_label.config(text="Cancelling...")
 
     def on_exit(self):
-        self.on_cancel_button_click()
+        cancel_event.set()
         self.root.destroy()
 
     def run_conversion(self, anilist_username, xml_username):
+        unresolved = []
         try:
-            global ANILIST_USERNAME, XML_USERNAME
-            ANILIST_USERNAME = anilist_username
-            XML_USERNAME = xml_username
-            self.start_timer()
-            anime_list = fetch_user_anime_list()
-            if anime_list:
-                create_mal_xml(anime_list, 'myanimelist.xml')
-            self.stop_timer()
-            if not cancel_event.is_set():
-                self.output_text.config(state=tk.NORMAL)
-                self.output_text.insert(tk.END, "\nMAL XML file created successfully.\n")
-                self.output_text.config(state=tk.DISABLED)
-                messagebox.showinfo("Success", "MAL XML file created successfully.")
+            anime_list = fetch_user_anime_list(anilist_username)
+            if anime_list is not None:
+                if not anime_list:
+                    raise Exception('Error fetching anime list or no anime found')
+                self.events.put(('progress', 'fetched', len(anime_list), len(anime_list)))
+                unresolved = create_mal_xml(anime_list, 'myanimelist.xml', xml_username,
+                                            progress=lambda stage, count, total: self.events.put(('progress', stage, count, total)))
+            if cancel_event.is_set():
+                self.events.put(('cancelled',))
+            else:
+                self.events.put(('done', len(unresolved)))
         except Exception as e:
-            self.stop_timer()
-            if not cancel_event.is_set():
-                self.output_text.config(state=tk.NORMAL)
-                self.output_text.insert(tk.END, f"\nAn error occurred: {str(e)}\n", "error")
-                self.output_text.config(state=tk.DISABLED)
-                self.output_text.see(tk.END)
-                messagebox.showerror("Error", f"An error occurred: {str(e)}")
+            self.events.put(('cancelled',) if cancel_event.is_set() else ('error', str(e)))
 
     def start_conversion_thread(self, anilist_username, xml_username):
-        self.process = threading.Thread(target=self.run_conversion, args=(anilist_username, xml_username))
+        self.process = threading.Thread(target=self.run_conversion, args=(anilist_username, xml_username), daemon=True)
         self.process.start()
 
-    def start_timer(self):
-        self.timer_running = True
-        self.start_time = time.time()
-        threading.Thread(target=self.update_timer).start()
+    def poll_events(self):
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            self.handle_event(event)
+        if self.running:
+            self.update_status()
+        self.root.after(EVENT_POLL_INTERVAL, self.poll_events)
 
-    def stop_timer(self):
-        self.timer_running = False
+    def handle_event(self, event):
+        kind = event[0]
+        if kind == 'database':
+            if event[1] is not None:
+                self.log(f"Could not load the offline database, it will be retried when converting: {event[1]}\n", "error")
+        elif kind == 'progress':
+            _, stage, count, total = event
+            self.stage_started_at.setdefault(stage, time.monotonic())
+            self.stage = (stage, count, total)
+            if stage == 'mapped':
+                self.progress_bar.config(maximum=max(total, 1), value=count)
+        elif kind == 'done':
+            self.finish()
+            self.progress_bar.config(value=self.progress_bar['maximum'])
+            if event[1]:
+                self.log(f"{event[1]} entries have no MAL id and were left out.\n")
+            self.log("MAL XML file created successfully.\n")
+            messagebox.showinfo("Success", "MAL XML file created successfully.")
+        elif kind == 'error':
+            self.finish()
+            self.log(f"An error occurred: {event[1]}\n", "error")
+            messagebox.showerror("Error", f"An error occurred: {event[1]}")
+        elif kind == 'cancelled':
+            self.finish()
+            self.log("Process cancelled.\n")
+            print("Process cancelled.")
+
+    def finish(self):
+        self.running = False
+        self.update_status()
+        self.convert_button.state(['!disabled'])
 
-    def update_timer(self):
-        while self.timer_running:
-            elapsed_time = time.time() - self.start_time
-            minutes, seconds = divmod(elapsed_time, 60)
-            timer_text = f"{int(minutes):02}:{int(seconds):02}"
-            self.output_text.config(state=tk.NORMAL)
-            self.output_text.delete("end-2l", "end-1l")
-            self.output_text.insert(tk.END, f"{timer_text}\n")
-            self.output_text.config(state=tk.DISABLED)
-            time.sleep(1)
+    def update_status(self):
+        minutes, seconds = divmod(int(time.monotonic() - self.start_time), 60)
+        if cancel_event.is_set():
+            text = "Cancelling..." if self.running else "Cancelled"
+        elif self.stage is None:
+            text = "Fetching list"
+        else:
+            stage, count, total = self.stage
+            text = {'fetched': f"Fetched {count} entries", 'mapped': f"Mapped {count} entries to MAL ids"}.get(stage, f"Written {count}/{total} entries")
+            elapsed = time.monotonic() - self.stage_started_at[stage]
+            if stage == 'written' and elapsed > 0:
+                text += f" ({count / elapsed:.0f} entries/s)"
+        self.status_label.config(text=f"{minutes:02}:{seconds:02}  {text}")
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Convert AniList anime lists to importable MyAnimeList XML files.')
+    parser.add_argument('--user', help='AniList user to convert without opening the window')
+    parser.add_argument('--xml-user', help='username written into the XML, defaults to --user')
+    parser.add_argument('-o', '--output', default='myanimelist.xml', help="file the --user anime XML is written to, '-' for stdout")
+    parser.add_argument('--media', choices=['anime', 'manga', 'both'], default='anime', help='which --user lists to export, both are fetched concurrently')
+    parser.add_argument('--manga-output', default='myanimelist-manga.xml', help="file the --user manga XML is written to, '-' for stdout")
+    parser.add_argument('--offline-db', metavar='PATH', help='use this anime-offline-database json (or its .idx mapping store) instead of downloading it')
+    parser.add_argument('--timings', action='store_true', help='print how long each stage took to stderr')
+    parser.add_argument('--batch', nargs='+', metavar='USER[:XML_USER]', help='convert these AniList users without opening the window; the XML username defaults to the AniList one')
+    parser.add_argument('--output-dir', default='.', help='directory the --batch XML files are written to')
+    parser.add_argument('--snapshot-db', metavar='PATH', help='keep list snapshots in this SQLite file and only fetch entries changed since the last run')
+    parser.add_argument('--since', type=int, metavar='TIMESTAMP', help='only export entries updated at or after this unix timestamp')
+    parser.add_argument('--match-titles', action='store_true', help='match entries without any MAL id by title, type, episodes and year')
+    parser.add_argument('--import-mal', metavar='FILE', help='map a MAL anime export (.xml or .xml.gz) to AniList ids instead of converting')
+    parser.add_argument('--import-output', default='anilist-import.json', help='file the --import-mal entries are written to, .csv for csv; '
+                                                                               'entries without an AniList id go to the same name with -unmapped')
+    args = parser.parse_args()
+
+    global snapshot_store, TITLE_MATCHING
+    if args.match_titles:
+        TITLE_MATCHING = True
+    if args.snapshot_db:
+        snapshot_store = SnapshotStore(args.snapshot_db)
+
+    if args.offline_db:
+        base, ext = os.path.splitext(args.offline_db)
+        load_anime_offline_database(base + '.json' if ext == '.idx' else args.offline_db, base + '.idx')
+
+    if args.import_mal:
+        base, ext = os.path.splitext(args.import_output)
+        unmapped_output = f'{base}-unmapped{ext}'
+        try:
+            mapped, unmapped, malformed = import_mal_export(args.import_mal, args.import_output, unmapped_output)
+        except (OSError, ValueError, ET.ParseError) as e:
+            print(f'Error: {e}', file=sys.stderr)
+            sys.exit(1)
+        print(f'{mapped} entries mapped to AniList ids in {args.import_output}, {unmapped} left out in {unmapped_output}'
+              + (f', {malformed} malformed entries skipped.' if malformed else '.'))
+        return
+
+    if args.user:
+        try:
+            media_types = ('ANIME', 'MANGA') if args.media == 'both' else (args.media.upper(),)
+            run_cli(args.user, args.xml_user or args.user, {'ANIME': args.output, 'MANGA': args.manga_output},
+                    args.since, args.timings, media_types)
+        except Exception as e:
+            print(f'Error: {e}', file=sys.stderr)
+            sys.exit(1)
+        return
+
+    if args.batch:
+        users = []
+        for user in args.batch:
+            anilist_username, _, xml_username = user.partition(':')
+            users.append((anilist_username, xml_username or anilist_username))
+        results = convert_users(users, args.output_dir, since=args.since)
+        failed = [user for user, error in results.items() if error]
+        print(f'{len(results) - len(failed)} of {len(results)} users converted.')
+        sys.exit(1 if failed else 0)
+
+    import_tkinter()
     root = tk.Tk()
     app = AnimeListConverterApp(root)
     root.mainloop()
@@ -0,0 +1,311 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import contextlib
+import platform
+import statistics
+import subprocess
+import shutil
+import tempfile
+import threading
+import tracemalloc
+import importlib.util
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Offline benchmark of the conversion pipeline. Everything runs against a synthetic offline database
+# and a local stub of the AniList GraphQL API, so results are comparable between commits.
+#
+#   python benchmark.py --sizes 10 1000 20000 --db-size 35000 --output bench.json
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATUSES = ['CURRENT', 'COMPLETED', 'PAUSED', 'DROPPED', 'PLANNING', 'REPEATING']
+FORMATS = ['TV', 'MOVIE', 'OVA', 'ONA', 'SPECIAL', 'MUSIC', 'TV_SHORT']
+
+
+# Offline database shaped like anime-offline-database.json. About 1 in 12 entries has no MAL source
+# and 1 in 15 no AniList source, like the real file.
+def generate_offline_database(size, seed=0):
+    rng = random.Random(seed)
+    data = []
+    for i in range(1, size + 1):
+        sources = [f'https://anidb.net/anime/{i}', f'https://kitsu.app/anime/{i}']
+        if i % 15:
+            sources.append(f'https://anilist.co/anime/{i}')
+        if i % 12:
+            sources.append(f'https://myanimelist.net/anime/{i + 50000}')
+        data.append({
+            'sources': sources,
+            'title': f'Synthetic Anime {i}',
+            'type': rng.choice(['TV', 'MOVIE', 'OVA', 'ONA', 'SPECIAL']),
+            'episodes': rng.randint(1, 50),
+            'status': 'FINISHED',
+            'animeSeason': {'season': 'SPRING', 'year': 1980 + i % 45},
+            'picture': f'https://cdn.example/{i}.jpg',
+            'thumbnail': f'https://cdn.example/{i}t.jpg',
+            'synonyms': [f'Synthetic {i}', f'SA{i}'],
+            'relatedAnime': [],
+            'tags': rng.sample(['action', 'comedy', 'drama', 'romance', 'sci-fi'], 2)
+        })
+    return {'data': data}
+
+
+def synthetic_date(rng):
+    if rng.random() < 0.3:
+        return {'year': None, 'month': None, 'day': None}
+    return {'year': rng.randint(2000, 2024), 'month': rng.randint(1, 12), 'day': rng.randint(1, 28)}
+
+
+# MediaListCollection response with size entries spread over the usual lists, plus a custom list
+# repeating every 10th entry the way AniList repeats entries that are in custom lists.
+# 1 in 20 entries comes without an idMal, so the offline database index gets used too. Manga lists
+# have chapters and volumes instead of episodes.
+def generate_media_list_collection(size, db_size, seed=0, media_type='ANIME'):
+    rng = random.Random(seed)
+    lists = {}
+    anilist_ids = rng.sample(range(1, db_size + 1), size) if size <= db_size else [rng.randint(1, db_size) for _ in range(size)]
+    for i, anilist_id in enumerate(anilist_ids):
+        status = rng.choice(STATUSES)
+        entry = {
+            'media': {
+                'id': anilist_id,
+                'idMal': anilist_id + 50000 if i % 20 else None,
+                'title': {'english': None if i % 4 == 0 else f'Synthetic Anime {anilist_id}', 'romaji': f'Gousei Anime {anilist_id}'},
+                'episodes': rng.randint(1, 50),
+                'format': rng.choice(FORMATS),
+                'seasonYear': 1980 + anilist_id % 45
+            },
+            'score': rng.choice([0, 5, 7.5, 10]),
+            'progress': rng.randint(0, 50),
+            'startedAt': synthetic_date(rng),
+            'completedAt': synthetic_date(rng),
+            'status': status,
+            'updatedAt': 1600000000 + i
+        }
+        if media_type == 'MANGA':
+            entry['media']['chapters'] = entry['media'].pop('episodes') * 4
+            entry['media']['volumes'] = entry['media']['chapters'] // 8
+            entry['progressVolumes'] = entry['progress'] // 8
+        lists.setdefault(status, []).append(entry)
+        if i % 10 == 0:
+            lists.setdefault('Favourites', []).append(entry)
+    return {'data': {'MediaListCollection': {'lists': [{'name': name, 'entries': entries} for name, entries in lists.items()]}}}
+
+
+# Local stand-in for AniList and the offline database download. Users are named bench_<size>.
+class StubServer:
+    def __init__(self, offline_db_bytes, db_size):
+        self.offline_db_bytes = offline_db_bytes
+        self.offline_db_etag = '"%s"' % hashlib.sha1(offline_db_bytes).hexdigest()
+        self.db_size = db_size
+        self.payloads = {}
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def send_body(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.headers.get('If-None-Match') == stub.offline_db_etag:
+                    self.send_response(304)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', stub.offline_db_etag)
+                self.send_header('Content-Length', str(len(stub.offline_db_bytes)))
+                self.end_headers()
+                self.wfile.write(stub.offline_db_bytes)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                username = request.get('variables', {}).get('userName', '')
+                if not username.startswith('bench_') or not username[len('bench_'):].isdigit():
+                    body = json.dumps({'errors': [{'message': 'Not Found.', 'status': 404}], 'data': None}).encode('utf-8')
+                    self.send_body(404, body, 'application/json')
+                    return
+                media_type = request['variables'].get('type') or 'ANIME'
+                self.send_body(200, stub.payload(int(username[len('bench_'):]), media_type), 'application/json')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def payload(self, size, media_type='ANIME'):
+        with self.lock:
+            if (size, media_type) not in self.payloads:
+                collection = generate_media_list_collection(size, self.db_size, seed=size, media_type=media_type)
+                self.payloads[size, media_type] = json.dumps(collection).encode('utf-8')
+            return self.payloads[size, media_type]
+
+    def close(self):
+        self.server.shutdown()
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# Best wall time over repeat runs, plus the peak traced memory of one extra run
+def measure(fn, repeat, entries=None):
+    times = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started_at)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = {'seconds': min(times), 'median_seconds': statistics.median(times), 'peak_bytes': peak}
+    if entries:
+        result['entries_per_second'] = entries / min(times) if min(times) else None
+    return result
+
+
+def bench_desktop(module, sizes, repeat, work_dir):
+    results = {}
+    module.get_id_store().open()
+    for size in sizes:
+        username = f'bench_{size}'
+        anime_list = module.fetch_user_anime_list(username)
+        anilist_ids = [anime.anilist_id for anime in anime_list]
+        file_name = os.path.join(work_dir, f'desktop_{size}.xml')
+        with contextlib.redirect_stdout(sys.stderr):
+            results[size] = {
+                'fetch': measure(lambda: module.fetch_user_anime_list(username), repeat, size),
+                'map': measure(lambda: module.resolve_anime_mal_ids(anime_list), repeat, size),
+                'fetch_mal_id': measure(lambda: [module.fetch_mal_id(anilist_id) for anilist_id in anilist_ids], repeat, size),
+                'xml': measure(lambda: module.create_mal_xml(anime_list, file_name, 'bench'), repeat, size),
+                'total': measure(lambda: module.create_mal_xml(module.fetch_user_anime_list(username), file_name, 'bench'), repeat, size)
+            }
+    return results
+
+
+def bench_flask(module, sizes, repeat):
+    results = {}
+    client = module.app.test_client()
+    module.id_store.open()
+
+    def convert(username):
+        response = client.post('/convert', json={'anilist_username': username, 'xml_username': 'bench'})
+        response.get_data()
+        if response.status_code != 200:
+            raise Exception(f'/convert returned HTTP {response.status_code}: {response.get_data(as_text=True)[:200]}')
+
+    def convert_cold(username):
+        with module.result_cache.lock:
+            module.result_cache.entries.clear()
+            module.result_cache.size = 0
+        convert(username)
+
+    for size in sizes:
+        username = f'bench_{size}'
+        anime_list = module.fetch_user_anime_list(username)
+        results[size] = {
+            'fetch': measure(lambda: module.fetch_user_anime_list(username), repeat, size),
+            'map': measure(lambda: module.resolve_anime_mal_ids(anime_list), repeat, size),
+            'xml': measure(lambda: module.create_mal_xml(anime_list, 'bench'), repeat, size),
+            'convert_cold': measure(lambda: convert_cold(username), repeat, size),
+            'convert_cached': measure(lambda: convert(username), repeat, size)
+        }
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(path_name, results):
+    for size, stages in results.items():
+        for stage, result in stages.items():
+            rate = result.get('entries_per_second')
+            rate = f'{rate:12.0f} entries/s' if rate else ''
+            print(f'{path_name:8} {size:>6} {stage:15} {result["seconds"] * 1000:10.2f} ms {result["peak_bytes"] / 1024 / 1024:8.2f} MiB {rate}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the AniList to MAL XML conversion pipeline offline.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 5000, 20000], help='list sizes to convert')
+    parser.add_argument('--db-size', type=int, default=35000, help='entries in the synthetic offline database')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage, the best one is reported')
+    parser.add_argument('--paths', nargs='+', choices=['desktop', 'flask'], default=['desktop', 'flask'])
+    parser.add_argument('--output', help='write machine-readable results to this json file')
+    args = parser.parse_args()
+
+    started_at = time.perf_counter()
+    offline_db_bytes = json.dumps(generate_offline_database(args.db_size)).encode('utf-8')
+    stub = StubServer(offline_db_bytes, args.db_size)
+    print(f'Synthetic offline database with {args.db_size} entries ({len(offline_db_bytes) / 1024 / 1024:.1f} MiB) '
+          f'generated in {time.perf_counter() - started_at:.1f} s', file=sys.stderr)
+
+    # Holds the offline database copy, its index and the desktop exports, removed once the run is over
+    work_dir = tempfile.mkdtemp(prefix='anilist-bench-')
+    os.environ.update({
+        'OFFLINE_DB_URL': stub.url + '/anime-offline-database.json',
+        'OFFLINE_DB_DIR': work_dir,
+        'OFFLINE_DB_REFRESH_INTERVAL': '0',
+        'ANILIST_API_URL': stub.url,
+        'ANILIST_RATE_LIMIT': '1000000',
+        'RESULT_CACHE_DIR': '',
+        'SNAPSHOT_DB': '',
+        'MAL_ID_CACHE': ''
+    })
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'db_size': args.db_size,
+        'repeat': args.repeat,
+        'results': {}
+    }
+    try:
+        if 'desktop' in args.paths:
+            started_at = time.perf_counter()
+            module = load_module('anime_list_converter', os.path.join(ROOT, 'anime_list_converter.py'))
+            module.anilist_client = module.AniListClient(url=stub.url, requests_per_minute=1000000)
+            module.get_id_store()
+            report['desktop_startup_seconds'] = time.perf_counter() - started_at
+            report['results']['desktop'] = bench_desktop(module, args.sizes, args.repeat, work_dir)
+            print_results('desktop', report['results']['desktop'])
+        if 'flask' in args.paths:
+            started_at = time.perf_counter()
+            module = load_module('app', os.path.join(ROOT, 'Docker', 'app.py'))
+            report['flask_startup_seconds'] = time.perf_counter() - started_at
+            report['results']['flask'] = bench_flask(module, args.sizes, args.repeat)
+            print_results('flask', report['results']['flask'])
+    finally:
+        stub.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
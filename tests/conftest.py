@@ -0,0 +1,160 @@
+import hashlib
+import importlib.util
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Offline database shaped like anime-offline-database.json: entry i is AniList id i and MAL id i + 50000,
+# every 12th entry has no MAL source
+def offline_database_bytes(size=200):
+    data = []
+    for i in range(1, size + 1):
+        sources = [f'https://anidb.net/anime/{i}', f'https://anilist.co/anime/{i}']
+        if i % 12:
+            sources.append(f'https://myanimelist.net/anime/{i + 50000}')
+        data.append({'sources': sources, 'title': f'Test Anime {i}', 'type': 'TV', 'episodes': 12, 'synonyms': []})
+    return json.dumps({'data': data}).encode('utf-8')
+
+
+def error_body(message, status):
+    return json.dumps({'errors': [{'message': message, 'status': status}], 'data': None}).encode('utf-8')
+
+
+# One entry of a MediaListCollection or Page response, AniList id i is MAL id i + 50000 as in the offline database
+def list_entry(anilist_id, updated_at=0, **media):
+    return {
+        'media': dict({'id': anilist_id, 'idMal': anilist_id + 50000, 'title': {'english': f'Anime {anilist_id}', 'romaji': f'Anime Romaji {anilist_id}'},
+                       'episodes': 12, 'format': 'TV', 'seasonYear': 2020}, **media),
+        'score': 8, 'progress': 3,
+        'startedAt': {'year': 2021, 'month': 2, 'day': 3}, 'completedAt': {'year': None, 'month': None, 'day': None},
+        'status': 'CURRENT', 'updatedAt': updated_at,
+    }
+
+
+def media_list_collection(*entries):
+    return {'MediaListCollection': {'lists': [{'name': 'Watching', 'entries': list(entries)}]}}
+
+
+# Local stand-in for the offline database download, revalidated by ETag, and for the AniList GraphQL API.
+# AniList answers with the response registered in lists for the queried user, 404 for anyone else.
+# It records the requests it receives.
+class StubServer:
+    def __init__(self):
+        self.set_offline_database(offline_database_bytes())
+        self.lists = {}  # userName -> response data
+        self.requests = []  # (method, path, headers) of every request received
+        self.queued_responses = []  # (status, headers, body) sent to the next AniList requests, in order
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send_body(self, status, headers, body):
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                stub.requests.append(('GET', self.path, dict(self.headers)))
+                if self.headers.get('If-None-Match') == stub.offline_db_etag:
+                    self.send_response(304)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', stub.offline_db_etag)
+                self.send_header('Content-Length', str(len(stub.offline_db_bytes)))
+                self.end_headers()
+                self.wfile.write(stub.offline_db_bytes)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                stub.requests.append(('POST', self.path, dict(self.headers)))
+                with stub.lock:
+                    queued = stub.queued_responses.pop(0) if stub.queued_responses else None
+                if queued is not None:
+                    self.send_body(*queued)
+                    return
+                data = stub.lists.get(request.get('variables', {}).get('userName'))
+                if data is None:
+                    self.send_body(404, {'Content-Type': 'application/json'}, error_body('Not Found.', 404))
+                    return
+                self.send_body(200, {'Content-Type': 'application/json'}, json.dumps({'data': data}).encode('utf-8'))
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    # Serve a new copy of the offline database from now on, with its own ETag
+    def set_offline_database(self, offline_db_bytes):
+        self.offline_db_bytes = offline_db_bytes
+        self.offline_db_etag = '"%s"' % hashlib.sha1(offline_db_bytes).hexdigest()
+
+    def reset(self):
+        self.set_offline_database(offline_database_bytes())
+        self.lists.clear()
+        self.requests.clear()
+        self.queued_responses.clear()
+
+    def anilist_requests(self):
+        return [headers for method, path, headers in self.requests if method == 'POST']
+
+    def close(self):
+        self.server.shutdown()
+
+
+@pytest.fixture(scope='session')
+def session_stub():
+    stub = StubServer()
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def stub(session_stub):
+    session_stub.reset()
+    return session_stub
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def use_stub(stub, tmp_path, monkeypatch):
+    monkeypatch.setenv('OFFLINE_DB_URL', stub.url + '/anime-offline-database.json')
+    monkeypatch.setenv('OFFLINE_DB_DIR', str(tmp_path))
+    monkeypatch.setenv('OFFLINE_DB_REFRESH_INTERVAL', '0')
+    monkeypatch.setenv('ANILIST_API_URL', stub.url)
+
+
+# The web app reads its settings from the environment when it is loaded, so every test loads a fresh
+# copy pointed at the stub and its own cache directory. Loading it downloads the offline database.
+@pytest.fixture
+def web_app(stub, tmp_path, monkeypatch):
+    use_stub(stub, tmp_path, monkeypatch)
+    return load_module('app', os.path.join(ROOT, 'Docker', 'app.py'))
+
+
+# The desktop script, set up the same way. It downloads the offline database when it first needs it.
+@pytest.fixture
+def converter(stub, tmp_path, monkeypatch):
+    use_stub(stub, tmp_path, monkeypatch)
+    return load_module('anime_list_converter', os.path.join(ROOT, 'anime_list_converter.py'))
@@ -0,0 +1,87 @@
+import json
+import time
+
+import pytest
+
+from conftest import error_body
+
+LIST_QUERY = 'query ($userName: String) { MediaListCollection(userName: $userName, type: ANIME) { lists { name } } }'
+LIST_DATA = {'MediaListCollection': {'lists': [{'name': 'Watching'}]}}
+
+
+@pytest.fixture
+def client(web_app, stub, monkeypatch):
+    monkeypatch.setattr(web_app, 'ANILIST_BACKOFF_BASE', 0.01)
+    stub.lists['test_user'] = LIST_DATA
+    return web_app.AniListClient(requests_per_minute=6000, max_retries=2)
+
+
+def test_rate_limited_request_waits_for_retry_after(client, stub):
+    stub.queued_responses.append((429, {'Retry-After': '1'}, error_body('Too Many Requests.', 429)))
+    started_at = time.monotonic()
+    assert client.query(LIST_QUERY, {'userName': 'test_user'}) == LIST_DATA
+    assert time.monotonic() - started_at >= 1
+    assert len(stub.anilist_requests()) == 2
+
+
+def test_rate_limit_error_after_last_retry(web_app, client, stub):
+    client.max_retries = 0
+    stub.queued_responses.append((429, {'Retry-After': '7'}, error_body('Too Many Requests.', 429)))
+    with pytest.raises(web_app.AniListRateLimitError) as excinfo:
+        client.query(LIST_QUERY, {'userName': 'test_user'})
+    assert excinfo.value.retry_after == 7
+    assert client.limiter.paused_until > time.monotonic() + 5
+
+
+def test_remaining_requests_header_limits_tokens(client, stub):
+    body = json.dumps({'data': LIST_DATA}).encode('utf-8')
+    stub.queued_responses.append((200, {'X-RateLimit-Remaining': '0'}, body))
+    client.query(LIST_QUERY, {'userName': 'test_user'})
+    assert client.limiter.tokens == 0
+
+
+def test_missing_user_raises_not_found_without_retrying(web_app, client, stub):
+    with pytest.raises(web_app.AniListNotFoundError):
+        client.query(LIST_QUERY, {'userName': 'nobody'})
+    assert len(stub.anilist_requests()) == 1
+
+
+def test_server_error_is_retried(client, stub):
+    stub.queued_responses.append((502, {}, b'Bad Gateway'))
+    assert client.query(LIST_QUERY, {'userName': 'test_user'}) == LIST_DATA
+    assert len(stub.anilist_requests()) == 2
+
+
+def test_server_errors_surface_as_transport_error(web_app, client, stub):
+    stub.queued_responses.extend([(503, {}, b'Unavailable')] * 3)
+    with pytest.raises(web_app.AniListTransportError):
+        client.query(LIST_QUERY, {'userName': 'test_user'})
+    assert len(stub.anilist_requests()) == 3
+
+
+def test_convert_reports_missing_user_as_404(web_app, stub):
+    response = web_app.app.test_client().post('/convert', json={'anilist_username': 'nobody', 'xml_username': 'x'})
+    assert response.status_code == 404
+
+
+def test_convert_reports_rate_limit_as_429_with_retry_after(web_app, stub, monkeypatch):
+    monkeypatch.setattr(web_app.anilist_client, 'max_retries', 0)
+    stub.queued_responses.append((429, {'Retry-After': '30'}, error_body('Too Many Requests.', 429)))
+    response = web_app.app.test_client().post('/convert', json={'anilist_username': 'test_user', 'xml_username': 'x'})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '30'
+
+
+def test_failed_streamed_responses_are_closed_before_retrying(web_app, client, stub, monkeypatch):
+    responses = []
+    post = client.session.post
+
+    def recording_post(*args, **kwargs):
+        responses.append(post(*args, **kwargs))
+        return responses[-1]
+
+    monkeypatch.setattr(client.session, 'post', recording_post)
+    stub.queued_responses.extend([(429, {'Retry-After': '0'}, error_body('Too Many Requests.', 429)), (502, {}, b'Bad Gateway')])
+    assert client.query(LIST_QUERY, {'userName': 'test_user'}, parse=web_app.parse_media_list_collection) == []
+    assert len(responses) == 3
+    assert all(response.raw.closed for response in responses)
@@ -0,0 +1,71 @@
+import gzip
+import zlib
+
+import pytest
+
+from conftest import list_entry, media_list_collection
+
+
+@pytest.fixture
+def client(web_app, stub):
+    stub.lists['test_user'] = media_list_collection(*(list_entry(i) for i in range(1, 40)))
+    return web_app.app.test_client()
+
+
+def download(client, headers=None):
+    return client.get('/convert', query_string={'anilist_username': 'test_user', 'xml_username': 'x', 'format': 'xml'},
+                      headers=headers)
+
+
+def test_xml_is_sent_as_file_download(client):
+    response = download(client)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/xml'
+    assert response.headers['Content-Disposition'] == 'attachment; filename="test_user.xml"'
+    assert response.headers['X-Unresolved-Count'] == '0'
+    assert response.data.startswith(b'<?xml')
+
+
+@pytest.mark.parametrize('coding, decompress', [('gzip', gzip.decompress), ('deflate', zlib.decompress)])
+def test_compressed_download(client, coding, decompress):
+    plain = download(client).data
+    for _ in range(2):  # Compressed while generated, then from the cached body
+        response = download(client, {'Accept-Encoding': coding})
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == coding
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert decompress(response.data) == plain
+        assert response.headers['ETag'].endswith(f'-{coding}"')
+
+
+def test_uncompressed_download_without_accept_encoding(client):
+    response = download(client, {'Accept-Encoding': 'br'})
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_range_of_cached_download(client):
+    body = download(client).data
+    response = download(client, {'Range': 'bytes=10-19'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 10-19/{len(body)}'
+    assert response.data == body[10:20]
+
+    response = download(client, {'Range': 'bytes=-5'})
+    assert response.status_code == 206
+    assert response.data == body[-5:]
+
+
+def test_range_of_compressed_download_is_of_compressed_body(client):
+    download(client)
+    compressed = download(client, {'Accept-Encoding': 'gzip'}).data
+    response = download(client, {'Accept-Encoding': 'gzip', 'Range': 'bytes=0-9'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 0-9/{len(compressed)}'
+    assert response.data == compressed[:10]
+
+
+def test_unsatisfiable_range_is_answered_with_416(client):
+    body = download(client).data
+    response = download(client, {'Range': f'bytes={len(body) + 10}-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(body)}'
@@ -0,0 +1,92 @@
+import os
+import threading
+import time
+
+import pytest
+
+from conftest import ROOT, list_entry, load_module, media_list_collection
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out waiting for the job')
+        time.sleep(0.01)
+
+
+# Two copies of the app sharing JOBS_DIR, as two gunicorn workers do. Jobs run in the first one
+# and wait for release before fetching the list.
+@pytest.fixture
+def workers(web_app, stub, tmp_path, monkeypatch):
+    monkeypatch.setenv('JOBS_DIR', str(tmp_path / 'jobs'))
+    first = load_module('app', os.path.join(ROOT, 'Docker', 'app.py'))
+    second = load_module('app_second_worker', os.path.join(ROOT, 'Docker', 'app.py'))
+    monkeypatch.setattr(first, 'JOB_SYNC_INTERVAL', 0)
+    stub.lists['test_user'] = media_list_collection(list_entry(1), list_entry(2))
+
+    release = threading.Event()
+    load_user_lists = first.load_user_lists
+
+    def blocking_load_user_lists(*args, **kwargs):
+        release.wait(5)
+        return load_user_lists(*args, **kwargs)
+
+    monkeypatch.setattr(first, 'load_user_lists', blocking_load_user_lists)
+    yield first, second, release
+    release.set()
+
+
+def start_job(app):
+    response = app.app.test_client().post('/jobs', json={'anilist_username': 'test_user', 'xml_username': 'x'})
+    assert response.status_code == 202
+    return response.get_json()['job_id']
+
+
+def job_state(app, job_id):
+    return app.app.test_client().get(f'/jobs/{job_id}').get_json()['state']
+
+
+def test_job_started_in_one_worker_is_polled_from_another(workers):
+    first, second, release = workers
+    job_id = start_job(first)
+    wait_for(lambda: job_state(second, job_id) == 'running')
+
+    release.set()
+    wait_for(lambda: job_state(second, job_id) == 'done')
+    result = second.app.test_client().get(f'/jobs/{job_id}/result')
+    assert result.status_code == 200
+    assert result.data == first.app.test_client().get(f'/jobs/{job_id}/result').data
+    assert b'xml_content' in result.data
+
+
+def test_running_job_cancelled_from_another_worker(workers):
+    first, second, release = workers
+    job_id = start_job(first)
+    wait_for(lambda: job_state(second, job_id) == 'running')
+
+    response = second.app.test_client().post('/cancel', json={'job_id': job_id})
+    assert response.status_code == 200
+    assert os.path.exists(second.job_path(job_id, 'cancel'))
+
+    release.set()
+    wait_for(lambda: job_state(first, job_id) == 'cancelled')
+    assert job_state(second, job_id) == 'cancelled'
+    assert second.app.test_client().get(f'/jobs/{job_id}/result').status_code == 409
+
+
+def test_running_job_cancelled_in_its_own_worker(workers):
+    first, second, release = workers
+    job_id = start_job(first)
+    wait_for(lambda: job_state(first, job_id) == 'running')
+
+    assert first.app.test_client().post('/cancel', json={'job_id': job_id}).get_json()['job_id'] == job_id
+    release.set()
+    wait_for(lambda: job_state(second, job_id) == 'cancelled')
+
+
+def test_unknown_job_is_404_in_every_worker(workers):
+    first, second, release = workers
+    for app in (first, second):
+        assert app.app.test_client().get('/jobs/' + 'f' * 32).status_code == 404
+        assert app.app.test_client().post('/cancel', json={'job_id': 'f' * 32}).status_code == 404
@@ -0,0 +1,106 @@
+import json
+
+import pytest
+
+from conftest import list_entry
+
+
+# A custom list repeats entries of the status lists, and a title holds the "entries" key to trip the parser up
+COLLECTION = {'MediaListCollection': {'lists': [
+    {'name': 'Watching', 'entries': [list_entry(1, 100), list_entry(2, 200, title={'english': None, 'romaji': 'Ésé "entries": [{'})]},
+    {'name': 'Completed', 'entries': []},
+    {'name': 'Favourites', 'isCustomList': True, 'entries': [list_entry(1, 100), list_entry(3, 300)]},
+]}}
+COLLECTION_BYTES = json.dumps({'data': COLLECTION}, ensure_ascii=False).encode('utf-8')
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def rows(entries):
+    return [entry.to_row() for entry in entries]
+
+
+# What parsing the whole document at once gives, without the repeated entries
+def parsed_with_json_loads(web_app, data):
+    entries = {}
+    for media_list in json.loads(data)['data']['MediaListCollection']['lists']:
+        for entry in media_list['entries']:
+            entries.setdefault(entry['media']['id'], web_app.parse_list_entry(entry))
+    return list(entries.values())
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, len(COLLECTION_BYTES)])
+def test_streamed_entries_match_parsing_whole_response(web_app, chunk_size):
+    streamed = list(web_app.iter_anime_entries(chunked(COLLECTION_BYTES, chunk_size)))
+    assert rows(streamed) == rows(parsed_with_json_loads(web_app, COLLECTION_BYTES))
+    assert [entry.anilist_id for entry in streamed] == [1, 2, 3]
+    assert streamed[1].title == 'Ésé "entries": [{'
+
+
+def test_streamed_entries_of_nested_lists_are_all_yielded(web_app):
+    entries = list(web_app.iter_list_entries(chunked(COLLECTION_BYTES, 5)))
+    assert [entry['media']['id'] for entry in entries] == [1, 2, 1, 3]
+
+
+def test_response_without_lists_has_no_entries(web_app):
+    data = json.dumps({'data': {'MediaListCollection': {'lists': []}}}).encode('utf-8')
+    assert list(web_app.iter_anime_entries(chunked(data, 3))) == []
+
+
+def test_response_ending_inside_a_list_raises(web_app):
+    with pytest.raises(ValueError):
+        list(web_app.iter_anime_entries(chunked(COLLECTION_BYTES[:COLLECTION_BYTES.index(b'Anime 3')], 16)))
+
+
+def test_null_fields_parse_to_unknown_values(web_app):
+    entry = list_entry(4, None, idMal=None, episodes=None, seasonYear=None, title={'english': None, 'romaji': 'Romaji Only'})
+    entry['startedAt'] = {'year': None, 'month': None, 'day': None}
+    data = json.dumps({'data': {'MediaListCollection': {'lists': [{'name': 'Planning', 'entries': [entry]}]}}}).encode('utf-8')
+    anime, = web_app.iter_anime_entries(chunked(data, 10))
+    assert anime.title == 'Romaji Only'
+    assert anime.romaji_title is None
+    assert (anime.mal_id, anime.episodes, anime.year, anime.updated_at) == (None, None, None, 0)
+    assert anime.start_date == anime.finish_date == '0000-00-00'
+
+
+def test_snapshot_rows_round_trip(web_app):
+    streamed = list(web_app.iter_anime_entries([COLLECTION_BYTES]))
+    loaded = [web_app.ListEntry.from_row(json.loads(json.dumps(entry.to_row()))) for entry in streamed]
+    assert rows(loaded) == rows(streamed)
+
+
+def page(entries, has_next_page):
+    return json.dumps({'data': {'Page': {'pageInfo': {'hasNextPage': has_next_page}, 'mediaList': entries}}}).encode('utf-8')
+
+
+def test_updated_entries_are_fetched_page_by_page_until_since(web_app, stub, monkeypatch):
+    monkeypatch.setattr(web_app, 'ANILIST_PAGE_SIZE', 2)
+    stub.queued_responses.extend([
+        (200, {}, page([list_entry(5, 500), list_entry(4, 400)], True)),
+        (200, {}, page([list_entry(3, 300), list_entry(2, 200)], True)),
+    ])
+    updated = web_app.fetch_updated_anime_entries('test_user', 300)
+    assert [entry.anilist_id for entry in updated] == [5, 4, 3]
+    assert len(stub.anilist_requests()) == 2
+
+
+def test_updated_entries_stop_at_last_page(web_app, stub):
+    stub.queued_responses.append((200, {}, page([list_entry(5, 500)], False)))
+    assert [entry.anilist_id for entry in web_app.fetch_updated_anime_entries('test_user', 0)] == [5]
+
+
+def test_sync_merges_entries_updated_since_last_fetch(web_app, stub, tmp_path):
+    store = web_app.SnapshotStore(str(tmp_path / 'snapshots.sqlite'))
+    stub.lists['test_user'] = COLLECTION
+    first = web_app.sync_user_anime_list('test_user', store)
+    assert [entry.anilist_id for entry in first] == [1, 2, 3]
+    assert store.get_state('test_user')[0] == 300
+
+    changed = list_entry(2, 400, title={'english': 'Renamed', 'romaji': 'Renamed'})
+    stub.queued_responses.append((200, {}, page([changed, list_entry(3, 300)], False)))
+    second = web_app.sync_user_anime_list('test_user', store)
+    assert [(entry.anilist_id, entry.title) for entry in second] == [(1, 'Anime 1'), (2, 'Renamed'), (3, 'Anime 3')]
+    assert store.get_state('test_user')[0] == 400
+    assert len(stub.anilist_requests()) == 2
@@ -0,0 +1,99 @@
+import types
+
+import pytest
+
+
+class CountingIdMap:
+    def __init__(self, id_map):
+        self.id_map = id_map
+        self.lookups = []
+
+    def get(self, key, default=None):
+        self.lookups.append(key)
+        return self.id_map.get(key, default)
+
+
+class FakeTitleIndex:
+    def __init__(self, matches):
+        self.matches = matches
+        self.lookups = []
+
+    def match(self, anime):
+        self.lookups.append(anime.anilist_id)
+        return self.matches.get(anime.anilist_id)
+
+
+@pytest.fixture
+def resolver(web_app, tmp_path, monkeypatch):
+    # AniList id 12 is in the offline database without a MAL id, 10 maps to 50010
+    index = CountingIdMap(web_app.id_store.anilist_to_mal)
+    titles = FakeTitleIndex({12: (90012, 0.9)})
+    monkeypatch.setattr(web_app, 'id_store', types.SimpleNamespace(anilist_to_mal=index, titles=titles))
+    cache = web_app.MalIdCache(str(tmp_path / 'cache' / 'mal-id-cache.sqlite'))
+
+    def resolve(*anilist_ids):
+        entries = [web_app.ListEntry(anilist_id, f'Test Anime {anilist_id}', 12, 'TV', 0, 0, 0, 0, 'CURRENT', 0)
+                   for anilist_id in anilist_ids]
+        return web_app.resolve_anime_mal_ids(entries, cache)
+
+    return types.SimpleNamespace(resolve=resolve, index=index, titles=titles, cache=cache)
+
+
+def test_cached_miss_skips_index_lookup(resolver):
+    mal_ids, unresolved, _ = resolver.resolve(12)
+    assert mal_ids == [None]
+    assert [anime['anilist_id'] for anime in unresolved] == [12]
+    assert resolver.index.lookups == [12]
+    assert resolver.cache.get_many([12]) == {12: (None, None, False)}
+
+    mal_ids, unresolved, _ = resolver.resolve(12)
+    assert mal_ids == [None]
+    assert [anime['anilist_id'] for anime in unresolved] == [12]
+    assert resolver.index.lookups == [12]
+
+
+def test_expired_miss_is_looked_up_again(resolver):
+    resolver.resolve(12)
+    resolver.cache.miss_ttl = -1
+    assert resolver.cache.get_many([12]) == {}
+    resolver.resolve(12)
+    assert resolver.index.lookups == [12, 12]
+
+
+def test_entries_the_index_resolves_are_not_cached(resolver):
+    mal_ids, unresolved, _ = resolver.resolve(10)
+    assert mal_ids == [50010]
+    assert not unresolved
+    assert resolver.cache.get_many([10]) == {}
+
+
+def test_cached_miss_does_not_stop_title_matching(web_app, resolver, monkeypatch):
+    resolver.resolve(12)
+    monkeypatch.setattr(web_app, 'TITLE_MATCHING', True)
+    mal_ids, unresolved, title_matched = resolver.resolve(12)
+    assert mal_ids == [90012]
+    assert not unresolved
+    assert title_matched == [{'anilist_id': 12, 'title': 'Test Anime 12', 'mal_id': 90012, 'confidence': 0.9}]
+    assert resolver.index.lookups == [12]
+
+    # The match is reused rather than computed again
+    assert resolver.resolve(12)[0] == [90012]
+    assert resolver.titles.lookups == [12]
+
+
+def test_title_matches_are_ignored_with_title_matching_off(web_app, resolver, monkeypatch):
+    monkeypatch.setattr(web_app, 'TITLE_MATCHING', True)
+    resolver.resolve(12)
+    monkeypatch.setattr(web_app, 'TITLE_MATCHING', False)
+    mal_ids, unresolved, title_matched = resolver.resolve(12)
+    assert mal_ids == [None]
+    assert [anime['anilist_id'] for anime in unresolved] == [12]
+    assert not title_matched
+
+
+def test_expired_title_match_is_matched_again(web_app, resolver, monkeypatch):
+    monkeypatch.setattr(web_app, 'TITLE_MATCHING', True)
+    resolver.resolve(12)
+    resolver.cache.title_match_ttl = -1
+    resolver.resolve(12)
+    assert resolver.titles.lookups == [12, 12]
@@ -0,0 +1,78 @@
+import csv
+import gzip
+import json
+import os
+
+import pytest
+
+from conftest import ROOT
+
+EXPORT_PATH = os.path.join(ROOT, 'tests', 'data', 'mal-export.xml')
+UNKNOWN_DATE = {'year': None, 'month': None, 'day': None}
+
+
+def import_export(converter, tmp_path, path=EXPORT_PATH, output='anilist-import.json'):
+    output = str(tmp_path / output)
+    base, ext = os.path.splitext(output)
+    counts = converter.import_mal_export(path, output, f'{base}-unmapped{ext}')
+    return counts, output, f'{base}-unmapped{ext}'
+
+
+def read_json(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_entries_are_read_with_fuzzy_dates(converter):
+    malformed = []
+    entries = list(converter.iter_mal_export(EXPORT_PATH, malformed))
+    assert [entry['mal_id'] for entry in entries] == [50010, 50011, 50001, 99999]
+    watching, completed, planned, _ = entries
+    assert watching['started_at'] == {'year': 2021, 'month': 2, 'day': 3}
+    assert watching['completed_at'] == UNKNOWN_DATE
+    assert (watching['progress'], watching['score'], watching['notes']) == (5, 8, 'Good so far')
+    assert completed['started_at'] == {'year': 2020, 'month': 5, 'day': None}
+    assert completed['completed_at'] == {'year': 2020, 'month': None, 'day': None}
+    assert (completed['status'], completed['repeat']) == ('REPEATING', 2)
+    assert (planned['status'], planned['progress'], planned['score']) == ('PLANNING', 0, 0)
+
+
+def test_malformed_entries_are_skipped_and_reported(converter):
+    malformed = []
+    list(converter.iter_mal_export(EXPORT_PATH, malformed))
+    assert [title for title, _ in malformed] == ['Bad Episodes', 'Bad Score', 'Bad Date']
+    assert 'my_watched_episodes' in malformed[0][1]
+    assert 'my_score' in malformed[1][1]
+    assert 'my_start_date' in malformed[2][1]
+
+
+def test_import_maps_entries_to_anilist_ids(converter, tmp_path, capsys):
+    (mapped, unmapped, malformed), output, unmapped_output = import_export(converter, tmp_path)
+    assert (mapped, unmapped, malformed) == (3, 1, 3)
+    assert [(entry['anilist_id'], entry['status']) for entry in read_json(output)] == [(10, 'CURRENT'), (11, 'REPEATING'), (1, 'PLANNING')]
+    assert [entry['mal_id'] for entry in read_json(unmapped_output)] == [99999]
+    assert 'Skipped malformed entry "Bad Score"' in capsys.readouterr().err
+
+
+def test_import_reads_gzipped_export(converter, tmp_path):
+    path = str(tmp_path / 'animelist.xml.gz')
+    with open(EXPORT_PATH, 'rb') as f, gzip.open(path, 'wb') as out:
+        out.write(f.read())
+    (mapped, unmapped, malformed), _, _ = import_export(converter, tmp_path, path)
+    assert (mapped, unmapped, malformed) == (3, 1, 3)
+
+
+def test_import_writes_a_csv_column_per_date_part(converter, tmp_path):
+    _, output, _ = import_export(converter, tmp_path, output='anilist-import.csv')
+    with open(output, newline='', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    assert rows[1]['anilist_id'] == '11'
+    assert (rows[1]['started_at_year'], rows[1]['started_at_month'], rows[1]['started_at_day']) == ('2020', '5', '')
+
+
+def test_manga_export_is_rejected(converter, tmp_path):
+    path = tmp_path / 'mangalist.xml'
+    path.write_text('<myanimelist><myinfo><user_export_type>2</user_export_type></myinfo></myanimelist>')
+    with pytest.raises(ValueError):
+        import_export(converter, tmp_path, str(path))
+    assert not [name for name in os.listdir(tmp_path) if name.startswith('anilist-import')]
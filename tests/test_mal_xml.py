@@ -0,0 +1,32 @@
+def anime_list(web_app, size):
+    return [web_app.ListEntry(i, f'Test Anime {i}', 12, 'TV', 0, 0, 0, 0, 'CURRENT', 0) for i in range(1, size + 1)]
+
+
+def export_progress(web_app, size, mal_ids):
+    events = []
+    list(web_app.generate_mal_xml(anime_list(web_app, size), 'x', lambda *event: events.append(event), mal_ids))
+    return events
+
+
+def test_progress_is_reported_every_percent_of_entries(web_app):
+    # Every 4th entry has no MAL id
+    mal_ids = [None if i % 4 == 0 else i + 50000 for i in range(1, 5001)]
+    events = export_progress(web_app, 5000, mal_ids)
+    mapped = [event for event in events if event[0] == 'mapped']
+    written = [event for event in events if event[0] == 'written']
+    assert len(mapped) == len(written) == 100
+    assert mapped[0] == ('mapped', 50, 5000)
+    assert mapped[-1] == ('mapped', 5000, 5000)
+    assert written[-1] == ('written', 3750, 3750)
+    assert [count for _, count, _ in written] == sorted(count for _, count, _ in written)
+
+
+def test_progress_steps_are_at_most_100_entries(web_app):
+    events = export_progress(web_app, 25000, [i + 50000 for i in range(1, 25001)])
+    assert [count for stage, count, _ in events if stage == 'mapped'][:2] == [100, 200]
+
+
+def test_progress_of_short_list_is_reported_every_entry(web_app):
+    events = export_progress(web_app, 3, [50001, None, 50003])
+    assert events == [('mapped', 1, 3), ('written', 1, 2), ('mapped', 2, 3), ('written', 1, 2),
+                      ('mapped', 3, 3), ('written', 2, 2)]
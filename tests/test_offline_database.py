@@ -0,0 +1,106 @@
+import os
+
+from conftest import offline_database_bytes
+
+
+def offline_database_gets(stub):
+    return [headers for method, path, headers in stub.requests if method == 'GET']
+
+
+def temporary_files(directory):
+    return [name for name in os.listdir(directory) if name.endswith('.tmp')]
+
+
+def test_load_downloads_offline_database_and_builds_store(web_app, stub):
+    with open(web_app.OFFLINE_DB_PATH, 'rb') as f:
+        assert f.read() == stub.offline_db_bytes
+    assert web_app.read_offline_database_meta()['etag'] == stub.offline_db_etag
+    assert web_app.mapping_store_is_current()
+    assert web_app.id_store.anilist_to_mal.get(10) == 50010
+    assert web_app.id_store.mal_to_anilist.get(50010) == 10
+    assert web_app.id_store.anilist_to_mal.get(12) is None
+
+
+def test_download_revalidates_cached_copy_with_etag(web_app, stub):
+    mtime_ns = os.stat(web_app.OFFLINE_DB_PATH).st_mtime_ns
+
+    assert web_app.download_anime_offline_database() is False
+    first, second = offline_database_gets(stub)
+    assert 'If-None-Match' not in first
+    assert second['If-None-Match'] == stub.offline_db_etag
+    assert os.stat(web_app.OFFLINE_DB_PATH).st_mtime_ns == mtime_ns
+
+
+def test_download_replaces_cached_copy_when_etag_changes(web_app, stub):
+    old_etag = stub.offline_db_etag
+    stub.set_offline_database(offline_database_bytes(300))
+
+    assert web_app.download_anime_offline_database() is True
+    assert offline_database_gets(stub)[-1]['If-None-Match'] == old_etag
+    with open(web_app.OFFLINE_DB_PATH, 'rb') as f:
+        assert f.read() == stub.offline_db_bytes
+    assert web_app.read_offline_database_meta()['etag'] == stub.offline_db_etag
+    assert not temporary_files(web_app.OFFLINE_DB_DIR)
+
+
+def test_download_within_max_age_skips_request(web_app, stub):
+    assert web_app.download_anime_offline_database(max_age=3600) is False
+    assert len(offline_database_gets(stub)) == 1
+
+
+def test_refresh_swaps_in_new_store_and_keeps_old_one_readable(web_app, stub):
+    old_store = web_app.id_store
+    assert old_store.anilist_to_mal.get(250) is None
+    assert web_app.refresh_anime_offline_database() is False
+    assert web_app.id_store is old_store
+
+    stub.set_offline_database(offline_database_bytes(300))
+    assert web_app.refresh_anime_offline_database() is True
+    assert web_app.id_store is not old_store
+    assert web_app.id_store.anilist_to_mal.get(250) == 50250
+    # Requests still holding the old store read the mapping they started with
+    assert old_store.anilist_to_mal.get(10) == 50010
+    assert old_store.anilist_to_mal.get(250) is None
+    assert not temporary_files(web_app.OFFLINE_DB_DIR)
+
+
+def test_process_without_refresher_reloads_replaced_store(web_app, stub, monkeypatch):
+    old_store = web_app.id_store
+    monkeypatch.setattr(web_app, 'mapping_store_checked_at', 0)
+    assert web_app.reload_mapping_store_if_replaced() is False
+
+    # Another process rebuilds the store in place, as the refresher in the gunicorn master does
+    stub.set_offline_database(offline_database_bytes(300))
+    web_app.download_anime_offline_database()
+    web_app.build_mapping_store()
+    assert old_store.is_replaced()
+
+    monkeypatch.setattr(web_app, 'mapping_store_checked_at', 0)
+    assert web_app.reload_mapping_store_if_replaced() is True
+    assert web_app.id_store is not old_store
+    assert web_app.id_store.anilist_to_mal.get(250) == 50250
+
+
+def test_requests_reload_replaced_store_without_refresher(web_app, stub, monkeypatch):
+    old_store = web_app.id_store
+    stub.set_offline_database(offline_database_bytes(300))
+    web_app.download_anime_offline_database()
+    web_app.build_mapping_store()
+    monkeypatch.setattr(web_app, 'mapping_store_checked_at', 0)
+    web_app.app.test_client().get('/metrics')
+    assert web_app.id_store is not old_store
+
+
+def test_refresh_without_swap_leaves_new_store_to_serving_processes(web_app, stub, monkeypatch):
+    # As the refresher in the gunicorn parent does, whose workers reload the rebuilt files
+    monkeypatch.setattr(web_app, 'TITLE_MATCHING', True)
+    old_store = web_app.id_store
+    stub.set_offline_database(offline_database_bytes(300))
+    assert web_app.refresh_anime_offline_database(swap=False) is True
+    assert web_app.id_store is old_store
+    assert old_store.is_replaced()
+
+    monkeypatch.setattr(web_app, 'mapping_store_checked_at', 0)
+    assert web_app.reload_mapping_store_if_replaced() is True
+    assert web_app.id_store.anilist_to_mal.get(250) == 50250
+    assert web_app.id_store._titles is not None
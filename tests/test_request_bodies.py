@@ -0,0 +1,22 @@
+import pytest
+
+ENDPOINTS = [
+    ('/convert', 'Missing usernames'),
+    ('/convert/batch', 'Missing users'),
+    ('/jobs', 'Missing usernames'),
+    ('/cancel', 'Missing job_id')
+]
+BODIES = [
+    ('null', 'application/json'),
+    ('[1, 2]', 'application/json'),
+    ('{not json', 'application/json'),
+    ('anilist_username=someone', 'application/x-www-form-urlencoded')
+]
+
+
+@pytest.mark.parametrize('path, error', ENDPOINTS)
+@pytest.mark.parametrize('body, content_type', BODIES)
+def test_post_without_json_object_is_rejected_with_400(web_app, path, error, body, content_type):
+    response = web_app.app.test_client().post(path, data=body, content_type=content_type)
+    assert response.status_code == 400
+    assert response.get_json() == {'error': error}
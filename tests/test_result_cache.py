@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from conftest import list_entry, media_list_collection
+
+
+@pytest.fixture
+def client(web_app, stub):
+    stub.lists['test_user'] = media_list_collection(list_entry(1), list_entry(2))
+    stub.lists['other_user'] = media_list_collection(list_entry(3))
+    return web_app.app.test_client()
+
+
+def convert(client, anilist_username='test_user', headers=None):
+    return client.get('/convert', query_string={'anilist_username': anilist_username, 'xml_username': 'x'}, headers=headers)
+
+
+def test_matching_etag_is_answered_with_304(client, stub):
+    first = convert(client)
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+
+    second = convert(client, headers={'If-None-Match': etag})
+    assert second.status_code == 304
+    assert second.data == b''
+    assert second.headers['ETag'] == etag
+    assert len(stub.anilist_requests()) == 1
+
+
+def test_other_etag_gets_the_cached_body(client, stub):
+    first = convert(client)
+    second = convert(client, headers={'If-None-Match': '"stale"'})
+    assert second.status_code == 200
+    assert second.data == first.data
+    assert len(stub.anilist_requests()) == 1
+
+
+def test_changed_list_gets_a_new_etag(web_app, client, stub, monkeypatch):
+    etag = convert(client).headers['ETag']
+    monkeypatch.setattr(web_app.result_cache, 'ttl', 0)
+    watched = list_entry(2)
+    watched['progress'] = 5
+    stub.lists['test_user'] = media_list_collection(list_entry(1), watched)
+    response = convert(client, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_least_recently_used_results_are_evicted(web_app):
+    cache = web_app.ResultCache(max_bytes=10, ttl=60)
+    cache.put(('a', 'x'), web_app.CachedResult('a', b'aaaa'))
+    cache.put(('b', 'x'), web_app.CachedResult('b', b'bbbb'))
+    assert cache.get(('a', 'x')) is not None
+    cache.put(('c', 'x'), web_app.CachedResult('c', b'cccc'))
+    assert list(cache.entries) == [('a', 'x'), ('c', 'x')]
+    assert cache.size == 8
+    assert cache.get(('b', 'x')) is None
+
+
+def test_evicted_results_are_served_from_disk_tier(web_app, client, stub, tmp_path, monkeypatch):
+    directory = str(tmp_path / 'results')
+    monkeypatch.setattr(web_app, 'result_cache', web_app.ResultCache(1, 60, directory, 1024 * 1024))
+    first = convert(client)
+    convert(client, 'other_user')
+    assert not web_app.result_cache.entries
+    assert len([name for name in os.listdir(directory) if name.endswith('.body')]) == 2
+
+    again = convert(client, headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+    response = convert(client)
+    assert response.data == first.data
+    assert response.headers['ETag'] == first.headers['ETag']
+    assert len(stub.anilist_requests()) == 2
+
+
+def test_disk_tier_drops_oldest_results_past_its_size(web_app, tmp_path):
+    directory = str(tmp_path / 'results')
+    cache = web_app.ResultCache(1, 60, directory, 10)
+    cache.put(('a', 'x'), web_app.CachedResult('a', b'aaaaaa'))
+    os.utime(cache.disk_path(('a', 'x')) + '.body', (1, 1))
+    cache.put(('b', 'x'), web_app.CachedResult('b', b'bbbbbb'))
+    assert cache.get(('a', 'x')) is None
+    assert cache.get(('b', 'x')).body == b'bbbbbb'
@@ -0,0 +1,35 @@
+import ast
+import functools
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Definitions copied into both scripts, the rest differ on purpose (how the id store is reached,
+# per-process connections in the web app, the window and command line of the desktop script)
+SHARED_DEFINITIONS = [
+    'read_offline_database_meta', 'download_anime_offline_database', 'build_id_index', 'SortedIdMap',
+    'title_index_path', 'normalize_title', 'title_trigrams', 'build_title_index', 'TitleIndex',
+    'build_mapping_store', 'index_file_is_current', 'mapping_store_is_current', 'load_anime_offline_database',
+    'prepare_anime_offline_database', 'AniListError', 'AniListNotFoundError', 'AniListRateLimitError',
+    'AniListTransportError', 'AniListCancelledError', 'TokenBucket', 'AniListClient', 'pack_date', 'format_date',
+    'ListEntry', 'parse_list_entry', 'iter_list_entries', 'iter_anime_entries', 'parse_media_list_collection',
+    'fetch_updated_anime_entries', 'snapshot_key', 'map_format_to_mal_type', 'map_status_to_mal_status',
+    'anime_xml_fields', 'manga_xml_fields', 'escape_xml_text', 'xml_element', 'generate_mal_xml'
+]
+
+
+@functools.lru_cache(maxsize=None)
+def top_level_definitions(path):
+    with open(os.path.join(ROOT, path), encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    return {node.name: ast.dump(node) for node in tree.body if isinstance(node, (ast.FunctionDef, ast.ClassDef))}
+
+
+@pytest.mark.parametrize('name', SHARED_DEFINITIONS)
+def test_shared_definition_is_identical(name):
+    desktop = top_level_definitions('anime_list_converter.py')
+    web = top_level_definitions(os.path.join('Docker', 'app.py'))
+    assert name in desktop and name in web
+    assert desktop[name] == web[name], f'{name} differs between anime_list_converter.py and Docker/app.py'
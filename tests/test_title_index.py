@@ -0,0 +1,87 @@
+import json
+import os
+
+import pytest
+
+MAL_ANIME = 'https://myanimelist.net/anime/'
+
+
+def offline_entry(mal_id, title, synonyms=(), type_='TV', episodes=12, year=2000, anilist_id=None):
+    sources = [MAL_ANIME + str(mal_id)]
+    if anilist_id is not None:
+        sources.append(f'https://anilist.co/anime/{anilist_id}')
+    return {'sources': sources, 'title': title, 'synonyms': list(synonyms), 'type': type_,
+            'episodes': episodes, 'animeSeason': {'year': year}}
+
+
+ENTRIES = [
+    offline_entry(1, 'Cowboy Bebop', ['Kauboi Bibappu'], episodes=26, year=1998),
+    offline_entry(2, 'Mushishi', ['Mushi-Shi'], episodes=26, year=2005),
+    offline_entry(3, 'Shoujo Kakumei Utena', ['Revolutionary Girl Utena'], episodes=39, year=1997),
+    # Linked to AniList, so AniList ids already resolve it and the index leaves it out
+    offline_entry(4, 'Trigun', anilist_id=6, episodes=26, year=1998),
+] + [offline_entry(100 + i, f'Synthetic Anime {i}', [f'Synthetic {i}']) for i in range(1, 400)]
+
+
+@pytest.fixture
+def titles(web_app, tmp_path):
+    db_path = tmp_path / 'titles-source.json'
+    db_path.write_text(json.dumps({'data': ENTRIES}))
+    path = str(tmp_path / 'test.idx.titles')
+    web_app.build_title_index(ENTRIES, path, os.stat(db_path))
+    return web_app.TitleIndex(path)
+
+
+def list_entry(web_app, title, episodes=12, year=2000, format_='TV'):
+    return web_app.ListEntry(1, title, episodes, format_, 0, 0, 0, 0, 'CURRENT', 0, year=year)
+
+
+def test_build_writes_index_that_loads_from_disk(web_app, titles, tmp_path):
+    path = str(tmp_path / 'test.idx.titles')
+    assert web_app.index_file_is_current(str(tmp_path / 'titles-source.json'), path, web_app.TITLE_INDEX_MAGIC)
+    assert sorted(titles.mal_ids) == [1, 2, 3] + list(range(101, 500))
+    assert len(titles.title_candidates) == 2 * (len(ENTRIES) - 1)
+    assert list(titles.title_sizes) == sorted(titles.title_sizes)
+    assert titles.years[list(titles.mal_ids).index(1)] == 1998
+
+
+def test_load_rejects_other_files(web_app, tmp_path):
+    path = tmp_path / 'not-an-index'
+    path.write_bytes(b'\0' * web_app.TITLE_INDEX_HEADER.size)
+    with pytest.raises(Exception):
+        web_app.TitleIndex(str(path))
+
+
+def test_exact_title_matches(web_app, titles):
+    mal_id, confidence = titles.match(list_entry(web_app, 'Cowboy Bebop', episodes=26, year=1998))
+    assert mal_id == 1
+    assert confidence == pytest.approx(1)
+
+
+def test_synonym_matches(web_app, titles):
+    assert titles.match(list_entry(web_app, 'Revolutionary Girl Utena', episodes=39, year=1997))[0] == 3
+
+
+def test_fuzzy_title_matches(web_app, titles):
+    mal_id, confidence = titles.match(list_entry(web_app, 'Mushishi!', episodes=26, year=2005))
+    assert mal_id == 2
+    mal_id, confidence = titles.match(list_entry(web_app, 'Cowboy Bebopp', episodes=26, year=1998))
+    assert mal_id == 1
+    assert 0.8 <= confidence < 1
+
+
+def test_title_below_threshold_does_not_match(web_app, titles):
+    assert titles.match(list_entry(web_app, 'Bebop Cowboys Adventure', episodes=26, year=1998)) is None
+    assert titles.match(list_entry(web_app, 'Cowboy Bebopp', episodes=26, year=1998), threshold=0.99) is None
+
+
+def test_titles_linked_to_anilist_are_not_matched(web_app, titles):
+    assert titles.match(list_entry(web_app, 'Trigun', episodes=26, year=1998)) is None
+
+
+def test_similar_titles_match_through_common_trigrams(web_app, titles, monkeypatch):
+    # Every synthetic title shares the trigrams of "Synthetic Anime", which match far more titles than
+    # TITLE_MATCH_MAX_POSTINGS and are skipped when finding candidates
+    monkeypatch.setattr(web_app, 'TITLE_MATCH_MAX_POSTINGS', 32)
+    assert titles.match(list_entry(web_app, 'Synthetic Anime 123'))[0] == 223
+    assert titles.match(list_entry(web_app, 'Synthetic Anime 12'))[0] == 112